@@ -1,46 +1,46 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file
-from database import db, Contact, Template, Campaign, EmailLog, Reply, Settings, Server, ContactGroup, User
-from sqlalchemy import text
-from email_utils import send_email, check_replies
+from dotenv import load_dotenv
+
+load_dotenv() # Load environment variables from .env file before modules read their settings
+
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, Response
+from database import db, Contact, Template, Campaign, EmailLog, EmailLogDaily, TrackingEvent, Reply, Settings, Server, ContactGroup, User, Segment
+from sqlalchemy.orm import selectinload, defer, Session
+from email_utils import send_email, check_replies, is_hard_bounce, normalize_email, normalize_emails
+from audience import set_contact_tags, parse_definition, count_recipients, contacts_by_email
+from suppression import suppression_list
+from db_writer import configure_sqlite, background_writer, backup_sqlite, restore_sqlite
+from init_db import init_database
+from template_registry import FileTemplateRegistry, is_safe_name
+from template_build import build_template, personalize
+from attachments import store_attachment, prune_attachments, encoded_attachments
+from dkim_signing import parse_private_key, DkimKeyError
+from progress import progress_registry
+from scheduler import send_scheduler, domain_limits
+from sender import server_smtp_config, enqueue_campaign, delete_queue, run_campaign
+from server_health import health_monitor
+from recovery import campaign_recovery
+from reply_search import search_filter, keyset_page
+from retention import archived_counts, archived_daily
+from tracking import tracker, PIXEL
+from static_assets import static_assets
+from profiling import PROFILING, request_profiler
+from metrics import registry, instrument_sessions, authorized, emails_total, replies_total, CONTENT_TYPE
 import os
 import json
-from openpyxl import load_workbook
-import glob
-import threading
+import tempfile
+import time
 from datetime import datetime, timedelta, timezone
-from email.utils import parseaddr
-import pytz
-import shutil
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 TEMPLATE_DIR = os.path.join(basedir, 'email_templates')
+file_template_registry = FileTemplateRegistry(TEMPLATE_DIR)
 
 def get_file_templates():
-    if not os.path.exists(TEMPLATE_DIR):
-        os.makedirs(TEMPLATE_DIR)
-    files = glob.glob(os.path.join(TEMPLATE_DIR, '*.html'))
-    return [os.path.basename(f) for f in files]
+    return file_template_registry.names()
 
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from dotenv import load_dotenv
-
-load_dotenv() # Load environment variables from .env file
-
-app = Flask(__name__)
-# Use environment variable for DB URL
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
-if not app.config['SQLALCHEMY_DATABASE_URI']:
-    # Fallback to local sqlite if no DATABASE_URL is set (optional, but good for safety)
-    app.config['SQLALCHEMY_DATABASE_URI'] = r'sqlite:///email_marketing.db'
-
-# Fix for some SQLAlchemy versions if the URL starts with postgres://
-if app.config['SQLALCHEMY_DATABASE_URI'] and app.config['SQLALCHEMY_DATABASE_URI'].startswith("postgres://"):
-    app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_DATABASE_URI'].replace("postgres://", "postgresql://", 1)
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
-db.init_app(app)
 
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'login'
 
 # UserMixin for the User model is now directly in database.py
@@ -49,33 +49,50 @@ login_manager.login_view = 'login'
 def load_user(user_id):
     return db.session.get(User, int(user_id))
 
-with app.app_context():
-    db.create_all()
-    # Create default admin user if not exists
-    if not User.query.filter_by(username='admin').first():
-        admin = User(username='admin', password='adminpassword')
-        db.session.add(admin)
-        db.session.commit()
-    
-    # Migration for error_message column
-    try:
-        with db.engine.connect() as conn:
-            conn.execute(text("ALTER TABLE campaign ADD COLUMN error_message TEXT"))
-            conn.commit()
-    except Exception:
-        pass # Column likely exists
+# Session commit metrics, registered once per process
+instrument_sessions(Session)
+
+def create_app():
+    """
+    Builds the app: configuration and extensions only. Nothing here touches the
+    database, so web and sender worker processes start fast and can't race each other;
+    creating tables, migrations and the default admin are init_db.py's job.
+    """
+    app = Flask(__name__)
+    # Use environment variable for DB URL
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
+    if not app.config['SQLALCHEMY_DATABASE_URI']:
+        # Fallback to local sqlite if no DATABASE_URL is set (optional, but good for safety)
+        app.config['SQLALCHEMY_DATABASE_URI'] = r'sqlite:///email_marketing.db'
+
+    # Fix for some SQLAlchemy versions if the URL starts with postgres://
+    if app.config['SQLALCHEMY_DATABASE_URI'] and app.config['SQLALCHEMY_DATABASE_URI'].startswith("postgres://"):
+        app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_DATABASE_URI'].replace("postgres://", "postgresql://", 1)
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+    # SQLite concurrency mode: WAL + busy timeout + a single background writer thread (set SQLITE_WAL=0 to disable)
+    app.config['SQLITE_WAL'] = os.environ.get('SQLITE_WAL', '1') != '0'
+    app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    # 'thread': campaigns are sent by a thread of the web process that started them (sender_worker.py may help)
+    # 'worker': the web process only queues campaigns; sender_worker.py processes send them
+    app.config['SENDER_MODE'] = os.environ.get('SENDER_MODE', 'thread')
+    db.init_app(app)
+    login_manager.init_app(app)
+    static_assets.init_app(app)
 
-    # Reset stuck campaigns
-    try:
-        stuck_campaigns = Campaign.query.filter_by(status='sending').all()
-        if stuck_campaigns:
-            for campaign in stuck_campaigns:
-                campaign.status = 'failed'
-                campaign.error_message = "Campaign interrupted by server restart."
-            db.session.commit()
-            print(f"Reset {len(stuck_campaigns)} stuck campaigns to failed.")
-    except Exception as e:
-        print(f"Error resetting stuck campaigns: {e}")
+    with app.app_context():
+        sqlite_mode = app.config['SQLITE_WAL'] and configure_sqlite(db.engine, app.config['SQLITE_BUSY_TIMEOUT_MS'])
+        background_writer.init_app(app, enabled=sqlite_mode)
+        health_monitor.init_app(app)
+        tracker.init_app(app)
+        campaign_recovery.init_app(app)
+        # Server and domain limits hold across every process sending with this database
+        send_scheduler.init_app(app)
+        domain_limits.init_app(app)
+        if PROFILING:
+            request_profiler.init_app(app, db.engine)
+    return app
+
+app = create_app()
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -113,8 +130,10 @@ def dashboard():
     campaign_count = Campaign.query.count()
     
     # Advanced stats
-    total_sent = EmailLog.query.filter_by(status='sent').count()
-    total_failed = EmailLog.query.filter_by(status='failed').count()
+    # Logs moved to the archive by retention only remain as daily counts
+    archived = archived_counts()
+    total_sent = EmailLog.query.filter_by(status='sent').count() + sum(n for (_, status), n in archived.items() if status == 'sent')
+    total_failed = EmailLog.query.filter_by(status='failed').count() + sum(n for (_, status), n in archived.items() if status == 'failed')
     total_attempts = total_sent + total_failed
     success_rate = round((total_sent / total_attempts * 100), 1) if total_attempts > 0 else 0
     
@@ -124,25 +143,37 @@ def dashboard():
 
     # Today's stats
     try:
+        import pytz
         cairo_tz = pytz.timezone("Africa/Cairo")
         today = datetime.now(cairo_tz).date()
     except Exception as e:
         today = datetime.now(timezone.utc).date()
-    sent_today = EmailLog.query.filter(db.func.date(EmailLog.sent_at) == today, EmailLog.status == 'sent').count()
-    replies_today = Reply.query.filter(db.func.date(Reply.received_at) == today).count()
+    # Compare against day boundaries rather than date(column) so the timestamp indexes are used
+    today_start = datetime.combine(today, datetime.min.time())
+    tomorrow_start = today_start + timedelta(days=1)
+    sent_today = EmailLog.query.filter(EmailLog.status == 'sent', EmailLog.sent_at >= today_start, EmailLog.sent_at < tomorrow_start).count()
+    replies_today = Reply.query.filter(Reply.received_at >= today_start, Reply.received_at < tomorrow_start).count()
 
     # Recent activity
     recent_campaigns = Campaign.query.order_by(Campaign.created_at.desc()).limit(5).all()
-    recent_replies = Reply.query.order_by(Reply.received_at.desc()).limit(5).all()
-
-    # Chart Data: Last 7 Days Sent
+    recent_replies = Reply.query.options(defer(Reply.content)).order_by(Reply.received_at.desc()).limit(5).all()
+
+    # Chart Data: Last 7 Days Sent (one grouped range query instead of one query per day)
+    day = db.func.date(EmailLog.sent_at)
+    daily_counts = db.session.query(day, db.func.count(EmailLog.id)).filter(
+        EmailLog.status == 'sent',
+        EmailLog.sent_at >= today_start - timedelta(days=6),
+        EmailLog.sent_at < tomorrow_start
+    ).group_by(day).all()
+    daily_counts = {str(d): c for d, c in daily_counts}
+    for d, c in archived_daily(today - timedelta(days=6), today).items():
+        daily_counts[d] = daily_counts.get(d, 0) + c
     daily_stats_labels = []
     daily_stats_values = []
     for i in range(6, -1, -1):
         date = today - timedelta(days=i)
-        count = EmailLog.query.filter(db.func.date(EmailLog.sent_at) == date, EmailLog.status == 'sent').count()
         daily_stats_labels.append(date.strftime('%d %b'))
-        daily_stats_values.append(count)
+        daily_stats_values.append(daily_counts.get(date.isoformat(), 0))
 
     # Chart Data: Campaign Status
     campaign_statuses = db.session.query(Campaign.status, db.func.count(Campaign.status)).group_by(Campaign.status).all()
@@ -152,7 +183,7 @@ def dashboard():
     campaign_stats_values = [campaign_stats.get(s, 0) for s in status_order]
 
     # Follow-ups sent
-    followup_count = EmailLog.query.filter_by(status='sent', type='followup').count()
+    followup_count = EmailLog.query.filter_by(status='sent', type='followup').count() + archived.get(('followup', 'sent'), 0)
 
     # Failed and Draft Campaigns
     failed_campaign_count = Campaign.query.filter_by(status='failed').count()
@@ -181,27 +212,54 @@ def replies():
     # Filters
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
-    server_id = request.args.get('server_id')
+    server_id = request.args.get('server_id', type=int)
+    campaign_id = request.args.get('campaign_id', type=int)
+    unread = request.args.get('unread') == '1'
+    search = (request.args.get('q') or '').strip()
     
-    query = Reply.query
+    # Bodies are loaded one at a time by reply_content when a reply is opened
+    query = Reply.query.options(defer(Reply.content), selectinload(Reply.campaign))
     
-    if start_date:
-        query = query.filter(Reply.received_at >= datetime.strptime(start_date, '%Y-%m-%d'))
-    if end_date:
-        # Add one day to include the end date fully
-        end_dt = datetime.strptime(end_date, '%Y-%m-%d')
-        query = query.filter(Reply.received_at < end_dt.replace(day=end_dt.day+1))
+    try:
+        if start_date:
+            query = query.filter(Reply.received_at >= datetime.strptime(start_date, '%Y-%m-%d'))
+        if end_date:
+            # Add one day to include the end date fully
+            query = query.filter(Reply.received_at < datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1))
+    except ValueError:
+        flash('Invalid date format. Use YYYY-MM-DD.', 'error')
+        return redirect(url_for('replies'))
         
     # If server_id is provided for filtering (optional, if we want to see replies from specific server)
     if server_id:
-        query = query.filter_by(server_id=server_id)
-
-    replies_list = query.order_by(Reply.received_at.desc()).all()
+        query = query.filter(Reply.server_id == server_id)
+    if campaign_id:
+        query = query.filter(Reply.campaign_id == campaign_id)
+    if unread:
+        query = query.filter(Reply.is_read == False)
+    if search:
+        query = query.filter(search_filter(db.session, search))
+
+    # Keyset pagination: pages are fetched relative to the received_at/id of the edge row
+    replies_list, older, newer = keyset_page(query, before=request.args.get('before'), after=request.args.get('after'))
     servers = Server.query.all()
+    campaigns = db.session.query(Campaign.id, Campaign.name).order_by(Campaign.name).all()
+    filters = {k: v for k, v in request.args.items() if k not in ('before', 'after') and v}
     
-    return render_template('replies.html', replies=replies_list, servers=servers, 
-                           selected_server_id=int(server_id) if server_id else None,
-                           start_date=start_date, end_date=end_date)
+    return render_template('replies.html', replies=replies_list, servers=servers, campaigns=campaigns,
+                           selected_server_id=server_id, selected_campaign_id=campaign_id,
+                           start_date=start_date, end_date=end_date, unread=unread, search=search,
+                           older_url=url_for('replies', before=older, **filters) if older else None,
+                           newer_url=url_for('replies', after=newer, **filters) if newer else None)
+
+@app.route('/replies/<int:reply_id>')
+@login_required
+def reply_content(reply_id):
+    reply = Reply.query.get_or_404(reply_id)
+    if not reply.is_read:
+        reply.is_read = True
+        db.session.commit()
+    return jsonify({'id': reply.id, 'content': reply.content or ''})
 
 @app.route('/check_replies_manual', methods=['POST'])
 @login_required
@@ -251,10 +309,16 @@ def check_replies_manual():
         else:
             count = 0
             if new_replies:
+                pending = []
+                seen = set()
                 for r in new_replies:
+                    key = (r['sender'], r['subject'], r['content'])
+                    if key in seen:
+                        continue
+                    seen.add(key)
                     exists = Reply.query.filter_by(sender_email=r['sender'], subject=r['subject'], content=r['content']).first()
                     if not exists:
-                        reply = Reply(
+                        pending.append(Reply(
                             campaign_id=r['campaign_id'],
                             sender_email=r['sender'],
                             subject=r['subject'],
@@ -262,10 +326,12 @@ def check_replies_manual():
                             server_id=server.id,
                             cc=r.get('cc'),
                             has_attachments=r.get('has_attachments', False)
-                        )
-                        db.session.add(reply)
-                        count += 1
-                db.session.commit()
+                        ))
+                count = len(pending)
+                replies_total.inc(count, result='new')
+                if pending:
+                    background_writer.submit(lambda session: session.add_all(pending))
+                    background_writer.flush()
             
             msg = f'Checked {scanned_count} emails since {start_date.strftime("%Y-%m-%d")}. Found {count} new replies.'
             if request.is_json:
@@ -303,23 +369,29 @@ def resend_campaign_single(reply_id):
         flash('Campaign template not found.', 'error')
         return redirect(url_for('replies'))
         
+    suppression_list.maybe_refresh()
+    if suppression_list.is_suppressed(reply.sender_email):
+        flash(f'{reply.sender_email} is on the suppression list.', 'error')
+        return redirect(url_for('replies'))
+
     # Try to find contact for personalization
-    _, email_addr = parseaddr(reply.sender_email)
-    contact = Contact.query.filter_by(email=email_addr).first()
+    contact = Contact.query.filter_by(email=normalize_email(reply.sender_email)).first()
     name = contact.name if contact else 'Valued Customer'
     
-    smtp_config = {
-        'server': server.smtp_server,
-        'port': server.smtp_port,
-        'email': server.smtp_email,
-        'password': server.smtp_password
-    }
+    smtp_config = server_smtp_config(server)
     
-    personalized_content = template.content.replace('{{name}}', name)
+    built = build_template(template)
+    html_content, text_content = personalize(built, name)
     
     try:
-        success, error = send_email(smtp_config, reply.sender_email, template.subject, personalized_content)
-        
+        with send_scheduler.slot(None, server.id):
+            success, error = send_email(smtp_config, reply.sender_email, campaign.email_subject, html_content,
+                                        text_content, built.html_encoding, built.text_encoding,
+                                        encoded_attachments.parts(campaign.attachments))
+        if not success and is_hard_bounce(error):
+            suppression_list.add(reply.sender_email, 'bounce', error, commit=False)
+        emails_total.inc(status='sent' if success else 'failed', server=server.id, campaign=campaign.id, type='resend')
+
         log = EmailLog(
             campaign_id=campaign.id,
             recipient_email=reply.sender_email,
@@ -346,21 +418,26 @@ def send_followup(reply_id):
     subject = request.form.get('subject')
     content = request.form.get('content')
     
+    suppression_list.maybe_refresh()
+    if suppression_list.is_suppressed(reply.sender_email):
+        flash(f'{reply.sender_email} is on the suppression list.', 'error')
+        return redirect(url_for('replies'))
+
     server = Server.query.filter_by(is_primary=True).first()
     if not server:
         flash('No primary server configured.', 'error')
         return redirect(url_for('replies'))
         
-    smtp_config = {
-        'server': server.smtp_server,
-        'port': server.smtp_port,
-        'email': server.smtp_email,
-        'password': server.smtp_password
-    }
+    smtp_config = server_smtp_config(server)
     
     try:
-        success, error = send_email(smtp_config, reply.sender_email, subject, content)
-        
+        with send_scheduler.slot(None, server.id):
+            success, error = send_email(smtp_config, reply.sender_email, subject, content)
+        if not success and is_hard_bounce(error):
+            suppression_list.add(reply.sender_email, 'bounce', error, commit=False)
+        emails_total.inc(status='sent' if success else 'failed', server=server.id,
+                         campaign=reply.campaign_id or '', type='followup')
+
         log = EmailLog(
             campaign_id=reply.campaign_id,
             recipient_email=reply.sender_email,
@@ -432,24 +509,25 @@ def contacts():
             
             if manual_entry:
                 count = 0
-                lines = manual_entry.replace(',', '\n').split('\n')
+                emails, invalid = normalize_emails(manual_entry.replace(',', '\n').split('\n'))
                 group = db.session.get(ContactGroup, group_id) if group_id else None
-                
-                for line in lines:
-                    email = line.strip()
-                    if email:
-                        existing = Contact.query.filter_by(email=email).first()
-                        if not existing:
-                            contact = Contact(email=email, name='Unknown')
-                            if group:
-                                contact.groups.append(group)
-                            db.session.add(contact)
-                            count += 1
-                        elif group and group not in existing.groups:
-                            existing.groups.append(group)
-                            count += 1 # Count as success if added to group
+                existing_contacts = contacts_by_email(emails)
+
+                for email in emails:
+                    existing = existing_contacts.get(email)
+                    if not existing:
+                        contact = Contact(email=email, name='Unknown')
+                        if group:
+                            contact.groups.append(group)
+                        db.session.add(contact)
+                        count += 1
+                    elif group and group not in existing.groups:
+                        existing.groups.append(group)
+                        count += 1 # Count as success if added to group
                 db.session.commit()
                 flash(f'Successfully processed {count} contacts.', 'success')
+                if invalid:
+                    flash(f'Skipped {len(invalid)} invalid email addresses: {", ".join(invalid[:5])}', 'error')
 
         elif action == 'import_file':
             # Handle file upload
@@ -460,6 +538,7 @@ def contacts():
                 try:
                     data = []
                     if file.filename.endswith('.xlsx'):
+                        from openpyxl import load_workbook # Slow to import and only needed here
                         wb = load_workbook(file)
                         sheet = wb.active
                         headers = [cell.value for cell in sheet[1]]
@@ -473,33 +552,91 @@ def contacts():
                     
                     count = 0
                     group = db.session.get(ContactGroup, group_id) if group_id else None
-                    
+                    tag_cache = {}
+
+                    # Normalize every address up front; the first row wins for duplicates in the file
+                    rows_by_email = {}
+                    invalid = []
                     for row in data:
-                        email = row.get('Email') or row.get('email')
-                        if email:
-                            existing = Contact.query.filter_by(email=email).first()
-                            contact = existing
-                            if not existing:
-                                contact = Contact(
-                                    name=row.get('Name') or row.get('name'),
-                                    email=email,
-                                    company=row.get('Company') or row.get('company')
-                                )
-                                db.session.add(contact)
-                                count += 1
-                            
-                            if group and group not in contact.groups:
-                                contact.groups.append(group)
-                                if existing: count += 1 # Count if just added to group
-                                
+                        raw_email = row.get('Email') or row.get('email')
+                        if not raw_email:
+                            continue
+                        email = normalize_email(raw_email)
+                        if email is None:
+                            invalid.append(str(raw_email))
+                        elif email not in rows_by_email:
+                            rows_by_email[email] = row
+                    existing_contacts = contacts_by_email(list(rows_by_email))
+
+                    for email, row in rows_by_email.items():
+                        existing = existing_contacts.get(email)
+                        contact = existing
+                        if not existing:
+                            contact = Contact(
+                                name=row.get('Name') or row.get('name'),
+                                email=email,
+                                company=row.get('Company') or row.get('company')
+                            )
+                            db.session.add(contact)
+                            count += 1
+
+                        tags = row.get('Tags') or row.get('tags')
+                        if tags:
+                            set_contact_tags(contact, tags, tag_cache)
+
+                        if group and group not in contact.groups:
+                            contact.groups.append(group)
+                            if existing: count += 1 # Count if just added to group
+
                     db.session.commit()
                     flash(f'Successfully processed {count} contacts.', 'success')
+                    if invalid:
+                        flash(f'Skipped {len(invalid)} invalid email addresses: {", ".join(invalid[:5])}', 'error')
                 except Exception as e:
                     flash(f'Error importing contacts: {str(e)}', 'error')
-            
+
+        elif action == 'block_emails':
+            block_entry = request.form.get('block_entry')
+            if block_entry:
+                count = 0
+                for line in block_entry.replace(',', '\n').split('\n'):
+                    if line.strip() and suppression_list.add(line, 'manual', 'Blocked manually', commit=False):
+                        count += 1
+                db.session.commit()
+                flash(f'Blocked {count} email addresses.', 'success')
+
+        elif action == 'create_segment':
+            segment_name = request.form.get('segment_name')
+            definition = request.form.get('segment_definition')
+            if segment_name and definition:
+                if Segment.query.filter_by(name=segment_name).first():
+                    flash('Segment already exists.', 'error')
+                else:
+                    try:
+                        rules = parse_definition(definition)
+                        segment = Segment(name=segment_name, definition=json.dumps(rules))
+                        db.session.add(segment)
+                        db.session.commit()
+                        flash(f'Segment "{segment_name}" created.', 'success')
+                    except ValueError as e:
+                        flash(f'Invalid segment definition: {str(e)}', 'error')
+
     contacts_list = Contact.query.order_by(Contact.created_at.desc()).all()
     groups = ContactGroup.query.all()
-    return render_template('contacts.html', contacts=contacts_list, groups=groups)
+    segments = Segment.query.order_by(Segment.name).all()
+    return render_template('contacts.html', contacts=contacts_list, groups=groups, segments=segments)
+
+@app.route('/segments/<int:segment_id>/delete', methods=['POST'])
+@login_required
+def delete_segment(segment_id):
+    segment = Segment.query.get_or_404(segment_id)
+    if Campaign.query.filter_by(segment_id=segment_id).first():
+        flash('Cannot delete segment because it is used in a campaign.', 'error')
+    else:
+        db.session.delete(segment)
+        db.session.commit()
+        flash('Segment deleted successfully.', 'success')
+    return redirect(url_for('contacts'))
 
 @app.route('/templates', methods=['GET', 'POST'])
 @login_required
@@ -524,30 +661,61 @@ def templates():
 def get_template_content(filename):
     try:
         # Security check: ensure filename doesn't contain path separators
-        if '..' in filename or '/' in filename or '\\' in filename:
+        if not is_safe_name(filename):
             return jsonify({'error': 'Invalid filename'}), 400
-            
-        file_path = os.path.join(TEMPLATE_DIR, filename)
-        if not os.path.exists(file_path):
+
+        file_template = file_template_registry.get(filename)
+        if not file_template:
             return jsonify({'error': 'File not found'}), 404
-            
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-            
-        return jsonify({'content': content})
+
+        return jsonify({'content': file_template.content})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def attach_uploaded_files(campaign):
+    """
+    Stores the files uploaded in the 'attachments' field and links them to the campaign.
+    Raises ValueError for empty or oversized files.
+    """
+    for upload in request.files.getlist('attachments'):
+        if not upload or not upload.filename:
+            continue
+        attachment = store_attachment(upload.filename, upload.read(), upload.mimetype)
+        if attachment not in campaign.attachments:
+            campaign.attachments.append(attachment)
+
+def read_scheduling_form():
+    """
+    Reads (priority, weight) from the campaign forms; weight is clamped to 1..10.
+    """
+    try:
+        priority = int(request.form.get('priority') or 0)
+        weight = min(max(int(request.form.get('weight') or 1), 1), 10)
+    except ValueError:
+        return 0, 1
+    return priority, weight
+
+def parse_campaign_target(value):
+    """
+    Parses the campaign target select value into (target_group_id, segment_id).
+    '' = All Contacts, '<id>' = contact group, 'segment:<id>' = segment.
+    """
+    if not value:
+        return None, None
+    if value.startswith('segment:'):
+        return None, int(value.split(':', 1)[1])
+    return int(value), None
+
 @app.route('/campaigns', methods=['GET', 'POST'])
 @login_required
 def campaigns():
     if request.method == 'POST':
         name = request.form.get('name')
         template_mode = request.form.get('template_mode')
-        target_group_id = request.form.get('target_group_id')
-        target_group_id = int(target_group_id) if target_group_id else None
-        
+        target_group_id, segment_id = parse_campaign_target(request.form.get('target_group_id'))
+
         template_id = None
+        subject = None
         if template_mode == 'custom':
             custom_subject = request.form.get('custom_subject')
             custom_content = request.form.get('custom_content')
@@ -559,42 +727,52 @@ def campaigns():
             file_template = request.form.get('file_template')
             if file_template:
                 try:
-                    with open(os.path.join(TEMPLATE_DIR, file_template), 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    new_template = Template(name=f"File: {file_template}", subject=f"Campaign: {name}", content=content)
-                    db.session.add(new_template)
-                    db.session.commit()
-                    template_id = new_template.id
+                    loaded = file_template_registry.get(file_template)
+                    if not loaded:
+                        raise FileNotFoundError(file_template)
+                    # Reuse the stored version of this file if its content is unchanged
+                    template_name = f"File: {file_template}"
+                    version = Template.query.filter_by(content_hash=loaded.content_hash, name=template_name).first()
+                    if not version:
+                        version = Template(name=template_name, subject=os.path.splitext(file_template)[0], content=loaded.content)
+                        db.session.add(version)
+                        db.session.commit()
+                    template_id = version.id
+                    subject = f"Campaign: {name}"
                 except Exception as e:
                     flash(f'Error reading template file: {str(e)}', 'error')
                     return redirect(url_for('campaigns'))
         else:
             template_id = request.form.get('template_id')
         
-        # Calculate contacts count based on group
-        if target_group_id:
-            group = db.session.get(ContactGroup, target_group_id)
-            contacts_count = len(group.contacts) if group else 0
-        else:
-            contacts_count = Contact.query.filter_by(status='active').count()
-        
         existing = Campaign.query.filter_by(name=name).first()
         if existing:
             flash(f'A campaign with the name "{name}" already exists. Please use a different name.', 'error')
             return redirect(url_for('campaigns'))
-        
-        new_campaign = Campaign(name=name, template_id=template_id, status='draft', total_contacts=contacts_count, target_group_id=target_group_id)
+
+        priority, weight = read_scheduling_form()
+        new_campaign = Campaign(name=name, template_id=template_id, subject=subject, status='draft', target_group_id=target_group_id, segment_id=segment_id,
+                                priority=priority, weight=weight)
+        # Calculate contacts count based on group or segment
+        new_campaign.total_contacts = count_recipients(new_campaign)
         db.session.add(new_campaign)
+        try:
+            attach_uploaded_files(new_campaign)
+        except ValueError as e:
+            db.session.rollback()
+            flash(f'Attachment rejected: {str(e)}', 'error')
+            return redirect(url_for('campaigns'))
         db.session.commit()
         
         flash(f'Campaign "{name}" created successfully!', 'success')
         return redirect(url_for('campaigns'))
 
-    campaigns_list = Campaign.query.order_by(Campaign.created_at.desc()).all()
+    campaigns_list = Campaign.query.options(selectinload(Campaign.attachments)).order_by(Campaign.created_at.desc()).all()
     templates_list = Template.query.all()
     file_templates = get_file_templates()
     groups = ContactGroup.query.all()
-    return render_template('campaigns.html', campaigns=campaigns_list, templates=templates_list, file_templates=file_templates, groups=groups)
+    segments = Segment.query.order_by(Segment.name).all()
+    return render_template('campaigns.html', campaigns=campaigns_list, templates=templates_list, file_templates=file_templates, groups=groups, segments=segments)
 
 @app.route('/campaigns/<int:campaign_id>/duplicate', methods=['POST'])
 @login_required
@@ -609,20 +787,19 @@ def duplicate_campaign(campaign_id):
         new_name = f"Copy of {original.name} ({counter})"
         counter += 1
         
-    # Recalculate count
-    if original.target_group_id:
-        group = db.session.get(ContactGroup, original.target_group_id)
-        contacts_count = len(group.contacts) if group else 0
-    else:
-        contacts_count = Contact.query.filter_by(status='active').count()
-    
     new_campaign = Campaign(
         name=new_name,
         template_id=original.template_id,
+        subject=original.subject,
         status='draft',
-        total_contacts=contacts_count,
-        target_group_id=original.target_group_id
+        target_group_id=original.target_group_id,
+        segment_id=original.segment_id,
+        priority=original.priority,
+        weight=original.weight,
+        attachments=list(original.attachments)
     )
+    # Recalculate count
+    new_campaign.total_contacts = count_recipients(new_campaign)
     db.session.add(new_campaign)
     db.session.commit()
     
@@ -631,91 +808,7 @@ def duplicate_campaign(campaign_id):
 
 def send_campaign_emails(campaign_id):
     with app.app_context():
-        campaign = db.session.get(Campaign, campaign_id)
-        if not campaign:
-            return
-        
-        server = Server.query.filter_by(is_primary=True).first()
-        if not server:
-            campaign.status = 'failed'
-            campaign.error_message = "No primary server configured. Please go to Settings and configure a server."
-            db.session.commit()
-            print("No primary server configured.")
-            return
-        
-        template = db.session.get(Template, campaign.template_id)
-        if not template:
-            campaign.status = 'failed'
-            campaign.error_message = "Campaign template not found. It may have been deleted."
-            db.session.commit()
-            return
-        
-        template_content = template.content
-        template_subject = template.subject
-        
-        # Filter contacts based on target group
-        if campaign.target_group_id:
-            # Join with groups to filter
-            contacts = Contact.query.join(Contact.groups).filter(ContactGroup.id == campaign.target_group_id, Contact.status == 'active').all()
-        else:
-            contacts = Contact.query.filter_by(status='active').all()
-            
-        total_contacts = len(contacts)
-        campaign.total_contacts = total_contacts
-        campaign.status = 'sending'
-        campaign.sent_count = 0
-        db.session.commit()
-        
-        smtp_config = {
-            'server': server.smtp_server,
-            'port': server.smtp_port,
-            'email': server.smtp_email,
-            'password': server.smtp_password
-        }
-        
-        sent_count = 0
-        failed_count = 0
-        last_error = None
-        
-        try:
-            for contact in contacts:
-                personalized_content = template_content.replace('{{name}}', contact.name or 'Valued Customer')
-                
-                success, error = send_email(smtp_config, contact.email, template_subject, personalized_content)
-                
-                log = EmailLog(
-                    campaign_id=campaign.id,
-                    recipient_email=contact.email,
-                    status='sent' if success else 'failed',
-                    error_message=None if success else error
-                )
-                db.session.add(log)
-                
-                if success:
-                    sent_count += 1
-                else:
-                    failed_count += 1
-                    last_error = error
-                
-                # Commit progress after every email for real-time updates
-                campaign.sent_count = sent_count
-                db.session.commit()
-            
-            campaign.sent_count = sent_count
-            
-            if sent_count == 0 and total_contacts > 0:
-                campaign.status = 'failed'
-                campaign.error_message = f"All emails failed. Last error: {last_error}"
-            else:
-                campaign.status = 'completed' if sent_count > 0 or total_contacts == 0 else 'failed'
-                
-            db.session.commit()
-            
-        except Exception as e:
-            campaign.status = 'failed'
-            campaign.error_message = str(e)
-            db.session.commit()
-            print(f"Error sending campaign {campaign_id}: {str(e)}")
+        run_campaign(campaign_id)
 
 @app.route('/campaigns/<int:campaign_id>/start', methods=['POST'])
 @login_required
@@ -731,16 +824,19 @@ def start_campaign(campaign_id):
         flash('Please configure a primary server in Settings before starting a campaign.', 'error')
         return redirect(url_for('settings'))
     
-    if campaign.status == 'failed':
-        campaign.sent_count = 0
-    
+    # Queue the audience; a failed campaign keeps the recipients it already reached
+    enqueue_campaign(campaign)
     # Set status to sending immediately so UI updates on redirect
     campaign.status = 'sending'
+    campaign.error_message = None
+    if app.config['SENDER_MODE'] == 'thread':
+        # Sent by a thread of this process, which renews its lease; if the process dies,
+        # another one resumes the campaign (see recovery.py)
+        campaign_recovery.lease(campaign)
     db.session.commit()
     
-    thread = threading.Thread(target=send_campaign_emails, args=(campaign_id,))
-    thread.daemon = True
-    thread.start()
+    if app.config['SENDER_MODE'] == 'thread':
+        campaign_recovery.start(campaign_id)
     
     flash(f'Campaign "{campaign.name}" started.', 'success')
     return redirect(url_for('campaigns'))
@@ -748,6 +844,9 @@ def start_campaign(campaign_id):
 @app.route('/campaigns/<int:campaign_id>/progress', methods=['GET'])
 @login_required
 def get_campaign_progress(campaign_id):
+    live = progress_registry.get(campaign_id)
+    if live:
+        return jsonify(live)
     campaign = Campaign.query.get_or_404(campaign_id)
     total = campaign.total_contacts if campaign.total_contacts > 0 else 1
     sent = campaign.sent_count
@@ -759,6 +858,99 @@ def get_campaign_progress(campaign_id):
         'progress': progress_percent
     })
 
+PROGRESS_STREAM_MIN_INTERVAL = 0.5 # Seconds between two events on one stream
+PROGRESS_STREAM_DB_INTERVAL = 5 # Seconds between database reads for campaigns sent by another process
+PROGRESS_STREAM_KEEPALIVE = 15
+PROGRESS_STREAM_MAX_AGE = 600 # The browser reconnects on its own after this
+
+def campaign_progress_from_db(campaign_ids):
+    rows = db.session.query(Campaign.id, Campaign.status, Campaign.sent_count, Campaign.total_contacts, Campaign.error_message).filter(Campaign.id.in_(campaign_ids)).all()
+    db.session.remove() # Don't hold a read transaction open between events
+    progress = {}
+    for campaign_id, status, sent, total, error_message in rows:
+        total = total if total and total > 0 else 1
+        progress[campaign_id] = {
+            'id': campaign_id, 'status': status, 'sent': sent or 0, 'total': total,
+            'progress': round((sent or 0) / total * 100, 1), 'rate': None, 'eta': None,
+            'error_message': error_message,
+        }
+    return progress
+
+@app.route('/campaigns/progress/stream')
+@login_required
+def campaign_progress_stream():
+    """
+    Server-Sent Events stream with the progress of all active campaigns, pushed from the
+    in-memory registry as the sender updates it (at most every PROGRESS_STREAM_MIN_INTERVAL).
+    ids: campaigns shown on the page; any this process isn't sending (e.g. sent by another
+    worker) are read from the database every PROGRESS_STREAM_DB_INTERVAL seconds instead.
+    """
+    campaign_ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip().isdigit()]
+
+    def generate():
+        opened = time.monotonic()
+        last_payload = None
+        last_event = 0
+        last_db_read = 0
+        from_db = {}
+        version = None
+        yield "retry: 3000\n\n"
+        while time.monotonic() - opened < PROGRESS_STREAM_MAX_AGE:
+            version, live = progress_registry.snapshot()
+            live_ids = {p['id'] for p in live}
+            missing = [i for i in campaign_ids if i not in live_ids]
+            now = time.monotonic()
+            if missing and now - last_db_read >= PROGRESS_STREAM_DB_INTERVAL:
+                with app.app_context():
+                    from_db = campaign_progress_from_db(missing)
+                last_db_read = now
+            campaigns = live + [from_db[i] for i in missing if i in from_db]
+            payload = json.dumps({'campaigns': campaigns})
+            if payload != last_payload:
+                yield f"data: {payload}\n\n"
+                last_payload, last_event = payload, now
+            elif now - last_event >= PROGRESS_STREAM_KEEPALIVE:
+                yield ": keepalive\n\n"
+                last_event = now
+            # Wake on the next change (or in time for the next DB read / keepalive), then throttle
+            timeout = PROGRESS_STREAM_DB_INTERVAL if missing else PROGRESS_STREAM_KEEPALIVE
+            progress_registry.wait(version, timeout)
+            time.sleep(PROGRESS_STREAM_MIN_INTERVAL)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no', # Don't let a reverse proxy buffer the stream
+    })
+
+def read_server_limits_form():
+    """
+    Reads (max_connections, max_per_minute) from the server forms.
+    A blank or zero per-minute pace means unlimited.
+    """
+    try:
+        max_connections = max(int(request.form.get('max_connections') or 1), 1)
+        max_per_minute = int(request.form.get('max_per_minute') or 0) or None
+    except ValueError:
+        return 1, None
+    return max_connections, max_per_minute
+
+def read_dkim_form():
+    """
+    Reads and validates the DKIM fields of the server forms.
+    Returns (selector, private_key, error_message); an empty selector disables signing.
+    """
+    selector = (request.form.get('dkim_selector') or '').strip() or None
+    private_key = (request.form.get('dkim_private_key') or '').strip() or None
+    if not selector:
+        return None, None, None
+    if not private_key:
+        return selector, None, None
+    try:
+        parse_private_key(private_key)
+    except DkimKeyError as e:
+        return None, None, f'DKIM key rejected: {str(e)}'
+    return selector, private_key, None
+
 @app.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
@@ -770,6 +962,11 @@ def settings():
         smtp_email = request.form.get('smtp_email')
         smtp_password = request.form.get('smtp_password')
         imap_server = request.form.get('imap_server')
+        max_connections, max_per_minute = read_server_limits_form()
+        dkim_selector, dkim_private_key, dkim_error = read_dkim_form()
+        if dkim_error:
+            flash(dkim_error, 'error')
+            return redirect(url_for('settings'))
         
         # If this is the first server, make it primary
         is_primary = Server.query.count() == 0
@@ -781,15 +978,22 @@ def settings():
             smtp_email=smtp_email,
             smtp_password=smtp_password,
             imap_server=imap_server,
-            is_primary=is_primary
+            is_primary=is_primary,
+            dkim_selector=dkim_selector,
+            dkim_private_key=dkim_private_key,
+            max_connections=max_connections,
+            max_per_minute=max_per_minute
         )
         db.session.add(new_server)
         db.session.commit()
+        health_monitor.check_soon()
         flash('Server added successfully.', 'success')
         return redirect(url_for('settings'))
         
     servers = Server.query.all()
-    return render_template('settings.html', servers=servers)
+    health_monitor.ensure_started()
+    health = {server_id: server_status(h) for server_id, h in health_monitor.snapshot().items()}
+    return render_template('settings.html', servers=servers, health=health)
 
 @app.route('/settings/upload_db', methods=['POST'])
 @login_required
@@ -802,30 +1006,37 @@ def upload_db():
         flash('No selected file', 'error')
         return redirect(url_for('settings'))
     
-    if file and (file.filename.endswith('.db') or file.filename.endswith('.sqlite')):
+    if db.engine.dialect.name != 'sqlite':
+        flash('Database restore is only available with SQLite.', 'error')
+    elif Campaign.query.filter_by(status='sending').count():
+        flash('Wait for sending campaigns to finish before restoring the database.', 'error')
+    elif file and (file.filename.endswith('.db') or file.filename.endswith('.sqlite')):
+        db_path = db.engine.url.database
+        upload_path = db_path + '.upload'
         try:
-            # Close DB session to release locks
+            # Pending background writes belong to the old database
+            background_writer.flush()
+            tracker.flush()
             db.session.remove()
-            
-            # Determine path
-            # Assuming standard Flask instance path or relative to app
-            instance_path = os.path.join(basedir, 'instance')
-            if not os.path.exists(instance_path):
-                os.makedirs(instance_path)
-                
-            db_path = os.path.join(instance_path, 'email_marketing.db')
-            backup_path = db_path + '.bak'
-            
+
             # Backup existing
-            if os.path.exists(db_path):
-                shutil.copy2(db_path, backup_path)
-            
-            # Save new file
-            file.save(db_path)
+            backup_sqlite(db.engine, db_path + '.bak')
+
+            # Copied in through SQLite rather than by replacing the files: threads holding
+            # connections (writer, scheduler, health checks) keep working on the new data
+            file.save(upload_path)
+            restore_sqlite(db.engine, upload_path)
+            db.engine.dispose()
+            suppression_list.reset()
+            # Bring an older backup up to the current schema
+            init_database(app)
             
             flash('Database restored successfully. The application state has been updated.', 'success')
         except Exception as e:
             flash(f'Error restoring database: {str(e)}', 'error')
+        finally:
+            if os.path.exists(upload_path):
+                os.remove(upload_path)
     else:
         flash('Invalid file type. Please upload a .db or .sqlite file.', 'error')
         
@@ -864,9 +1075,18 @@ def delete_contact(contact_id):
 @login_required
 def edit_contact(contact_id):
     contact = Contact.query.get_or_404(contact_id)
+    email = normalize_email(request.form.get('email'))
+    if not email:
+        flash('Invalid email address.', 'error')
+        return redirect(url_for('contacts'))
+    other = Contact.query.filter_by(email=email).first()
+    if other and other.id != contact.id:
+        flash(f'Another contact already uses {email}.', 'error')
+        return redirect(url_for('contacts'))
     contact.name = request.form.get('name')
-    contact.email = request.form.get('email')
+    contact.email = email
     contact.company = request.form.get('company')
+    set_contact_tags(contact, request.form.get('tags'))
     db.session.commit()
     flash('Contact updated successfully.', 'success')
     return redirect(url_for('contacts'))
@@ -902,8 +1122,12 @@ def delete_campaign(campaign_id):
     # Delete associated logs and replies first if needed, or rely on cascade if configured (not configured here)
     # Manually delete logs and replies to be safe
     EmailLog.query.filter_by(campaign_id=campaign_id).delete()
+    EmailLogDaily.query.filter_by(campaign_id=campaign_id).delete()
+    TrackingEvent.query.filter_by(campaign_id=campaign_id).delete()
     Reply.query.filter_by(campaign_id=campaign_id).delete()
+    delete_queue(campaign_id)
     db.session.delete(campaign)
+    prune_attachments(commit=False)
     db.session.commit()
     flash('Campaign deleted successfully.', 'success')
     return redirect(url_for('campaigns'))
@@ -918,22 +1142,32 @@ def edit_campaign(campaign_id):
     
     campaign.name = request.form.get('name')
     
-    # Update Target Group
-    target_group_id = request.form.get('target_group_id')
-    campaign.target_group_id = int(target_group_id) if target_group_id else None
-    
+    # Update Target Group / Segment
+    campaign.target_group_id, campaign.segment_id = parse_campaign_target(request.form.get('target_group_id'))
+
     # Update Template
     template_id = request.form.get('template_id')
-    if template_id:
+    if template_id and int(template_id) != campaign.template_id:
         campaign.template_id = int(template_id)
-        
+        campaign.subject = None # Subject override belonged to the previous template
+
+    # Update Scheduling
+    campaign.priority, campaign.weight = read_scheduling_form()
+
+    # Update Attachments
+    if request.form.get('clear_attachments'):
+        campaign.attachments = []
+    try:
+        attach_uploaded_files(campaign)
+    except ValueError as e:
+        db.session.rollback()
+        flash(f'Attachment rejected: {str(e)}', 'error')
+        return redirect(url_for('campaigns'))
+    prune_attachments(commit=False)
+
     # Recalculate total contacts
-    if campaign.target_group_id:
-        group = db.session.get(ContactGroup, campaign.target_group_id)
-        campaign.total_contacts = len(group.contacts) if group else 0
-    else:
-        campaign.total_contacts = Contact.query.filter_by(status='active').count()
-        
+    campaign.total_contacts = count_recipients(campaign)
+
     db.session.commit()
     flash('Campaign updated successfully.', 'success')
     return redirect(url_for('campaigns'))
@@ -951,6 +1185,7 @@ def delete_server(server_id):
         else:
             db.session.delete(server)
             db.session.commit()
+            health_monitor.forget(server_id)
             flash('Server deleted successfully.', 'success')
     return redirect(url_for('settings'))
 
@@ -965,86 +1200,94 @@ def edit_server(server_id):
     if request.form.get('smtp_password'):
         server.smtp_password = request.form.get('smtp_password')
     server.imap_server = request.form.get('imap_server')
+    server.max_connections, server.max_per_minute = read_server_limits_form()
+    dkim_selector, dkim_private_key, dkim_error = read_dkim_form()
+    if dkim_error:
+        flash(dkim_error, 'error')
+        return redirect(url_for('settings'))
+    server.dkim_selector = dkim_selector
+    # A blank key field keeps the stored key, like the password field
+    if not dkim_selector:
+        server.dkim_private_key = None
+    elif dkim_private_key:
+        server.dkim_private_key = dkim_private_key
     
     db.session.commit()
+    # Running campaigns pick up the new limits immediately; the new settings get probed afresh
+    health_monitor.forget(server.id)
+    send_scheduler.configure_server(server.id, *health_monitor.limits(server))
     flash('Server updated successfully.', 'success')
     return redirect(url_for('settings'))
 
 @app.route('/settings/download_db')
 @login_required
 def download_db():
+    if db.engine.dialect.name != 'sqlite':
+        flash('Database download is only available with SQLite.', 'error')
+        return redirect(url_for('settings'))
     try:
-        instance_path = os.path.join(basedir, 'instance')
-        db_path = os.path.join(instance_path, 'email_marketing.db')
-        
-        if not os.path.exists(db_path):
-            # Fallback to root if not in instance
-            db_path = os.path.join(basedir, 'email_marketing.db')
-            
-        if os.path.exists(db_path):
-            return send_file(db_path, as_attachment=True, download_name='email_marketing_backup.db')
-        else:
-            flash('Database file not found.', 'error')
-            return redirect(url_for('settings'))
+        # A consistent snapshot, including transactions still in the WAL file
+        fd, snapshot = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        backup_sqlite(db.engine, snapshot)
+        response = send_file(snapshot, as_attachment=True, download_name='email_marketing_backup.db')
+        response.call_on_close(lambda: os.remove(snapshot))
+        return response
     except Exception as e:
         flash(f'Error downloading database: {str(e)}', 'error')
         return redirect(url_for('settings'))
 
+def server_status(health):
+    """
+    Health monitor entry in the shape the settings page expects.
+    """
+    message = health['error'] or ''
+    # If SMTP works, we consider it a success for sending purposes.
+    # IMAP failure is a warning.
+    if health['smtp_status'] and health['imap_status'] is False:
+        message += " (Warning: SMTP connected but IMAP failed. You can send emails but replies won't be tracked.)"
+    return dict(health, success=bool(health['smtp_status']), message=message.strip())
+
 @app.route('/settings/server/<int:server_id>/check_status')
 @login_required
 def check_server_status(server_id):
+    """
+    Returns the cached result of the background health monitor. Servers not probed yet,
+    or ?refresh=1, are probed now (SMTP and IMAP in parallel).
+    """
     server = Server.query.get_or_404(server_id)
-    
-    smtp_status = False
-    imap_status = False
-    error_message = ""
-    
-    # Check SMTP
-    try:
-        import smtplib
-        if server.smtp_port == 465:
-            smtp = smtplib.SMTP_SSL(server.smtp_server, server.smtp_port, timeout=15)
-        else:
-            smtp = smtplib.SMTP(server.smtp_server, server.smtp_port, timeout=15)
-            smtp.starttls()
-            
-        smtp.login(server.smtp_email, server.smtp_password)
-        smtp.quit()
-        smtp_status = True
-    except Exception as e:
-        error_message += f"SMTP Error: {str(e)}. "
-
-    # Check IMAP
-    try:
-        import imaplib
-        # Some servers don't support IMAP, so if the server is clearly not an IMAP server (like smtp-relay), this will fail.
-        # We'll try to connect.
-        if server.imap_server and server.imap_server.strip():
-            imap = imaplib.IMAP4_SSL(server.imap_server, timeout=15)
-            imap.login(server.smtp_email, server.smtp_password)
-            imap.logout()
-            imap_status = True
-        else:
-            # If no IMAP server provided (or empty), consider it skipped/OK or just False but not an error
-            pass
-    except Exception as e:
-        error_message += f"IMAP Error: {str(e)}."
-        
-    # Determine overall status
-    # If SMTP works, we consider it a success for sending purposes.
-    # IMAP failure is a warning.
-    
-    success = smtp_status
-    if smtp_status and not imap_status:
-        error_message += " (Warning: SMTP connected but IMAP failed. You can send emails but replies won't be tracked.)"
-    
-    return jsonify({
-        'success': success, 
-        'smtp_status': smtp_status,
-        'imap_status': imap_status,
-        'message': error_message.strip()
-    })
+    health_monitor.ensure_started()
+    health = health_monitor.get(server.id)
+    if health is None or health['checked_at'] is None or request.args.get('refresh'):
+        health_monitor.probe([server])
+        health = health_monitor.get(server.id)
+    return jsonify(server_status(health))
+
+@app.route('/metrics')
+def metrics():
+    """
+    Prometheus scrape endpoint for this process (see metrics.py).
+    """
+    if not authorized(request.headers.get('Authorization'), request.remote_addr, request.headers):
+        return Response('Forbidden\n', status=403, mimetype='text/plain')
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
+# Open and click tracking (see tracking.py). Public, and answered without a database query:
+# hits are buffered and written in bulk.
+@app.route('/t/o/<token>.gif')
+def track_open(token):
+    tracker.hit('open', token, user_agent=request.headers.get('User-Agent'))
+    return Response(PIXEL, mimetype='image/gif', headers={'Cache-Control': 'no-store, max-age=0'})
+
+@app.route('/t/c/<token>')
+def track_click(token):
+    url = request.args.get('u', '')
+    # The signature covers the target, so this can't be used as an open redirect
+    if not url.startswith(('http://', 'https://')) or not tracker.hit('click', token, url, request.headers.get('User-Agent')):
+        return Response('Not found\n', status=404, mimetype='text/plain')
+    return redirect(url)
 
 
 if __name__ == '__main__':
+    init_database(app)
     app.run(debug=False)
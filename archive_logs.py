@@ -0,0 +1,50 @@
+import argparse
+import json
+import sys
+from collections import Counter
+from datetime import datetime
+
+# EmailLog retention job (see retention.py). Run it daily, e.g. from cron:
+#   python archive_logs.py run --days 90
+# and read the archive back without the database:
+#   python archive_logs.py query --campaign 3 --status failed --since 2024-01-01
+#   python archive_logs.py query --since 2024-01-01 --until 2024-02-01 --count
+parser = argparse.ArgumentParser(description="Archive old email logs, or query the archive.")
+parser.add_argument('--archive-dir', help="archive directory (default ARCHIVE_DIR or ./archive)")
+commands = parser.add_subparsers(dest='command')
+run = commands.add_parser('run', help="archive and delete old logs (the default)")
+run.add_argument('--days', type=int, help="keep this many days of logs (default EMAIL_LOG_RETENTION_DAYS)")
+run.add_argument('--chunk-size', type=int, help="rows per transaction (default RETENTION_CHUNK_SIZE or 5000)")
+run.add_argument('--pause', type=float, default=0.1, help="seconds to wait between chunks")
+query = commands.add_parser('query', help="print archived logs as JSON lines")
+query.add_argument('--since', type=datetime.fromisoformat, help="sent at or after, e.g. 2024-01-01")
+query.add_argument('--until', type=datetime.fromisoformat, help="sent before")
+query.add_argument('--campaign', type=int, help="campaign id")
+query.add_argument('--email', help="recipient email")
+query.add_argument('--status', help="sent, failed, suppressed, capped, ...")
+query.add_argument('--type', help="campaign, followup or resend")
+query.add_argument('--count', action='store_true', help="print counts by day and status instead of rows")
+args = parser.parse_args()
+
+if args.command == 'query':
+    from retention import read_archive
+    filters = {field: value for field, value in (('campaign_id', args.campaign), ('recipient_email', args.email),
+               ('status', args.status), ('type', args.type)) if value is not None}
+    records = read_archive(args.archive_dir, since=args.since, until=args.until, **filters)
+    if args.count:
+        counts = Counter(((record['sent_at'] or '')[:10] or 'undated', record['status']) for record in records)
+        for (day, status), count in sorted(counts.items()):
+            print(f"{day}\t{status}\t{count}")
+    else:
+        for record in records:
+            sys.stdout.write(json.dumps(record) + '\n')
+else:
+    from app import app
+    from retention import archive_email_logs, RETENTION_DAYS
+    days = getattr(args, 'days', None) or RETENTION_DAYS
+    if days < 1:
+        sys.exit("Set EMAIL_LOG_RETENTION_DAYS or pass --days.")
+    with app.app_context():
+        archived = archive_email_logs(days, args.archive_dir, getattr(args, 'chunk_size', None),
+                                      pause=getattr(args, 'pause', 0.1))
+        print(f"Archived {archived} email logs older than {days} days.")
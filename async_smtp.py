@@ -0,0 +1,229 @@
+import asyncio
+import base64
+import os
+import smtplib
+import socket
+import ssl
+import threading
+from concurrent.futures import Future
+from email_utils import build_message, describe_refusal, _quote_periods
+from metrics import smtp_seconds
+
+# asyncio SMTP delivery. Every session is a coroutine on one event loop running in a
+# background thread, so a single process can hold hundreds of SMTP connections open at
+# once without a thread per connection. Messages are still built and DKIM signed by the
+# calling thread (build_message), keeping CPU work off the loop.
+# SMTP_BACKEND=asyncio makes the campaign sender use it (and only then import this
+# module); other sends keep smtplib.
+
+SMTP_TIMEOUT = int(os.environ.get('SMTP_TIMEOUT', 60)) # Seconds per connect, reply or write
+MAX_SESSIONS = int(os.environ.get('SMTP_ASYNC_MAX_SESSIONS', 500)) # Open connections per process
+
+def tls_context():
+    return ssl.create_default_context()
+
+class SMTPSession:
+    """
+    One SMTP connection: the client side of the commands send_email uses.
+    Errors are raised as the smtplib exceptions, so callers report them the same way.
+    """
+
+    def __init__(self, reader, writer, host, timeout=SMTP_TIMEOUT):
+        self.reader = reader
+        self.writer = writer
+        self.host = host
+        self.timeout = timeout
+        self.extensions = {}
+
+    @classmethod
+    async def connect(cls, host, port, local_hostname, timeout=SMTP_TIMEOUT):
+        if port == 465:
+            connecting = asyncio.open_connection(host, port, ssl=tls_context(), server_hostname=host)
+        else:
+            connecting = asyncio.open_connection(host, port)
+        reader, writer = await asyncio.wait_for(connecting, timeout)
+        session = cls(reader, writer, host, timeout)
+        try:
+            code, message = await session.reply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, message)
+            await session.ehlo(local_hostname)
+            if port != 465:
+                await session.starttls(local_hostname)
+        except BaseException:
+            session.close()
+            raise
+        return session
+
+    async def reply(self):
+        """
+        Reads a (possibly multiline) reply. Returns (code, message bytes).
+        """
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            lines.append(line[4:].strip())
+            try:
+                code = int(line[:3])
+            except ValueError:
+                raise smtplib.SMTPResponseException(-1, b"\n".join(lines))
+            if line[3:4] != b'-':
+                return code, b"\n".join(lines)
+
+    async def write(self, data):
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+    async def command(self, line):
+        await self.write(line.encode('ascii') + b'\r\n')
+        return await self.reply()
+
+    async def ehlo(self, local_hostname):
+        code, message = await self.command(f"EHLO {local_hostname}")
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, message)
+        self.extensions = {}
+        for line in message.decode('latin-1').split('\n')[1:]:
+            keyword, _, params = line.partition(' ')
+            self.extensions[keyword.lower()] = params.strip()
+
+    async def starttls(self, local_hostname):
+        if 'starttls' not in self.extensions:
+            raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+        code, message = await self.command("STARTTLS")
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, message)
+        await asyncio.wait_for(self.writer.start_tls(tls_context(), server_hostname=self.host), self.timeout)
+        # The server forgets everything learned before TLS
+        await self.ehlo(local_hostname)
+
+    async def login(self, user, password):
+        if 'auth' not in self.extensions:
+            raise smtplib.SMTPNotSupportedError("SMTP AUTH extension not supported by server.")
+        mechanisms = self.extensions['auth'].upper().split()
+        if 'PLAIN' in mechanisms:
+            token = base64.b64encode(f"\0{user}\0{password}".encode('utf-8')).decode('ascii')
+            code, message = await self.command(f"AUTH PLAIN {token}")
+        elif 'LOGIN' in mechanisms:
+            code, message = await self.command("AUTH LOGIN")
+            if code == 334:
+                code, message = await self.command(base64.b64encode(user.encode('utf-8')).decode('ascii'))
+            if code == 334:
+                code, message = await self.command(base64.b64encode(password.encode('utf-8')).decode('ascii'))
+        else:
+            raise smtplib.SMTPException("No suitable authentication method found.")
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, message)
+
+    async def send_chunks(self, from_addr, to_addr, chunks):
+        """
+        Async twin of email_utils.send_chunks.
+        """
+        code, message = await self.command(f"MAIL FROM:<{from_addr}>")
+        if code != 250:
+            await self.command("RSET")
+            raise smtplib.SMTPSenderRefused(code, message, from_addr)
+        code, message = await self.command(f"RCPT TO:<{to_addr}>")
+        if code not in (250, 251):
+            await self.command("RSET")
+            raise smtplib.SMTPRecipientsRefused({to_addr: (code, message)})
+        code, message = await self.command("DATA")
+        if code != 354:
+            await self.command("RSET")
+            raise smtplib.SMTPDataError(code, message)
+        for chunk in chunks:
+            await self.write(_quote_periods(chunk))
+        await self.write(b'.\r\n')
+        code, message = await self.reply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, message)
+
+    async def quit(self):
+        try:
+            await self.command("QUIT")
+        finally:
+            self.close()
+
+    def close(self):
+        self.writer.close()
+
+async def deliver(smtp_settings, to_email, headers, body, local_hostname='localhost', timeout=SMTP_TIMEOUT):
+    """
+    Sends a message built by build_message over a new connection.
+    Returns (success, message) like send_email.
+    """
+    session = None
+    try:
+        with smtp_seconds.time(phase='connect', backend='asyncio'):
+            session = await SMTPSession.connect(smtp_settings['server'], int(smtp_settings['port']), local_hostname, timeout)
+        with smtp_seconds.time(phase='login', backend='asyncio'):
+            await session.login(smtp_settings['email'], smtp_settings['password'])
+        with smtp_seconds.time(phase='data', backend='asyncio'):
+            await session.send_chunks(smtp_settings['email'], to_email, [headers + b'\r\n'] + body)
+        try:
+            await session.quit()
+        except Exception:
+            pass # The server accepted the message at the end of DATA; a failed QUIT doesn't unsend it
+        session = None # quit() closed it
+        return True, "Sent successfully"
+    except smtplib.SMTPRecipientsRefused as e:
+        return False, describe_refusal(e)
+    except asyncio.TimeoutError:
+        return False, f"Timed out after {timeout}s talking to {smtp_settings['server']}"
+    except Exception as e:
+        return False, str(e)
+    finally:
+        if session is not None:
+            session.close()
+
+class AsyncSMTPBackend:
+    """
+    Runs SMTP sessions on a private event loop thread, at most max_sessions at a time.
+    submit() takes the send_email arguments and returns a concurrent.futures.Future of
+    (success, message), so a sender thread can keep many deliveries in flight.
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, timeout=SMTP_TIMEOUT):
+        self.max_sessions = max_sessions
+        self.timeout = timeout
+        self._loop = None
+        self._sessions = None
+        self._lock = threading.Lock()
+        self._local_hostname = None
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._local_hostname = socket.getfqdn()
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='async-smtp', daemon=True).start()
+            return self._loop
+
+    async def _deliver(self, smtp_settings, to_email, headers, body):
+        if self._sessions is None:
+            self._sessions = asyncio.Semaphore(self.max_sessions)
+        async with self._sessions:
+            return await deliver(smtp_settings, to_email, headers, body, self._local_hostname, self.timeout)
+
+    def submit(self, smtp_settings, to_email, subject, html_content, text_content=None,
+               html_encoding=None, text_encoding=None, attachments=None):
+        loop = self._ensure_loop()
+        try:
+            headers, body = build_message(smtp_settings, to_email, subject, html_content, text_content,
+                                          html_encoding, text_encoding, attachments)
+        except Exception as e:
+            future = Future()
+            future.set_result((False, str(e)))
+            return future
+        return asyncio.run_coroutine_threadsafe(self._deliver(smtp_settings, to_email, headers, body), loop)
+
+    def send_email(self, *args, **kwargs):
+        """
+        Drop-in for email_utils.send_email: blocks until this one message is delivered.
+        """
+        return self.submit(*args, **kwargs).result()
+
+# Shared per-process backend; its loop thread starts on the first send
+async_smtp = AsyncSMTPBackend()
@@ -0,0 +1,100 @@
+import hashlib
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from email import encoders
+from email.mime.base import MIMEBase
+from email.policy import SMTP
+from database import db, Attachment
+
+MAX_ATTACHMENT_BYTES = int(os.environ.get('MAX_ATTACHMENT_MB', 10)) * 1024 * 1024
+
+def store_attachment(filename, data, content_type=None):
+    """
+    Returns the Attachment row for (filename, data), adding it only if the same
+    file isn't stored yet. Raises ValueError for empty or oversized files.
+    """
+    if not data:
+        raise ValueError(f"{filename} is empty")
+    if len(data) > MAX_ATTACHMENT_BYTES:
+        raise ValueError(f"{filename} is larger than {MAX_ATTACHMENT_BYTES // (1024 * 1024)} MB")
+    filename = os.path.basename(filename)[:255]
+    digest = hashlib.sha256(data).hexdigest()
+    existing = Attachment.query.filter_by(content_hash=digest, filename=filename).first()
+    if existing:
+        return existing
+    content_type = content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    attachment = Attachment(filename=filename, content_type=content_type, size=len(data), content_hash=digest, data=data)
+    db.session.add(attachment)
+    return attachment
+
+def prune_attachments(commit=True):
+    """
+    Deletes attachments no campaign refers to any more. Returns the number removed.
+    """
+    orphans = Attachment.query.filter(~Attachment.campaigns.any()).all()
+    for attachment in orphans:
+        db.session.delete(attachment)
+    if orphans and commit:
+        db.session.commit()
+    return len(orphans)
+
+def encode_part(filename, content_type, data):
+    """
+    Renders a complete base64 attachment part (headers and body) as wire-ready bytes:
+    CRLF line endings, no line starting with '.', so it can go straight into SMTP DATA.
+    """
+    maintype, _, subtype = content_type.partition('/')
+    part = MIMEBase(maintype or 'application', subtype or 'octet-stream')
+    part.set_payload(data)
+    encoders.encode_base64(part)
+    del part['MIME-Version']
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+    return part.as_bytes(policy=SMTP)
+
+class EncodedAttachmentCache:
+    """
+    Process wide cache of encoded attachment parts keyed by content hash and name.
+    Each part is encoded once into an immutable bytes buffer that every sender thread
+    writes to the socket as is, so a campaign attachment costs one encode and one
+    copy in memory no matter how many recipients or concurrent sends use it.
+    The cache is bounded by the total size of the encoded parts (LRU).
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._parts = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, attachment):
+        key = (attachment.content_hash, attachment.filename, attachment.content_type)
+        with self._lock:
+            part = self._parts.get(key)
+            if part is not None:
+                self._parts.move_to_end(key)
+                return part
+        # Loads the deferred blob; only happens on a cache miss
+        part = encode_part(attachment.filename, attachment.content_type, attachment.data)
+        with self._lock:
+            if key not in self._parts:
+                self._parts[key] = part
+                self._size += len(part)
+            self._parts.move_to_end(key)
+            # Never evict the part just added, even if it alone exceeds the budget
+            while self._size > self.max_bytes and len(self._parts) > 1:
+                _, evicted = self._parts.popitem(last=False)
+                self._size -= len(evicted)
+            return self._parts[key]
+
+    def parts(self, attachments):
+        return [self.get(a) for a in attachments]
+
+    def clear(self):
+        with self._lock:
+            self._parts.clear()
+            self._size = 0
+
+# Shared per-process cache
+encoded_attachments = EncodedAttachmentCache()
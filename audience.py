@@ -0,0 +1,272 @@
+import json
+from datetime import datetime
+from sqlalchemy import and_, or_, not_, exists, select, func, false
+from database import db, Contact, Tag, Segment, EmailLog, Reply, contact_group_association, contact_tag_association
+from email_utils import normalize_email
+
+MAX_TAG_LENGTH = 50
+
+def parse_tags(raw):
+    """
+    Splits a comma separated tag string into clean, lowercase, de-duplicated names.
+    Order of first appearance is kept so the display copy stays stable.
+    """
+    if not raw:
+        return []
+    names = []
+    for part in str(raw).split(','):
+        name = part.strip().lower()[:MAX_TAG_LENGTH]
+        if name and name not in names:
+            names.append(name)
+    return names
+
+def get_or_create_tags(names, cache=None):
+    """
+    Returns Tag rows for the given names, creating the missing ones.
+    cache: optional dict name -> Tag reused across calls (e.g. during a file import)
+    """
+    cache = cache if cache is not None else {}
+    missing = [n for n in names if n not in cache]
+    if missing:
+        for tag in Tag.query.filter(Tag.name.in_(missing)).all():
+            cache[tag.name] = tag
+        for name in missing:
+            if name not in cache:
+                tag = Tag(name=name)
+                db.session.add(tag)
+                cache[name] = tag
+    return [cache[n] for n in names]
+
+def set_contact_tags(contact, raw, cache=None):
+    """
+    Replaces a contact's tags with the ones in the comma separated string `raw`,
+    keeping the normalized tag table and the Contact.tags display copy in sync.
+    """
+    names = parse_tags(raw)
+    contact.tag_list = get_or_create_tags(names, cache)
+    contact.tags = ','.join(names) if names else None
+
+def backfill_tags(commit=True):
+    """
+    Populates the normalized tag table from Contact.tags for rows that predate it.
+    Returns the number of contacts updated.
+    """
+    tagged_ids = select(contact_tag_association.c.contact_id)
+    pending = Contact.query.filter(Contact.tags.isnot(None), Contact.tags != '', ~Contact.id.in_(tagged_ids)).all()
+    cache = {}
+    for contact in pending:
+        set_contact_tags(contact, contact.tags, cache)
+    if pending and commit:
+        db.session.commit()
+    return len(pending)
+
+# --- Email normalization ---
+
+def contacts_by_email(emails, chunk_size=500):
+    """
+    Looks up existing contacts for a list of canonical addresses with one IN query per chunk.
+    Returns a dict email -> Contact.
+    """
+    found = {}
+    for i in range(0, len(emails), chunk_size):
+        for contact in Contact.query.filter(Contact.email.in_(emails[i:i + chunk_size])).all():
+            found[contact.email] = contact
+    return found
+
+# Most restrictive status wins when duplicates are merged
+STATUS_PRIORITY = {'bounced': 2, 'unsubscribed': 1, 'active': 0}
+
+def merge_duplicate_contacts(commit=True):
+    """
+    One-off job that rewrites every contact email to its canonical form and collapses
+    contacts whose canonical emails collide. The oldest contact survives and inherits
+    the others' groups, tags, replies, missing fields and most restrictive status;
+    email logs are rewritten to the canonical address.
+    Returns (merged, renamed): duplicates removed and emails rewritten.
+    """
+    by_key = {}
+    for contact_id, email in db.session.query(Contact.id, Contact.email).order_by(Contact.id).all():
+        key = normalize_email(email) or email.strip().lower()
+        by_key.setdefault(key, []).append((contact_id, email))
+
+    merged = 0
+    renamed = 0
+    for key, rows in by_key.items():
+        if len(rows) == 1 and rows[0][1] == key:
+            continue
+        contacts = Contact.query.filter(Contact.id.in_([r[0] for r in rows])).order_by(Contact.id).all()
+        survivor, duplicates = contacts[0], contacts[1:]
+
+        old_emails = [c.email for c in contacts if c.email != key]
+        for dup in duplicates:
+            for group in dup.groups:
+                if group not in survivor.groups:
+                    survivor.groups.append(group)
+            for tag in dup.tag_list:
+                if tag not in survivor.tag_list:
+                    survivor.tag_list.append(tag)
+            survivor.name = survivor.name if survivor.name and survivor.name != 'Unknown' else (dup.name or survivor.name)
+            survivor.company = survivor.company or dup.company
+            if STATUS_PRIORITY.get(dup.status, 0) > STATUS_PRIORITY.get(survivor.status, 0):
+                survivor.status = dup.status
+            Reply.query.filter_by(contact_id=dup.id).update({Reply.contact_id: survivor.id}, synchronize_session=False)
+            db.session.delete(dup)
+            merged += 1
+        if survivor.tag_list:
+            survivor.tags = ','.join(t.name for t in survivor.tag_list)
+        # Delete the duplicates before taking their address, or the unique constraint trips
+        db.session.flush()
+
+        if old_emails:
+            EmailLog.query.filter(EmailLog.recipient_email.in_(old_emails)).update(
+                {EmailLog.recipient_email: key}, synchronize_session=False)
+        if survivor.email != key:
+            survivor.email = key
+            renamed += 1
+        if commit:
+            db.session.commit()
+        else:
+            db.session.flush()
+    return merged, renamed
+
+# --- Segments ---
+# A segment definition is a JSON rule tree:
+#   {"all": [rule, ...]}             every rule must match
+#   {"any": [rule, ...]}             at least one rule must match
+#   {"not": rule}                    rule must not match
+#   {"field": "group", "value": 3}   member of group id (or list of ids)
+#   {"field": "tag", "value": "vip"} has tag (or any of a list of tags)
+#   {"field": "status", "value": "active"}
+#   {"field": "company", "op": "equals" | "contains", "value": "acme"}
+#   {"field": "created_at", "op": "before" | "after", "value": "2025-01-31"}
+
+def _as_list(value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(str(value)[:10], '%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f"Invalid date '{value}', expected YYYY-MM-DD")
+
+def compile_rule(rule):
+    """
+    Compiles a segment rule tree into a SQL boolean expression over Contact.
+    Group and tag rules become correlated EXISTS lookups against the indexed
+    association tables so the whole segment runs as a single query.
+    Raises ValueError for malformed definitions.
+    """
+    if not isinstance(rule, dict):
+        raise ValueError("Segment rule must be an object")
+
+    if 'all' in rule or 'any' in rule:
+        key = 'all' if 'all' in rule else 'any'
+        children = rule[key]
+        if not isinstance(children, list) or not children:
+            raise ValueError(f"'{key}' must be a non-empty list of rules")
+        clauses = [compile_rule(child) for child in children]
+        return and_(*clauses) if key == 'all' else or_(*clauses)
+
+    if 'not' in rule:
+        return not_(compile_rule(rule['not']))
+
+    field = rule.get('field')
+    value = rule.get('value')
+    op = rule.get('op')
+    if value is None or value == '' or value == []:
+        raise ValueError(f"Rule for '{field}' needs a value")
+
+    if field == 'group':
+        try:
+            group_ids = [int(v) for v in _as_list(value)]
+        except (TypeError, ValueError):
+            raise ValueError("Group rule values must be group ids")
+        return exists().where(
+            contact_group_association.c.contact_id == Contact.id,
+            contact_group_association.c.group_id.in_(group_ids)
+        )
+
+    if field == 'tag':
+        names = [n for v in _as_list(value) for n in parse_tags(v)]
+        if not names:
+            raise ValueError("Tag rule needs at least one tag name")
+        return exists().where(
+            contact_tag_association.c.contact_id == Contact.id,
+            contact_tag_association.c.tag_id == Tag.id,
+            Tag.name.in_(names)
+        )
+
+    if field == 'status':
+        return Contact.status.in_([str(v) for v in _as_list(value)])
+
+    if field == 'company':
+        if op in (None, 'equals'):
+            return func.lower(Contact.company).in_([str(v).lower() for v in _as_list(value)])
+        if op == 'contains':
+            return or_(*[Contact.company.ilike(f"%{v}%") for v in _as_list(value)])
+        raise ValueError(f"Unknown company operator '{op}'")
+
+    if field == 'created_at':
+        if op == 'before':
+            return Contact.created_at < _parse_date(value)
+        if op == 'after':
+            return Contact.created_at >= _parse_date(value)
+        raise ValueError(f"Unknown created_at operator '{op}'")
+
+    raise ValueError(f"Unknown segment field '{field}'")
+
+def parse_definition(raw):
+    """
+    Parses and validates a JSON segment definition. Returns the rule tree.
+    """
+    try:
+        definition = json.loads(raw) if isinstance(raw, str) else raw
+    except ValueError as e:
+        raise ValueError(f"Invalid JSON: {e}")
+    compile_rule(definition)
+    return definition
+
+def segment_filter(segment):
+    return compile_rule(json.loads(segment.definition))
+
+# --- Campaign recipients ---
+
+def recipients_query(campaign):
+    """
+    Returns a lightweight (id, email, name) query of the active contacts a campaign targets.
+    A segment takes precedence over a target group; neither means all contacts.
+    """
+    query = db.session.query(Contact.id, Contact.email, Contact.name).filter(Contact.status == 'active')
+    if campaign.segment_id:
+        segment = db.session.get(Segment, campaign.segment_id)
+        # A missing segment must never widen the audience to everyone
+        query = query.filter(segment_filter(segment) if segment else false())
+    elif campaign.target_group_id:
+        query = query.filter(exists().where(
+            contact_group_association.c.contact_id == Contact.id,
+            contact_group_association.c.group_id == campaign.target_group_id
+        ))
+    return query
+
+def count_recipients(campaign):
+    return recipients_query(campaign).order_by(None).count()
+
+def iter_recipients(query, batch_size=500):
+    """
+    Streams rows from a recipients query in keyset-paginated batches ordered by id.
+    Each batch is fully fetched, so callers can commit between rows without
+    invalidating an open cursor, and memory stays bounded for large audiences.
+    The read transaction is ended after each batch so a long send doesn't pin an
+    old snapshot (and later batches see contacts changed meanwhile).
+    """
+    last_id = 0
+    while True:
+        batch = query.filter(Contact.id > last_id).order_by(Contact.id).limit(batch_size).all()
+        db.session.commit()
+        if not batch:
+            return
+        for row in batch:
+            yield row
+        last_id = batch[-1].id
@@ -0,0 +1,143 @@
+import argparse
+import imaplib
+import os
+import re
+import ssl
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# Reply ingestion benchmark. Seeds a fake IMAP mailbox with synthetic mail, then runs the
+# app's reply check (/check_replies_manual, which calls email_utils.check_replies and
+# stores new replies) twice: an initial check over the whole mailbox and an incremental
+# one after new mail arrived. Prints JSON with time, IMAP round trips and bytes, and
+# database work per check:
+#   python benchmarks/bench_replies.py --messages 5k --reply-ratio 0.1 --attachment-kb 200
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import WriteCounter, capture_stdout, log, parse_count, peak_rss_mb, write_result
+from imap_server import FakeIMAPServer, Mailbox
+from smtp_sink import make_certificate
+
+parser = argparse.ArgumentParser(description="Benchmark checking and storing replies over IMAP.")
+parser.add_argument('--messages', type=parse_count, default=parse_count('2k'), help="messages in the mailbox, e.g. 2k")
+parser.add_argument('--reply-ratio', type=float, default=0.1, help="share of messages replying to the campaign")
+parser.add_argument('--attachment-ratio', type=float, default=0.1, help="share of messages with an attachment")
+parser.add_argument('--attachment-kb', type=int, default=0, help="attachment size")
+parser.add_argument('--new-messages', type=parse_count, default=parse_count('100'), help="mail arriving before the incremental check")
+parser.add_argument('--limit', type=int, help="check_replies limit (default: the whole mailbox)")
+parser.add_argument('--database', help="database URL (default: a new SQLite file); must have no replies")
+parser.add_argument('--output', help="also write the JSON result to this file")
+args = parser.parse_args()
+
+result_stream = capture_stdout()
+workdir = tempfile.mkdtemp(prefix='bench-replies-')
+cert, key = make_certificate(workdir)
+SUBJECT = "Benchmark offer"
+mailbox = Mailbox(SUBJECT, args.reply_ratio, args.attachment_ratio, args.attachment_kb)
+log(f"Building a mailbox of {args.messages} messages...")
+mailbox.add(args.messages)
+imap_server = FakeIMAPServer(mailbox, cert, key)
+imap_port = imap_server.start()
+
+os.environ['DATABASE_URL'] = args.database or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+from app import app
+from database import db, Campaign, Reply, Server, Template
+from init_db import init_database
+
+imap_stats = {'round_trips': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+class CountingIMAP4_SSL(imaplib.IMAP4_SSL):
+    """
+    IMAP4_SSL pointed at the fake server, counting commands and bytes both ways.
+    """
+
+    def __init__(self, host='', port=None, **kwargs):
+        super().__init__(host, imap_port, ssl_context=ssl.create_default_context(cafile=cert), timeout=60)
+
+    def _command(self, name, *args):
+        imap_stats['round_trips'] += 1
+        return super()._command(name, *args)
+
+    def send(self, data):
+        imap_stats['bytes_out'] += len(data)
+        super().send(data)
+
+    def read(self, size):
+        data = super().read(size)
+        imap_stats['bytes_in'] += len(data)
+        return data
+
+    def readline(self):
+        line = super().readline()
+        imap_stats['bytes_in'] += len(line)
+        return line
+
+# check_replies looks the class up on the module at call time
+imaplib.IMAP4_SSL = CountingIMAP4_SSL
+
+init_database(app)
+with app.app_context():
+    if db.session.query(Reply.id).first() is not None:
+        sys.exit("The benchmark database already has replies; use an empty one.")
+    db.session.add(Template(name='benchmark', subject=SUBJECT, content='<p>Hi</p>'))
+    db.session.add(Server(name='fake', smtp_server='127.0.0.1', smtp_port=587, smtp_email='bench@example.com',
+                          smtp_password='bench', imap_server='127.0.0.1', is_primary=True))
+    db.session.flush()
+    db.session.add(Campaign(name='benchmark', template_id=db.session.query(Template.id).scalar(), status='completed'))
+    db.session.commit()
+    writes = WriteCounter(db.engine)
+    dialect = db.engine.dialect.name
+
+client = app.test_client()
+client.post('/login', data={'username': 'admin', 'password': 'adminpassword'})
+start_date = (datetime.now() - timedelta(days=mailbox.days + 1)).strftime('%Y-%m-%d')
+
+def check(label):
+    for key in imap_stats:
+        imap_stats[key] = 0
+    imap_server.reset_stats()
+    writes.reset()
+    limit = args.limit or len(mailbox.messages)
+    log(f"{label} check of {len(mailbox.messages)} messages (limit {limit})...")
+    writes.active.set()
+    started = time.perf_counter()
+    response = client.post('/check_replies_manual', json={'start_date': start_date, 'limit': limit})
+    seconds = time.perf_counter() - started
+    writes.active.clear()
+    body = response.get_json()
+    if not body.get('success'):
+        sys.exit(f"Reply check failed: {body.get('message')}")
+    scanned = int(re.search(r'Checked (\d+)', body['message']).group(1))
+    with app.app_context():
+        stored = db.session.query(Reply).count()
+    return {
+        'mailbox_messages': len(mailbox.messages),
+        'scanned': scanned,
+        'new_replies': body['new_count'],
+        'stored_replies': stored,
+        'seconds': round(seconds, 3),
+        'messages_per_second': round(scanned / seconds, 1) if seconds else None,
+        'imap': dict(imap_stats, fetch_commands=imap_server.stats['fetch_commands'],
+                     fetched_messages=imap_server.stats['fetched_messages'],
+                     round_trips_per_message=round(imap_stats['round_trips'] / scanned, 3) if scanned else None,
+                     bytes_in_per_message=round(imap_stats['bytes_in'] / scanned, 1) if scanned else None),
+        'db': writes.per(scanned, 'message'),
+    }
+
+initial = check('Initial')
+mailbox.add(args.new_messages)
+incremental = check('Incremental')
+imap_server.stop()
+
+write_result('replies', dict(vars(args), database=dialect), {
+    'replies_in_mailbox': mailbox.replies,
+    'initial': initial,
+    'incremental': incremental,
+    'peak_rss_mb': peak_rss_mb(),
+}, result_stream, args.output)
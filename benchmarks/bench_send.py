@@ -0,0 +1,153 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# End to end campaign send benchmark. Seeds a fresh database with synthetic contacts,
+# starts an in-process SMTP sink and sends one campaign to all of them through the real
+# engine (send_campaign_emails, or SenderWorker for --threads > 1), then prints the
+# results as JSON:
+#   python benchmarks/bench_send.py --contacts 100k --connections 8 --output send-100k.json
+# Compare runs across commits with the same arguments on the same machine.
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import (WriteCounter, capture_stdout, current_rss_mb, latency_summary, log, parse_count,
+                    peak_rss_mb, write_result)
+from smtp_sink import SMTPSink, make_certificate
+
+DOMAINS = [('gmail.com', 40), ('outlook.com', 20), ('yahoo.com', 10), ('icloud.com', 5)] + \
+          [(f'company{i}.com', 1) for i in range(25)]
+
+parser = argparse.ArgumentParser(description="Benchmark sending one campaign end to end.")
+parser.add_argument('--contacts', type=parse_count, default=parse_count('1k'), help="audience size, e.g. 1k, 100k, 1m")
+parser.add_argument('--backend', choices=['smtplib', 'asyncio'], default='smtplib', help="SMTP_BACKEND to send with")
+parser.add_argument('--threads', type=int, default=1, help="sender threads (more than 1 uses SenderWorker)")
+parser.add_argument('--connections', type=int, default=1, help="max_connections of the server")
+parser.add_argument('--batch-size', type=int, default=50, help="SENDER_BATCH_SIZE")
+parser.add_argument('--delay-ms', type=float, default=0, help="sink delay before accepting each message")
+parser.add_argument('--reject-rate', type=float, default=0, help="share of recipients refused with 550")
+parser.add_argument('--tempfail-rate', type=float, default=0, help="share of recipients refused with 451")
+parser.add_argument('--body-kb', type=int, default=4, help="approximate template size")
+parser.add_argument('--database', help="database URL (default: a new SQLite file); must have no contacts")
+parser.add_argument('--output', help="also write the JSON result to this file")
+args = parser.parse_args()
+result_stream = capture_stdout()
+
+workdir = tempfile.mkdtemp(prefix='bench-send-')
+cert, key = make_certificate(workdir)
+sink = SMTPSink(delay=args.delay_ms / 1000, reject_rate=args.reject_rate, tempfail_rate=args.tempfail_rate,
+                tls_cert=cert, tls_key=key)
+sink_port = sink.start()
+
+# Module level settings are read at import
+os.environ['DATABASE_URL'] = args.database or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+os.environ['SMTP_BACKEND'] = args.backend
+os.environ['SENDER_BATCH_SIZE'] = str(args.batch_size)
+
+import ssl
+from sqlalchemy import insert
+import async_smtp
+import sender
+from app import app, send_campaign_emails
+from database import db, Contact, Campaign, Server, Template
+from db_writer import background_writer
+from init_db import init_database
+from sender import SenderWorker, enqueue_campaign, status_counts
+
+# Trust the sink's certificate instead of turning verification off
+async_smtp.tls_context = lambda: ssl.create_default_context(cafile=cert)
+
+def seed(session):
+    if session.query(Contact.id).first() is not None:
+        sys.exit("The benchmark database already has contacts; use an empty one.")
+    paragraph = "<p>Hello {{name}}, this is a benchmark message with some text in it. </p>\n"
+    session.add(Template(name='benchmark', subject='Benchmark', content=paragraph * max(1, args.body_kb * 1024 // len(paragraph))))
+    session.add(Server(name='sink', smtp_server='127.0.0.1', smtp_port=sink_port, smtp_email='bench@example.com',
+                       smtp_password='bench', imap_server='', is_primary=True, max_connections=args.connections))
+    weights = [(domain, weight) for domain, weight in DOMAINS for _ in range(weight)]
+    chunk = 10000
+    for start in range(0, args.contacts, chunk):
+        session.execute(insert(Contact), [
+            {'email': f'user{i}@{weights[i % len(weights)][0]}', 'name': f'User {i}', 'status': 'active'}
+            for i in range(start, min(start + chunk, args.contacts))])
+        session.commit()
+    campaign = Campaign(name='benchmark', template_id=session.query(Template.id).scalar())
+    session.add(campaign)
+    session.commit()
+    return campaign.id
+
+latencies = []
+
+def timed_send(send):
+    def wrapper(*a, **kw):
+        started = time.perf_counter()
+        result = send(*a, **kw)
+        latencies.append(time.perf_counter() - started)
+        return result
+    return wrapper
+
+def timed_submit(submit):
+    def wrapper(*a, **kw):
+        started = time.perf_counter()
+        future = submit(*a, **kw)
+        future.add_done_callback(lambda f: latencies.append(time.perf_counter() - started))
+        return future
+    return wrapper
+
+sender.send_email = timed_send(sender.send_email)
+async_smtp.async_smtp.submit = timed_submit(async_smtp.async_smtp.submit)
+
+init_database(app)
+with app.app_context():
+    writes = WriteCounter(db.engine)
+    log(f"Seeding {args.contacts} contacts...")
+    started = time.perf_counter()
+    campaign_id = seed(db.session)
+    seed_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    campaign = db.session.get(Campaign, campaign_id)
+    enqueue_campaign(campaign)
+    campaign.status = 'sending'
+    db.session.commit()
+    enqueue_seconds = time.perf_counter() - started
+    db.session.remove()
+
+rss_before_mb = current_rss_mb()
+log(f"Sending with {args.backend}, {args.threads} thread(s), {args.connections} connection(s)...")
+writes.active.set()
+started = time.perf_counter()
+if args.threads > 1:
+    SenderWorker(app, threads=args.threads, batch_size=args.batch_size, poll_interval=0.2,
+                 campaign_ids=[campaign_id]).run(once=True)
+else:
+    send_campaign_emails(campaign_id)
+background_writer.flush()
+send_seconds = time.perf_counter() - started
+writes.active.clear()
+
+with app.app_context():
+    counts = status_counts(campaign_id)
+    status = db.session.get(Campaign, campaign_id).status
+    dialect = db.engine.dialect.name
+sink.stop()
+
+handled = sum(counts.values())
+write_result('send', dict(vars(args), database=dialect), {
+    'campaign_status': status,
+    'recipients': handled,
+    'statuses': counts,
+    'seed_seconds': round(seed_seconds, 3),
+    'enqueue_seconds': round(enqueue_seconds, 3),
+    'send_seconds': round(send_seconds, 3),
+    'messages_per_second': round(counts.get('sent', 0) / send_seconds, 1) if send_seconds else None,
+    'latency_ms': latency_summary(latencies),
+    'db': writes.per(handled, 'message'),
+    'rss_before_send_mb': rss_before_mb,
+    'peak_rss_mb': peak_rss_mb(),
+    'sink': {k: v for k, v in sink.stats.items() if k != 'concurrent'},
+}, result_stream, args.output)
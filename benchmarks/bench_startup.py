@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# Worker startup benchmark: how long a fresh process takes to import the app (what every
+# gunicorn worker pays at boot), its memory afterwards, whether it touched the database,
+# and the slowest imports:
+#   python benchmarks/bench_startup.py --runs 10
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import ROOT, capture_stdout, log, write_result
+
+# Runs in the child: import, then report time, memory and SQL statements as JSON
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+statements = []
+event.listen(Engine, 'before_cursor_execute', lambda *a: statements.append(a[2]))
+import {module}
+seconds = time.perf_counter() - started
+with open('/proc/self/statm') as f:
+    rss = int(f.read().split()[1]) * __import__('os').sysconf('SC_PAGE_SIZE')
+print(json.dumps({{'seconds': seconds, 'rss_mb': rss / 1048576, 'modules': len(sys.modules),
+                  'sql_statements': len(statements)}}), file=sys.__stderr__)
+"""
+
+parser = argparse.ArgumentParser(description="Benchmark process startup (import time and memory).")
+parser.add_argument('--module', default='app', help="module to import (default: app)")
+parser.add_argument('--runs', type=int, default=5, help="fresh processes to time")
+parser.add_argument('--top', type=int, default=15, help="slowest imports to list")
+parser.add_argument('--database', help="database URL (default: a new SQLite file)")
+parser.add_argument('--output', help="also write the JSON result to this file")
+args = parser.parse_args()
+result_stream = capture_stdout()
+
+workdir = tempfile.mkdtemp(prefix='bench-startup-')
+env = dict(os.environ, DATABASE_URL=args.database or f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+           SECRET_KEY=os.environ.get('SECRET_KEY', 'benchmark'), PYTHONPATH=ROOT)
+
+def child(*python_args, probe=True):
+    code = PROBE.format(module=args.module) if probe else f"import {args.module}"
+    done = subprocess.run([sys.executable, *python_args, '-c', code], cwd=ROOT, env=env,
+                          capture_output=True, text=True)
+    if done.returncode:
+        sys.exit(f"Importing {args.module} failed:\n{done.stderr}")
+    return done.stderr
+
+# A database must exist, as it would in production (init_db.py ran at release)
+subprocess.run([sys.executable, 'init_db.py'], cwd=ROOT, env=env, check=True, capture_output=True)
+child() # Warm the bytecode and OS file caches
+
+runs = []
+for run in range(args.runs):
+    output = child()
+    runs.append(json.loads(output.strip().splitlines()[-1]))
+    log(f"Run {run + 1}: {runs[-1]['seconds'] * 1000:.0f} ms, {runs[-1]['rss_mb']:.1f} MB")
+
+# -X importtime: "import time: self | cumulative | name", in microseconds
+imports = []
+for line in child('-X', 'importtime', probe=False).splitlines():
+    match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+    if match:
+        imports.append({'module': match.group(4), 'self_ms': int(match.group(1)) / 1000,
+                        'cumulative_ms': int(match.group(2)) / 1000, 'depth': len(match.group(3)) // 2})
+top_level = sorted((i for i in imports if i['depth'] <= 1), key=lambda i: -i['cumulative_ms'])
+
+seconds = sorted(r['seconds'] for r in runs)
+write_result('startup', dict(vars(args), database=env['DATABASE_URL'].split(':')[0]), {
+    'import_ms': {'min': round(seconds[0] * 1000, 1), 'median': round(statistics.median(seconds) * 1000, 1),
+                  'max': round(seconds[-1] * 1000, 1)},
+    'rss_mb': round(statistics.median(r['rss_mb'] for r in runs), 1),
+    'modules_loaded': runs[-1]['modules'],
+    'sql_statements_at_import': runs[-1]['sql_statements'],
+    'slowest_imports': [{k: round(v, 1) if isinstance(v, float) else v for k, v in i.items() if k != 'depth'}
+                        for i in top_level[:args.top]],
+}, result_stream, args.output)
@@ -0,0 +1,117 @@
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+# Helpers shared by the benchmark scripts
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def parse_count(value):
+    """
+    '1k' -> 1000, '1m' -> 1000000, '250' -> 250.
+    """
+    value = value.strip().lower()
+    scale = {'k': 1000, 'm': 1000000}.get(value[-1:], 1)
+    return int(float(value.rstrip('km')) * scale)
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+def latency_summary(values):
+    """
+    p50/p90/p99/max in milliseconds of a list of durations in seconds.
+    """
+    values = sorted(values)
+    return {name: round(percentile(values, p) * 1000, 2) if values else None
+            for name, p in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100))}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576, 1)
+    except OSError:
+        return None
+
+def peak_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+def capture_stdout():
+    """
+    The app reports progress with print(); send that to stderr and return the real
+    stdout, which is kept for the JSON result.
+    """
+    result_stream, sys.stdout = sys.stdout, sys.stderr
+    return result_stream
+
+def write_result(name, params, results, stream, output=None):
+    result = {
+        'benchmark': name,
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'params': params,
+        'results': results,
+    }
+    text = json.dumps(result, indent=2, default=str)
+    print(text, file=stream)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+
+class WriteCounter:
+    """
+    Counts the SQL an engine runs while active: write statements, rows written
+    (executemany counts every row), reads and commits.
+    """
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.active = threading.Event()
+        self.reset()
+        event.listen(engine, 'before_cursor_execute', self._statement)
+        event.listen(engine, 'commit', self._commit)
+
+    def reset(self):
+        self.counts = {'statements': 0, 'rows': 0, 'reads': 0, 'commits': 0}
+
+    def _statement(self, conn, cursor, statement, parameters, context, executemany):
+        if not self.active.is_set():
+            return
+        verb = statement.lstrip()[:6].upper()
+        if verb in ('INSERT', 'UPDATE', 'DELETE'):
+            self.counts['statements'] += 1
+            # executemany gets one parameter set per row; a single row may come as a flat tuple
+            many = executemany and parameters and isinstance(parameters[0], (list, tuple, dict))
+            self.counts['rows'] += len(parameters) if many else 1
+        elif verb.startswith(('SELECT', 'WITH')):
+            self.counts['reads'] += 1
+
+    def _commit(self, conn):
+        if self.active.is_set():
+            self.counts['commits'] += 1
+
+    def per(self, total, unit):
+        """
+        Counts plus their ratio to total, e.g. per(messages, 'message').
+        """
+        return dict(self.counts, **{f'{name}_per_{unit}': round(value / total, 3) if total else None
+                                    for name, value in self.counts.items()})
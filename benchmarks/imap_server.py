@@ -0,0 +1,183 @@
+import asyncio
+import random
+import re
+import ssl
+import threading
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from email.policy import SMTP
+from email.utils import format_datetime
+
+# In-process IMAP stand-in for benchmarks: an implicit TLS server (like port 993) with
+# one synthetic INBOX, answering the commands check_replies uses (CAPABILITY, LOGIN,
+# SELECT, SEARCH SINCE, FETCH of header fields or RFC822, CLOSE, LOGOUT).
+
+HEADER_FIELDS_RE = re.compile(rb'BODY(?:\.PEEK)?\[HEADER\.FIELDS \(([^)]*)\)\]', re.I)
+
+class Mailbox:
+    """
+    Synthetic messages, oldest first. reply_ratio of them answer the campaign subject;
+    attachment_ratio of them carry an attachment of attachment_kb.
+    """
+
+    def __init__(self, subject, reply_ratio=0.1, attachment_ratio=0.0, attachment_kb=0, days=30, seed=0):
+        self.subject = subject
+        self.reply_ratio = reply_ratio
+        self.attachment_ratio = attachment_ratio
+        self.attachment_kb = attachment_kb
+        self.days = days
+        self.random = random.Random(seed)
+        self.messages = [] # (date, raw bytes, {header name: raw header line})
+        self.replies = 0
+
+    def add(self, count, newest=None):
+        """
+        Adds count messages dated over the window before newest (default now), keeping date order.
+        """
+        newest = newest or datetime.now().astimezone()
+        oldest = self.messages[-1][0] if self.messages else newest - timedelta(days=self.days)
+        span = max((newest - oldest).total_seconds(), 1)
+        dates = sorted(oldest + timedelta(seconds=self.random.uniform(0, span)) for _ in range(count))
+        for date in dates:
+            self.messages.append(self._message(len(self.messages) + 1, date))
+
+    def _message(self, number, date):
+        is_reply = self.random.random() < self.reply_ratio
+        self.replies += is_reply
+        msg = EmailMessage(policy=SMTP)
+        msg['From'] = f"Lead {number} <lead{number}@example.org>"
+        msg['To'] = "bench@example.com"
+        msg['Subject'] = f"Re: {self.subject}" if is_reply else f"Weekly digest #{number}"
+        msg['Date'] = format_datetime(date)
+        if number % 7 == 0:
+            msg['Cc'] = f"colleague{number}@example.org"
+        msg.set_content(f"Message {number}.\n\n" + "Thanks for reaching out, let's talk next week.\n" * 20)
+        if self.attachment_kb and self.random.random() < self.attachment_ratio:
+            msg.add_attachment(self.random.randbytes(self.attachment_kb * 1024), maintype='application',
+                               subtype='octet-stream', filename=f"file{number}.bin")
+        raw = msg.as_bytes()
+        head = raw[:raw.index(b'\r\n\r\n') + 2]
+        headers = {}
+        for line in re.split(rb'\r\n(?![ \t])', head):
+            if b':' in line:
+                headers[line.split(b':', 1)[0].strip().upper()] = line + b'\r\n'
+        return date, raw, headers
+
+    def search_since(self, day):
+        return [str(i + 1).encode() for i, (date, _, _) in enumerate(self.messages) if date.date() >= day]
+
+    def header_fields(self, number, names):
+        # names as sent by the client, e.g. [b'FROM', b'SUBJECT']
+        _, _, headers = self.messages[number - 1]
+        return b''.join(headers.get(name.upper(), b'') for name in names) + b'\r\n'
+
+    def raw(self, number):
+        return self.messages[number - 1][1]
+
+def parse_sequence_set(text, last):
+    numbers = []
+    for part in text.split(b','):
+        if b':' in part:
+            start, end = part.split(b':')
+            start = int(start)
+            end = last if end == b'*' else int(end)
+            numbers.extend(range(start, end + 1))
+        else:
+            numbers.append(int(part))
+    return [n for n in numbers if 1 <= n <= last]
+
+class FakeIMAPServer:
+    def __init__(self, mailbox, tls_cert, tls_key, host='127.0.0.1', port=0):
+        self.mailbox = mailbox
+        self.host = host
+        self.port = port
+        self.tls = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.tls.load_cert_chain(tls_cert, tls_key)
+        self.stats = {'sessions': 0, 'commands': 0, 'fetch_commands': 0, 'fetched_messages': 0, 'bytes_sent': 0}
+        self._loop = None
+        self._server = None
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._session, self.host, self.port, ssl=self.tls))
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=run, name='fake-imap', daemon=True).start()
+        started.wait()
+        return self.port
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def reset_stats(self):
+        for key in self.stats:
+            self.stats[key] = 0
+
+    def _fetch(self, arguments):
+        sequence, _, items = arguments.partition(b' ')
+        numbers = parse_sequence_set(sequence, len(self.mailbox.messages))
+        fields = HEADER_FIELDS_RE.search(items)
+        self.stats['fetch_commands'] += 1
+        self.stats['fetched_messages'] += len(numbers)
+        out = []
+        for number in numbers:
+            if fields:
+                names = fields.group(1).split()
+                data = self.mailbox.header_fields(number, names)
+                label = b'BODY[HEADER.FIELDS (' + b' '.join(names) + b')]'
+            else:
+                data = self.mailbox.raw(number)
+                label = b'RFC822'
+            out.append(b'* %d FETCH (%s {%d}\r\n' % (number, label, len(data)) + data + b')\r\n')
+        return b''.join(out)
+
+    async def _session(self, reader, writer):
+        self.stats['sessions'] += 1
+        try:
+            writer.write(b'* OK [CAPABILITY IMAP4rev1] fake IMAP ready\r\n')
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.stats['commands'] += 1
+                tag, _, rest = line.rstrip(b'\r\n').partition(b' ')
+                command, _, arguments = rest.partition(b' ')
+                command = command.upper()
+                if command == b'CAPABILITY':
+                    response = b'* CAPABILITY IMAP4rev1 AUTH=PLAIN\r\n' + tag + b' OK CAPABILITY completed\r\n'
+                elif command == b'LOGIN':
+                    response = tag + b' OK LOGIN completed\r\n'
+                elif command in (b'SELECT', b'EXAMINE'):
+                    response = (b'* %d EXISTS\r\n* 0 RECENT\r\n' % len(self.mailbox.messages) +
+                                tag + b' OK [READ-WRITE] SELECT completed\r\n')
+                elif command == b'SEARCH':
+                    match = re.search(rb'SINCE "?(\d{1,2}-\w{3}-\d{4})"?', arguments, re.I)
+                    ids = self.mailbox.search_since(datetime.strptime(match.group(1).decode(), '%d-%b-%Y').date()) \
+                        if match else [str(i + 1).encode() for i in range(len(self.mailbox.messages))]
+                    response = b'* SEARCH ' + b' '.join(ids) + b'\r\n' + tag + b' OK SEARCH completed\r\n'
+                elif command == b'FETCH':
+                    response = self._fetch(arguments) + tag + b' OK FETCH completed\r\n'
+                elif command in (b'CLOSE', b'NOOP'):
+                    response = tag + b' OK ' + command + b' completed\r\n'
+                elif command == b'LOGOUT':
+                    writer.write(b'* BYE logging out\r\n' + tag + b' OK LOGOUT completed\r\n')
+                    await writer.drain()
+                    break
+                else:
+                    response = tag + b' BAD unknown command\r\n'
+                self.stats['bytes_sent'] += len(response)
+                writer.write(response)
+                await writer.drain()
+        except (ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,137 @@
+import asyncio
+import os
+import random
+import ssl
+import subprocess
+import threading
+
+# In-process SMTP sink for benchmarks: speaks enough ESMTP for send_email and the
+# asyncio backend (STARTTLS, AUTH PLAIN, MAIL/RCPT/DATA), counts what it receives
+# instead of storing it, and can delay or refuse messages to mimic a real server.
+
+def make_certificate(directory, host='127.0.0.1'):
+    """
+    Writes a self-signed certificate for host (and localhost) with the openssl CLI.
+    Returns (cert path, key path).
+    """
+    cert, key = os.path.join(directory, 'sink.crt'), os.path.join(directory, 'sink.key')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2',
+                    '-subj', '/CN=localhost', '-addext', f'subjectAltName=DNS:localhost,IP:{host}',
+                    '-keyout', key, '-out', cert], check=True, capture_output=True)
+    return cert, key
+
+class SMTPSink:
+    """
+    delay: seconds to wait before accepting each message (server side processing time)
+    reject_rate / tempfail_rate: share of recipients refused with 550 / 451
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0, reject_rate=0.0, tempfail_rate=0.0,
+                 tls_cert=None, tls_key=None, seed=0):
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.reject_rate = reject_rate
+        self.tempfail_rate = tempfail_rate
+        self.random = random.Random(seed)
+        self.tls = None
+        if tls_cert:
+            self.tls = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self.tls.load_cert_chain(tls_cert, tls_key)
+        self.stats = {'sessions': 0, 'messages': 0, 'bytes': 0, 'rejected': 0, 'tempfailed': 0,
+                      'concurrent': 0, 'max_concurrent': 0}
+        self._loop = None
+        self._server = None
+
+    def start(self):
+        """
+        Starts serving from a background thread and returns the port.
+        """
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._session, self.host, self.port, backlog=4096))
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=run, name='smtp-sink', daemon=True).start()
+        started.wait()
+        return self.port
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _recipient_reply(self):
+        roll = self.random.random()
+        if roll < self.reject_rate:
+            self.stats['rejected'] += 1
+            return b'550 5.1.1 No such user\r\n'
+        if roll < self.reject_rate + self.tempfail_rate:
+            self.stats['tempfailed'] += 1
+            return b'451 4.7.1 Try again later\r\n'
+        return b'250 2.1.5 Ok\r\n'
+
+    async def _session(self, reader, writer):
+        stats = self.stats
+        stats['sessions'] += 1
+        stats['concurrent'] += 1
+        stats['max_concurrent'] = max(stats['max_concurrent'], stats['concurrent'])
+        secure = False
+        try:
+            writer.write(b'220 sink ESMTP\r\n')
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                verb = line[:4].upper()
+                if verb in (b'EHLO', b'HELO'):
+                    features = [b'sink', b'PIPELINING', b'8BITMIME', b'SIZE 104857600']
+                    if self.tls and not secure:
+                        features.append(b'STARTTLS')
+                    features.append(b'AUTH PLAIN')
+                    writer.write(b''.join(b'250-' + f + b'\r\n' for f in features[:-1]) + b'250 ' + features[-1] + b'\r\n')
+                elif verb == b'STAR' and self.tls and not secure:
+                    writer.write(b'220 2.0.0 Ready to start TLS\r\n')
+                    await writer.drain()
+                    await writer.start_tls(self.tls)
+                    secure = True
+                elif verb == b'AUTH':
+                    if len(line.split()) < 3:
+                        writer.write(b'334 \r\n')
+                        await writer.drain()
+                        await reader.readline()
+                    writer.write(b'235 2.7.0 Authentication successful\r\n')
+                elif verb == b'RCPT':
+                    writer.write(self._recipient_reply())
+                elif verb == b'DATA':
+                    writer.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                    await writer.drain()
+                    size = 0
+                    while True:
+                        data = await reader.readline()
+                        if not data or data == b'.\r\n':
+                            break
+                        size += len(data)
+                    if self.delay:
+                        await asyncio.sleep(self.delay)
+                    stats['messages'] += 1
+                    stats['bytes'] += size
+                    writer.write(b'250 2.0.0 Ok: queued\r\n')
+                elif verb == b'QUIT':
+                    writer.write(b'221 2.0.0 Bye\r\n')
+                    await writer.drain()
+                    break
+                else:
+                    writer.write(b'250 2.0.0 Ok\r\n')
+                await writer.drain()
+        except (ConnectionError, ssl.SSLError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            stats['concurrent'] -= 1
+            writer.close()
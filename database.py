@@ -1,5 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import validates
 from datetime import datetime
+from template_registry import content_hash
 
 db = SQLAlchemy()
 
@@ -8,6 +10,22 @@ contact_group_association = db.Table('contact_group_association',
     db.Column('contact_id', db.Integer, db.ForeignKey('contact.id'), primary_key=True),
     db.Column('group_id', db.Integer, db.ForeignKey('contact_group.id'), primary_key=True)
 )
+# The primary key covers lookups by contact; group membership lookups need their own index
+db.Index('ix_contact_group_association_group_id', contact_group_association.c.group_id)
+
+# Association table for Contact <-> Tag
+# Indexed on tag_id so "contacts with tag X" is an index lookup, not a scan
+contact_tag_association = db.Table('contact_tag_association',
+    db.Column('contact_id', db.Integer, db.ForeignKey('contact.id'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True, index=True)
+)
+
+# Association table for Campaign <-> Attachment
+# Attachments are content-addressed, so duplicated campaigns share the same stored file
+campaign_attachment_association = db.Table('campaign_attachment_association',
+    db.Column('campaign_id', db.Integer, db.ForeignKey('campaign.id'), primary_key=True),
+    db.Column('attachment_id', db.Integer, db.ForeignKey('attachment.id'), primary_key=True, index=True)
+)
 
 class ContactGroup(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -16,47 +34,189 @@ class ContactGroup(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Contact(db.Model):
+    __table_args__ = (
+        db.Index('ix_contact_status_id', 'status', 'id'), # Active counts, keyset-paginated recipients
+        db.Index('ix_contact_created_at', 'created_at'), # Contacts page ordering, segment date rules
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
     company = db.Column(db.String(100), nullable=True)
     status = db.Column(db.String(20), default='active')  # active, unsubscribed, bounced
-    tags = db.Column(db.String(200), nullable=True) # Comma separated tags
+    tags = db.Column(db.String(200), nullable=True) # Comma separated tags (display copy of tag_list)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     groups = db.relationship('ContactGroup', secondary=contact_group_association, lazy='subquery',
         backref=db.backref('contacts', lazy=True))
+    tag_list = db.relationship('Tag', secondary=contact_tag_association, lazy=True,
+        backref=db.backref('contacts', lazy='dynamic'))
+
+# Write sites store normalize_email() output; this makes the database refuse a second
+# spelling of the same address from any path that doesn't (raw imports, restores)
+db.Index('ix_contact_email_lower', db.func.lower(Contact.email), unique=True)
+
+class Tag(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), unique=True, nullable=False) # Lowercase, trimmed
+
+class Segment(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+    definition = db.Column(db.Text, nullable=False) # JSON rule tree, see audience.compile_rule
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Template(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     subject = db.Column(db.String(200), nullable=False)
     content = db.Column(db.Text, nullable=False) # HTML content
+    content_hash = db.Column(db.String(64), nullable=True, index=True) # SHA-256 of content, identifies the version
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    @validates('content')
+    def _hash_content(self, key, value):
+        self.content_hash = content_hash(value)
+        return value
+
 class Campaign(db.Model):
+    __table_args__ = (
+        db.Index('ix_campaign_status', 'status'), # Dashboard counts, stuck campaign reset
+        db.Index('ix_campaign_created_at', 'created_at'), # Campaign lists ordering
+        db.Index('ix_campaign_name', 'name'), # Duplicate name checks
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     template_id = db.Column(db.Integer, db.ForeignKey('template.id'), nullable=False)
     target_group_id = db.Column(db.Integer, db.ForeignKey('contact_group.id'), nullable=True) # Null = All Contacts
+    segment_id = db.Column(db.Integer, db.ForeignKey('segment.id'), nullable=True) # Takes precedence over target_group_id
+    subject = db.Column(db.String(200), nullable=True) # Overrides template.subject when set (shared file templates)
     status = db.Column(db.String(20), default='draft') # draft, sending, completed, failed
+    priority = db.Column(db.Integer, default=0) # Higher goes first when campaigns share a server
+    weight = db.Column(db.Integer, default=1) # Share of server capacity among campaigns of equal priority
     sent_count = db.Column(db.Integer, default=0)
     total_contacts = db.Column(db.Integer, default=0)  # Total contacts to send to (for progress tracking)
+    # Kept by tracking.py as hits are flushed, so stats never count tracking_event rows
+    open_count = db.Column(db.Integer, default=0)
+    unique_open_count = db.Column(db.Integer, default=0)
+    click_count = db.Column(db.Integer, default=0)
+    unique_click_count = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # SENDER_MODE=thread: the web process sending the campaign and until when its lease holds
+    # (renewed while it sends; another process adopts the campaign once it lapses, see recovery.py)
+    sender = db.Column(db.String(200), nullable=True)
+    sender_lease_until = db.Column(db.DateTime, nullable=True)
     template = db.relationship('Template', backref=db.backref('campaigns', lazy=True))
     target_group = db.relationship('ContactGroup', backref=db.backref('campaigns', lazy=True))
+    segment = db.relationship('Segment', backref=db.backref('campaigns', lazy=True))
     error_message = db.Column(db.Text, nullable=True)
+    attachments = db.relationship('Attachment', secondary=campaign_attachment_association, lazy=True,
+        backref=db.backref('campaigns', lazy=True))
+
+    @property
+    def email_subject(self):
+        return self.subject or (self.template.subject if self.template else None)
+
+class Attachment(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255), nullable=False)
+    content_type = db.Column(db.String(100), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    content_hash = db.Column(db.String(64), nullable=False, index=True) # SHA-256 of data
+    data = db.deferred(db.Column(db.LargeBinary, nullable=False)) # Only loaded when the part is (re)encoded
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class EmailLog(db.Model):
+    __table_args__ = (
+        db.Index('ix_email_log_status_sent_at', 'status', 'sent_at'), # Dashboard totals and per-day counts
+        db.Index('ix_email_log_type_status', 'type', 'status'), # Follow-up counts
+        db.Index('ix_email_log_campaign_id_status', 'campaign_id', 'status'), # Per-campaign stats and deletes
+        db.Index('ix_email_log_recipient_email', 'recipient_email'), # Per-recipient history
+    )
     id = db.Column(db.Integer, primary_key=True)
     campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), nullable=True)
     recipient_email = db.Column(db.String(120), nullable=False)
-    status = db.Column(db.String(20), default='sent') # sent, failed, replied
+    status = db.Column(db.String(20), default='sent') # sent, failed, replied, suppressed, capped
     type = db.Column(db.String(20), default='campaign') # campaign, followup, resend
     error_message = db.Column(db.String(500), nullable=True)
     sent_at = db.Column(db.DateTime, default=datetime.utcnow)
     campaign = db.relationship('Campaign', backref=db.backref('logs', lazy=True))
 
+class EmailLogDaily(db.Model):
+    """
+    Per-day, per-campaign counts of EmailLog rows that retention moved to the archive
+    (see retention.py), so totals survive the detailed rows being deleted.
+    """
+    __table_args__ = (
+        db.Index('ix_email_log_daily_key', 'day', 'campaign_id', 'type', 'status'),
+        db.Index('ix_email_log_daily_campaign_id', 'campaign_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=True)
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), nullable=True)
+    type = db.Column(db.String(20), nullable=True)
+    status = db.Column(db.String(20), nullable=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class CampaignRecipient(db.Model):
+    """
+    Send queue of a started campaign, one row per recipient. Sender workers claim
+    pending rows in batches (see sender.py), so any number of processes can share a campaign.
+    """
+    __table_args__ = (
+        db.Index('ix_campaign_recipient_contact', 'campaign_id', 'contact_id', unique=True), # Idempotent enqueue
+        db.Index('ix_campaign_recipient_order', 'campaign_id', 'status', 'send_order'), # Next pending batch, status counts
+        db.Index('ix_campaign_recipient_claim_token', 'claim_token'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), nullable=False)
+    contact_id = db.Column(db.Integer, nullable=False)
+    email = db.Column(db.String(120), nullable=False)
+    name = db.Column(db.String(100), nullable=True)
+    domain = db.Column(db.String(255), nullable=True) # Recipient domain, for pacing per receiving server
+    send_order = db.Column(db.Float, nullable=True) # Domains interleaved evenly across the campaign
+    status = db.Column(db.String(20), default='pending', nullable=False) # pending, claimed, sent, failed, suppressed, capped
+    defer_until = db.Column(db.DateTime, nullable=True) # Held back by a domain rate cap
+    claimed_by = db.Column(db.String(100), nullable=True) # host:pid of the worker holding the row
+    claim_token = db.Column(db.String(32), nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    error_message = db.Column(db.Text, nullable=True)
+    opened_at = db.Column(db.DateTime, nullable=True) # First tracked open
+    clicked_at = db.Column(db.DateTime, nullable=True) # First tracked click
+
+class TrackingEvent(db.Model):
+    """
+    Raw open and click hits, bulk inserted by tracking.py. recipient_id is the
+    campaign_recipient row the token was issued for.
+    """
+    __table_args__ = (
+        db.Index('ix_tracking_event_campaign_id', 'campaign_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), nullable=False)
+    recipient_id = db.Column(db.Integer, nullable=False)
+    type = db.Column(db.String(10), nullable=False) # open, click
+    url = db.Column(db.String(2000), nullable=True) # Click target
+    user_agent = db.Column(db.String(200), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class RecipientSendIndex(db.Model):
+    """
+    Latest campaign sends per address, written alongside EmailLog so the frequency
+    cap (see frequency.py) is a primary key lookup instead of an EmailLog count.
+    """
+    email = db.Column(db.String(120), primary_key=True)
+    last_sent_at = db.Column(db.DateTime, nullable=False)
+    recent_sends = db.Column(db.String(200), nullable=False, default='') # Unix times, oldest first, space separated
+
 class Reply(db.Model):
+    __table_args__ = (
+        db.Index('ix_reply_received_at', 'received_at'), # Inbox ordering, date filters, today count
+        db.Index('ix_reply_server_id_received_at', 'server_id', 'received_at'), # Inbox filtered by server
+        db.Index('ix_reply_campaign_id', 'campaign_id'),
+        db.Index('ix_reply_campaign_id_received_at', 'campaign_id', 'received_at'), # Inbox filtered by campaign
+        db.Index('ix_reply_is_read_received_at', 'is_read', 'received_at'), # Unread inbox
+        db.Index('ix_reply_contact_id', 'contact_id'),
+        db.Index('ix_reply_sender_email_subject', 'sender_email', 'subject'), # Duplicate check on ingest
+    )
     id = db.Column(db.Integer, primary_key=True)
     campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), nullable=True)
     contact_id = db.Column(db.Integer, db.ForeignKey('contact.id'), nullable=True)
@@ -70,6 +230,17 @@ class Reply(db.Model):
     is_read = db.Column(db.Boolean, default=False)
     campaign = db.relationship('Campaign', backref=db.backref('replies', lazy=True))
 
+class Suppression(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    email = db.Column(db.String(120), unique=True, nullable=False) # Lowercase, trimmed
+    reason = db.Column(db.String(20), nullable=False) # unsubscribe, bounce, complaint, manual
+    source = db.Column(db.String(200), nullable=True) # What added it, e.g. SMTP error text
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_suppression_created_at', 'created_at'), # Incremental refresh of the in-memory list
+    )
+
 class Settings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     smtp_server = db.Column(db.String(100), default='smtp.gmail.com')
@@ -88,8 +259,36 @@ class Server(db.Model):
     smtp_password = db.Column(db.String(120), nullable=False)
     imap_server = db.Column(db.String(100), nullable=False)
     is_primary = db.Column(db.Boolean, default=False)
+    dkim_selector = db.Column(db.String(63), nullable=True) # DKIM signing is on when selector and key are set
+    dkim_private_key = db.Column(db.Text, nullable=True) # PEM, RSA; signs for the domain of smtp_email
+    max_connections = db.Column(db.Integer, default=1) # Concurrent SMTP sessions across all campaigns
+    max_per_minute = db.Column(db.Integer, nullable=True) # Send pace across all campaigns, null = unlimited
+    pace_next = db.Column(db.Float, nullable=True) # Unix time of the first send slot no process holds yet
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class ServerLease(db.Model):
+    """
+    A process's share of a server's connection limit (see scheduler.py). A process that
+    stops renewing its lease, e.g. because it died, no longer counts once it expires.
+    """
+    __table_args__ = (
+        db.Index('ix_server_lease_server_holder', 'server_id', 'holder', unique=True),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    server_id = db.Column(db.Integer, nullable=False) # No foreign key: deleting a server mustn't wait for leases
+    holder = db.Column(db.String(200), nullable=False) # host:pid
+    connections = db.Column(db.Integer, nullable=False, default=0) # Sessions it may have open
+    wanted = db.Column(db.Integer, nullable=False, default=0) # Sessions it could use right now
+    waiting_since = db.Column(db.Float, nullable=True) # Unix time since which it has wanted sessions and had none
+    expires_at = db.Column(db.Float, nullable=False) # Unix time
+
+class DomainPace(db.Model):
+    """
+    Next free send slot of a rate capped recipient domain, shared by every process.
+    """
+    domain = db.Column(db.String(255), primary_key=True)
+    pace_next = db.Column(db.Float, nullable=True) # Unix time
+
 from flask_login import UserMixin
 
 class User(db.Model, UserMixin):
@@ -0,0 +1,156 @@
+import queue
+import sqlite3
+import threading
+from sqlalchemy import event
+from database import db
+from metrics import writer_queue
+
+def configure_sqlite(engine, busy_timeout_ms=5000):
+    """
+    Switches a SQLite engine to WAL mode so readers never block on the writer
+    (and vice versa), waits up to busy_timeout_ms for locks instead of failing
+    with "database is locked", and relaxes fsync to synchronous=NORMAL, which is
+    safe under WAL. Returns False (and does nothing) for other databases.
+    """
+    if engine.dialect.name != 'sqlite':
+        return False
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    return True
+
+def backup_sqlite(engine, target_path):
+    """
+    Copies engine's SQLite database to target_path with SQLite's online backup API.
+    Unlike copying the .db file, the copy includes transactions still in the WAL.
+    """
+    target = sqlite3.connect(target_path)
+    raw = engine.raw_connection()
+    try:
+        raw.driver_connection.backup(target)
+    finally:
+        raw.close()
+        target.close()
+
+def restore_sqlite(engine, source_path):
+    """
+    Overwrites engine's SQLite database with the database in source_path, page by page
+    through the backup API. The live files (and their WAL) stay in place, so connections
+    held by other threads remain valid and simply see the new contents.
+    Raises sqlite3.DatabaseError if source_path is not a SQLite database.
+    """
+    source = sqlite3.connect(source_path)
+    raw = engine.raw_connection()
+    try:
+        source.execute("PRAGMA schema_version").fetchone() # Fails fast on a file that isn't a database
+        source.backup(raw.driver_connection)
+    finally:
+        raw.close()
+        source.close()
+
+class BackgroundWriter:
+    """
+    Funnels background writes (email logs, campaign progress, replies) through one
+    dedicated thread that commits them in batched transactions.
+    SQLite allows a single writer at a time, so one writer with few, larger commits
+    beats many threads committing per row and fighting over the lock.
+
+    Work items are callables taking a session. When the writer is disabled (e.g. on
+    Postgres) items run inline on the caller's session and are committed right away.
+    """
+
+    def __init__(self, batch_size=200, max_delay=0.05):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.enabled = False
+        self._app = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app, enabled):
+        self._app = app
+        self.enabled = enabled
+
+    def submit(self, work):
+        """
+        Queues work(session) for the writer thread, or runs it inline when disabled.
+        """
+        if not self.enabled:
+            work(db.session)
+            db.session.commit()
+            return
+        self._ensure_started()
+        self._queue.put(work)
+
+    def add(self, obj):
+        self.submit(lambda session: session.add(obj))
+
+    def execute(self, statement):
+        self.submit(lambda session: session.execute(statement))
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def flush(self):
+        """
+        Blocks until everything submitted so far has been committed.
+        """
+        if self.enabled and self._thread is not None:
+            self._queue.join()
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get(timeout=self.max_delay))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        with self._app.app_context():
+            while True:
+                batch = self._next_batch()
+                try:
+                    self._apply(batch)
+                finally:
+                    db.session.remove()
+                    for _ in batch:
+                        self._queue.task_done()
+
+    def _apply(self, batch):
+        try:
+            for work in batch:
+                work(db.session)
+            db.session.commit()
+            return
+        except Exception as e:
+            db.session.rollback()
+            print(f"Background write batch failed, retrying items one by one: {e}")
+        # Isolate the bad item so one failure doesn't drop the whole batch
+        for work in batch:
+            try:
+                work(db.session)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Background write failed: {e}")
+
+# Shared per-process writer
+background_writer = BackgroundWriter()
+writer_queue.set_function(lambda: {(): background_writer.pending()})
@@ -1,39 +1,240 @@
 import smtplib
+import hashlib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from email.charset import Charset, QP, BASE64
+from email.generator import BytesGenerator
+from email.utils import parseaddr, formatdate, make_msgid
+from dkim_signing import signer_for
+from metrics import smtp_seconds, imap_seconds, imap_bytes_total, replies_total
+import io
 import os
+import re
 
-def send_email(smtp_settings, to_email, subject, html_content):
+EMAIL_RE = re.compile(r'^[^@\s<>(),;:"]+@[^@\s<>(),;:"]+\.[^@\s<>(),;:"]+$')
+
+def normalize_email(value):
+    """
+    Returns the canonical (trimmed, lowercase, bare) form of an address,
+    or None if it is not a plausible email address.
+    Accepts header style values like 'John <John@X.com>'.
+    """
+    if not value:
+        return None
+    value = str(value).strip()
+    if '<' in value:
+        value = parseaddr(value)[1]
+    value = value.strip().lower()
+    return value if EMAIL_RE.match(value) else None
+
+def normalize_emails(values):
+    """
+    Normalizes a batch of raw addresses in one pass.
+    Returns (valid, invalid): canonical addresses de-duplicated in first-seen order,
+    and the raw values that failed validation.
+    """
+    valid = []
+    invalid = []
+    seen = set()
+    for value in values:
+        if value is None or not str(value).strip():
+            continue
+        email = normalize_email(value)
+        if email is None:
+            invalid.append(str(value).strip())
+        elif email not in seen:
+            seen.add(email)
+            valid.append(email)
+    return valid, invalid
+
+_UTF8_QP = Charset('utf-8')
+_UTF8_QP.body_encoding = QP
+_UTF8_BASE64 = Charset('utf-8')
+_UTF8_BASE64.body_encoding = BASE64
+
+def text_part(content, subtype='html', encoding=None):
+    """
+    Builds a text/<subtype> MIME part with the given Content-Transfer-Encoding
+    ('7bit', 'quoted-printable' or 'base64'). None keeps the email package default.
+    """
+    if encoding is None:
+        return MIMEText(content, subtype)
+    # Personalization can put non-ASCII into a body built as 7bit
+    if encoding == '7bit' and not content.isascii():
+        encoding = 'quoted-printable'
+    if encoding == '7bit':
+        return MIMEText(content, subtype, 'us-ascii')
+    return MIMEText(content, subtype, _UTF8_QP if encoding == 'quoted-printable' else _UTF8_BASE64)
+
+_DOT_LINE_RE = re.compile(rb'(?m)^\.')
+_EOL_RE = re.compile(rb'\r\n|\n|\r')
+
+def serialize_message(msg, parts=None):
+    """
+    Serializes msg into (header block, body chunks), both with CRLF line endings.
+    Pre-encoded MIME parts (see attachments.encode_part) are spliced in before the
+    closing boundary of a multipart/mixed msg; the shared part buffers are
+    referenced, not copied or re-encoded.
+    """
+    buffer = io.BytesIO()
+    BytesGenerator(buffer).flatten(msg, linesep='\r\n')
+    data = _EOL_RE.sub(b'\r\n', buffer.getvalue())
+    split = data.index(b'\r\n\r\n') + 2
+    headers, body = data[:split], data[split + 2:]
+    if not parts:
+        return headers, [body]
+    boundary = msg.get_boundary().encode('ascii')
+    closing = b'--' + boundary + b'--'
+    chunks = [body[:body.rindex(closing)]]
+    for part in parts:
+        chunks.append(b'--' + boundary + b'\r\n')
+        chunks.append(part)
+        if not part.endswith(b'\r\n'):
+            chunks.append(b'\r\n')
+    chunks.append(closing + b'\r\n')
+    return headers, chunks
+
+def body_variant(*parts):
+    """
+    Identifies a rendered message body for DKIM body hash reuse: a digest of the
+    text content plus the identity of the shared attachment buffers.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, (list, tuple)):
+            digest.update(','.join(str(id(p)) for p in part).encode('ascii'))
+        else:
+            digest.update((part or '').encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def _quote_periods(chunk):
+    if chunk.startswith(b'.') or b'\n.' in chunk:
+        return _DOT_LINE_RE.sub(b'..', chunk)
+    return chunk
+
+def send_chunks(server, from_addr, to_addr, chunks):
+    """
+    Sends a message given as CRLF byte chunks with MAIL/RCPT/DATA, writing each
+    chunk straight to the socket instead of joining them into one buffer.
+    Every chunk must start at a line boundary.
+    """
+    server.ehlo_or_helo_if_needed()
+    code, resp = server.mail(from_addr)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+    code, resp = server.rcpt(to_addr)
+    if code not in (250, 251):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused({to_addr: (code, resp)})
+    code, resp = server.docmd('DATA')
+    if code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    for chunk in chunks:
+        server.send(_quote_periods(chunk))
+    server.send(b'.\r\n')
+    code, resp = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+
+def send_email(smtp_settings, to_email, subject, html_content, text_content=None,
+               html_encoding=None, text_encoding=None, attachments=None):
     """
     Sends an email using the provided SMTP settings.
-    smtp_settings: dict with 'server', 'port', 'email', 'password'
+    smtp_settings: dict with 'server', 'port', 'email', 'password',
+                   optionally 'dkim_selector', 'dkim_private_key' (and 'dkim_domain') to DKIM sign
+    text_content: optional text/plain alternative; the message becomes multipart/alternative
+    html_encoding/text_encoding: transfer encodings picked by the template build (optional)
+    attachments: optional list of pre-encoded MIME parts (bytes) shared across recipients
     """
     try:
-        msg = MIMEMultipart()
-        msg['From'] = smtp_settings['email']
-        msg['To'] = to_email
-        msg['Subject'] = subject
-
-        msg.attach(MIMEText(html_content, 'html'))
+        headers, body = build_message(smtp_settings, to_email, subject, html_content, text_content,
+                                      html_encoding, text_encoding, attachments)
 
         # Connect to server
-        if int(smtp_settings['port']) == 465:
-            server = smtplib.SMTP_SSL(smtp_settings['server'], smtp_settings['port'])
-        else:
-            server = smtplib.SMTP(smtp_settings['server'], smtp_settings['port'])
-            server.starttls()
+        with smtp_seconds.time(phase='connect', backend='smtplib'):
+            if int(smtp_settings['port']) == 465:
+                server = smtplib.SMTP_SSL(smtp_settings['server'], smtp_settings['port'])
+            else:
+                server = smtplib.SMTP(smtp_settings['server'], smtp_settings['port'])
+                server.starttls()
             
-        server.login(smtp_settings['email'], smtp_settings['password'])
+        with smtp_seconds.time(phase='login', backend='smtplib'):
+            server.login(smtp_settings['email'], smtp_settings['password'])
         
         # Send email
-        server.send_message(msg)
+        with smtp_seconds.time(phase='data', backend='smtplib'):
+            send_chunks(server, smtp_settings['email'], to_email, [headers + b'\r\n'] + body)
         server.quit()
         
         return True, "Sent successfully"
+    except smtplib.SMTPRecipientsRefused as e:
+        return False, describe_refusal(e)
     except Exception as e:
         return False, str(e)
 
-import imaplib
+def build_message(smtp_settings, to_email, subject, html_content, text_content=None,
+                  html_encoding=None, text_encoding=None, attachments=None):
+    """
+    Builds (and DKIM signs, when configured) the message send_email delivers.
+    Returns (headers, body chunks) as CRLF bytes, ready for DATA.
+    """
+    if text_content:
+        msg = MIMEMultipart('alternative')
+        msg.attach(text_part(text_content, 'plain', text_encoding))
+        msg.attach(text_part(html_content, 'html', html_encoding))
+        if attachments:
+            body, msg = msg, MIMEMultipart()
+            msg.attach(body)
+    else:
+        msg = MIMEMultipart()
+        msg.attach(text_part(html_content, 'html', html_encoding))
+    sender_domain = smtp_settings['email'].rpartition('@')[2]
+    msg['From'] = smtp_settings['email']
+    msg['To'] = to_email
+    msg['Subject'] = subject
+    msg['Date'] = formatdate(localtime=True)
+    msg['Message-ID'] = make_msgid(domain=sender_domain or 'localhost')
+
+    signer = signer_for(smtp_settings)
+    variant = None
+    if signer:
+        # Same content -> same boundaries -> byte-identical body, so its hash is computed once
+        variant = body_variant(html_content, text_content, html_encoding, text_encoding, attachments or [])
+        for i, part in enumerate(p for p in msg.walk() if p.is_multipart()):
+            part.set_boundary(f"=_{variant[:32]}_{i}")
+    headers, body = serialize_message(msg, attachments)
+    if signer:
+        headers = signer.sign(headers, body, variant) + headers
+    return headers, body
+
+HARD_BOUNCE_PREFIX = "Hard bounce"
+REFUSAL_PREFIX = "Recipient refused"
+
+def describe_refusal(error):
+    """
+    Turns an SMTPRecipientsRefused into an error message.
+    A permanent (5xx) refusal is reported with HARD_BOUNCE_PREFIX so callers can suppress the address.
+    """
+    codes = [code for code, _ in error.recipients.values()]
+    details = "; ".join(f"{rcpt}: {code} {msg.decode(errors='ignore') if isinstance(msg, bytes) else msg}"
+                        for rcpt, (code, msg) in error.recipients.items())
+    if codes and all(500 <= int(code) < 600 for code in codes):
+        return f"{HARD_BOUNCE_PREFIX} ({details})"
+    return f"{REFUSAL_PREFIX} ({details})"
+
+def is_hard_bounce(error_message):
+    return bool(error_message) and error_message.startswith(HARD_BOUNCE_PREFIX)
+
+def is_refusal(error_message):
+    """
+    True for a recipient the server refused, permanently (5xx) or not (4xx greylisting,
+    mailbox busy...): the server answered, so it says nothing about the server's health.
+    """
+    return bool(error_message) and error_message.startswith((HARD_BOUNCE_PREFIX, REFUSAL_PREFIX))
+
 import email
 from datetime import datetime, timedelta
 
@@ -47,17 +248,20 @@ def check_replies(imap_settings, campaigns=None, start_date=None, limit=200):
     limit: int (default: 200)
     Returns: list of dicts (replies), scanned_count, error_message
     """
+    import imaplib # Only the reply check needs it
     try:
-        mail = imaplib.IMAP4_SSL(imap_settings['server'])
-        mail.login(imap_settings['email'], imap_settings['password'])
-        mail.select('inbox')
+        with imap_seconds.time(operation='connect'):
+            mail = imaplib.IMAP4_SSL(imap_settings['server'])
+            mail.login(imap_settings['email'], imap_settings['password'])
+            mail.select('inbox')
 
         # Use provided start_date or default to 30 days ago
         if not start_date:
             start_date = datetime.now() - timedelta(days=30)
             
         since_date_str = start_date.strftime("%d-%b-%Y")
-        status, messages = mail.search(None, f'(SINCE "{since_date_str}")')
+        with imap_seconds.time(operation='search'):
+            status, messages = mail.search(None, f'(SINCE "{since_date_str}")')
         
         if status != 'OK':
             return [], 0, "Failed to search emails"
@@ -69,6 +273,7 @@ def check_replies(imap_settings, campaigns=None, start_date=None, limit=200):
         email_ids = all_email_ids[-limit:] if all_email_ids else []
         
         scanned_count = len(email_ids)
+        replies_total.inc(scanned_count, result='scanned')
         replies = []
         
         if not email_ids:
@@ -91,7 +296,9 @@ def check_replies(imap_settings, campaigns=None, start_date=None, limit=200):
                 # Fetch headers for the batch
                 # Note: fetch returns a list. Each email part is a tuple (response_header, data)
                 # But for multiple emails, it returns a list where items are either tuples (for found parts) or bytes (closing parens)
-                status, data = mail.fetch(batch_ids_str, '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE CC)])')
+                with imap_seconds.time(operation='headers'):
+                    status, data = mail.fetch(batch_ids_str, '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE CC)])')
+                imap_bytes_total.inc(sum(len(p[1]) for p in data if isinstance(p, tuple)), operation='headers')
                 
                 if status != 'OK':
                     print(f"Error fetching batch {batch_ids_str}")
@@ -131,8 +338,8 @@ def check_replies(imap_settings, campaigns=None, start_date=None, limit=200):
                         
                         if campaigns:
                             for campaign in campaigns:
-                                if campaign.template and campaign.template.subject:
-                                    campaign_subject = campaign.template.subject.lower()
+                                if campaign.email_subject:
+                                    campaign_subject = campaign.email_subject.lower()
                                     reply_subject = subject.lower()
                                     
                                     if campaign_subject in reply_subject:
@@ -146,7 +353,10 @@ def check_replies(imap_settings, campaigns=None, start_date=None, limit=200):
                             # Fetch full content for this specific email
                             # We still do this one by one because it's heavy and only for relevant emails
                             try:
-                                _, msg_data = mail.fetch(current_id, '(RFC822)')
+                                with imap_seconds.time(operation='body'):
+                                    _, msg_data = mail.fetch(current_id, '(RFC822)')
+                                imap_bytes_total.inc(len(msg_data[0][1]), operation='body')
+                                replies_total.inc(result='matched')
                                 msg = email.message_from_bytes(msg_data[0][1])
 
                                 sender = msg.get('From')
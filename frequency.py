@@ -0,0 +1,167 @@
+import os
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, update
+from database import db, EmailLog, RecipientSendIndex
+
+# Frequency capping: at most N campaign emails per address in a rolling window,
+# e.g. FREQUENCY_CAP="3/7d" (units: m, h, d). Checked against recipient_send_index,
+# which keeps the times of each address's latest campaign sends, so a check is one
+# primary key lookup per address however large EmailLog grows. While a cap is set, each
+# send is reserved in the index before it goes out with a conditional update, so
+# concurrent senders can't both pass the cap; otherwise the index is updated in the
+# same transaction as the EmailLog row.
+
+MAX_TRACKED = 16 # Sends remembered per address; caps above this are clamped to it
+UNITS = {'m': 60, 'h': 3600, 'd': 86400}
+
+def parse_frequency_cap(value):
+    """
+    Parses 'N/<number><m|h|d>' into (max sends, window seconds), or None if unset or invalid.
+    """
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*([mhd])\s*', value or '')
+    if not match or int(match.group(1)) < 1 or int(match.group(2)) < 1:
+        return None
+    return min(int(match.group(1)), MAX_TRACKED), int(match.group(2)) * UNITS[match.group(3)]
+
+def _epoch(when):
+    # Log times are naive UTC
+    return int(when.replace(tzinfo=timezone.utc).timestamp()) if when.tzinfo is None else int(when.timestamp())
+
+def _parse_times(recent_sends):
+    return [int(t) for t in (recent_sends or '').split()]
+
+def _dialect_insert(dialect):
+    # The dialect's own insert (for ON CONFLICT), imported from the dialect already loaded by the engine
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        insert = None
+    return insert
+
+def _swap(conn, email, current, recent_sends):
+    """
+    Sets email's recent_sends if it is still current (None: no row yet).
+    Returns False if another sender changed it first.
+    """
+    table = RecipientSendIndex.__table__
+    values = {'recent_sends': recent_sends, 'last_sent_at': datetime.utcnow()}
+    if current is not None:
+        return conn.execute(update(table).where(table.c.email == email, table.c.recent_sends == current)
+                            .values(**values)).rowcount == 1
+    insert = _dialect_insert(conn.dialect.name)
+    if insert is None:
+        conn.execute(table.insert().values(email=email, **values))
+        return True
+    return conn.execute(insert(table).values(email=email, **values).on_conflict_do_nothing()).rowcount == 1
+
+def record_send(session, email, when=None):
+    """
+    Adds a campaign send to the index. Runs on the session writing the EmailLog row.
+    """
+    when = when or datetime.utcnow()
+    row = session.get(RecipientSendIndex, email)
+    times = (_parse_times(row.recent_sends) if row else []) + [_epoch(when)]
+    recent_sends = ' '.join(str(t) for t in times[-MAX_TRACKED:])
+    if row is not None:
+        row.recent_sends = recent_sends
+        row.last_sent_at = when
+        return
+    # Another sender may add the same address meanwhile; upsert rather than fail the batch
+    insert = _dialect_insert(session.get_bind().dialect.name)
+    values = {'email': email, 'last_sent_at': when, 'recent_sends': recent_sends}
+    if insert is None:
+        session.add(RecipientSendIndex(**values))
+        return
+    session.execute(insert(RecipientSendIndex).values(**values).on_conflict_do_update(
+        index_elements=['email'], set_={'last_sent_at': when, 'recent_sends': recent_sends}))
+
+class FrequencyCap:
+    def __init__(self, max_sends=None, window_seconds=None):
+        self.max_sends = max_sends
+        self.window_seconds = window_seconds
+
+    @property
+    def enabled(self):
+        return bool(self.max_sends and self.window_seconds)
+
+    @property
+    def reason(self):
+        return f"Frequency cap: already got {self.max_sends} campaign emails in {self.window_seconds // 60} minutes"
+
+    def capped(self, emails):
+        """
+        Returns the addresses among emails that already got max_sends campaign
+        emails inside the window. One indexed query for the whole batch.
+        """
+        if not self.enabled or not emails:
+            return set()
+        cutoff = time.time() - self.window_seconds
+        rows = db.session.query(RecipientSendIndex.email, RecipientSendIndex.recent_sends).filter(
+            RecipientSendIndex.email.in_(emails)).all()
+        return {email for email, recent_sends in rows
+                if sum(1 for t in _parse_times(recent_sends) if t > cutoff) >= self.max_sends}
+
+    def reserve(self, email):
+        """
+        Counts a send to email before it goes out. Returns the Unix time recorded, or
+        None if email is at the cap (nothing is recorded then). Commits on a connection
+        of its own, so other senders see the reservation at once.
+        """
+        table = RecipientSendIndex.__table__
+        while True:
+            with db.engine.begin() as conn:
+                current = conn.execute(select(table.c.recent_sends).where(table.c.email == email)).scalar()
+                now = int(time.time())
+                times = _parse_times(current)
+                if sum(1 for t in times if t > now - self.window_seconds) >= self.max_sends:
+                    return None
+                # Lost the race only if another sender recorded a send first: count again
+                if _swap(conn, email, current, ' '.join(str(t) for t in (times + [now])[-MAX_TRACKED:])):
+                    return now
+
+    def release(self, email, reserved):
+        """
+        Takes back a reservation whose send failed.
+        """
+        table = RecipientSendIndex.__table__
+        while True:
+            with db.engine.begin() as conn:
+                current = conn.execute(select(table.c.recent_sends).where(table.c.email == email)).scalar()
+                times = _parse_times(current)
+                if reserved not in times:
+                    return
+                times.remove(reserved)
+                if _swap(conn, email, current, ' '.join(str(t) for t in times)):
+                    return
+
+# Process wide policy from FREQUENCY_CAP (off when unset)
+frequency_cap = FrequencyCap(*(parse_frequency_cap(os.environ.get('FREQUENCY_CAP')) or (None, None)))
+
+def backfill_send_index(since_days=90, batch_size=1000):
+    """
+    Builds the index from the EmailLog campaign sends of the last since_days days,
+    a batch of addresses at a time. Used by the migration that added it. Does not commit.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=since_days)
+    last_email = ''
+    while True:
+        emails = [row[0] for row in db.session.query(EmailLog.recipient_email).filter(
+            EmailLog.type == 'campaign', EmailLog.status == 'sent', EmailLog.recipient_email > last_email
+        ).distinct().order_by(EmailLog.recipient_email).limit(batch_size)]
+        if not emails:
+            return
+        sends = {}
+        for email, sent_at in db.session.query(EmailLog.recipient_email, EmailLog.sent_at).filter(
+                EmailLog.recipient_email.in_(emails), EmailLog.type == 'campaign', EmailLog.status == 'sent',
+                EmailLog.sent_at >= cutoff).order_by(EmailLog.sent_at):
+            sends.setdefault(email, []).append(sent_at)
+        for email, times in sends.items():
+            if db.session.get(RecipientSendIndex, email) is None:
+                db.session.add(RecipientSendIndex(email=email, last_sent_at=times[-1],
+                    recent_sends=' '.join(str(_epoch(t)) for t in times[-MAX_TRACKED:])))
+        db.session.flush()
+        last_email = emails[-1]
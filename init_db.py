@@ -1,5 +1,42 @@
-from app import app, db
+import argparse
+import sys
+from database import db, User
+from migrations import MIGRATIONS, applied_versions, run_migrations
 
-with app.app_context():
-    db.create_all()
+# One-shot database setup, kept out of app startup so web and worker processes don't
+# repeat it (and race each other) at every boot. Run it once per deploy, before the
+# web processes start (the Procfile release phase does):
+#   python init_db.py           create tables, apply migrations, create the default admin
+#   python init_db.py --check   exit 1 if migrations are pending, without changing anything
+
+def init_database(app):
+    """
+    Creates missing tables, applies pending migrations (each runs once, see migrations.py),
+    and creates the default admin user. Safe to run again. Campaigns left 'sending' are
+    not touched: the web processes resume them once their lease lapses (see recovery.py).
+    """
+    with app.app_context():
+        db.create_all()
+        # Create default admin user if not exists
+        if not User.query.filter_by(username='admin').first():
+            db.session.add(User(username='admin', password='adminpassword'))
+            db.session.commit()
+        run_migrations()
+
+def pending_migrations(app):
+    with app.app_context():
+        applied = applied_versions()
+        return [name for version, name, _ in MIGRATIONS if version not in applied]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create or upgrade the database.")
+    parser.add_argument('--check', action='store_true', help="only report pending migrations (exit 1 if any)")
+    args = parser.parse_args()
+
+    from app import app
+    if args.check:
+        pending = pending_migrations(app)
+        print(f"Pending migrations: {', '.join(pending)}" if pending else "Database is up to date.")
+        sys.exit(1 if pending else 0)
+    init_database(app)
     print("Database tables created successfully.")
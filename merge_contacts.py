@@ -0,0 +1,7 @@
+from app import app
+from audience import merge_duplicate_contacts
+
+# One-off job: canonicalize contact emails and merge case/whitespace duplicates
+with app.app_context():
+    merged, renamed = merge_duplicate_contacts()
+    print(f"Merged {merged} duplicate contacts, normalized {renamed} email addresses.")
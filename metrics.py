@@ -0,0 +1,241 @@
+import bisect
+import hmac
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# In-process metrics in the Prometheus text format, served at /metrics by the web app
+# and by sender_worker.py --metrics-port. Each process keeps its own numbers; scrape
+# every process. Recording is a dict update under a per-metric lock, cheap enough for
+# the send loop.
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN') # Bearer token; without one only local scrapes are answered
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        """
+        Yields (suffix, label values, extra labels, value) for rendering.
+        """
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield '', key, (), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. With set_function the value is read at scrape
+    time instead: the function returns {label values tuple: value}.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def samples(self):
+        if self._function is None:
+            yield from super().samples()
+            return
+        for key, value in self._function().items():
+            yield '', tuple(str(v) for v in key), (), value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # Per bucket counts (the last one is +Inf), then the sum
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', key, (('le', _format_value(bound)),), cumulative
+            yield '_sum', key, (), total
+            yield '_count', key, (), cumulative
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        parts = []
+        for metric in self._metrics:
+            try:
+                parts.append(metric.render())
+            except Exception as e:
+                # One broken collector (e.g. the database is down) must not hide the rest
+                print(f"Metrics: could not collect {metric.name}: {e}")
+        return '\n'.join(parts) + '\n'
+
+registry = Registry()
+
+def counter(name, documentation, labelnames=()):
+    return registry.register(Counter(name, documentation, labelnames))
+
+def gauge(name, documentation, labelnames=()):
+    return registry.register(Gauge(name, documentation, labelnames))
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+# ---------------------------------------------------------------------------
+# Pipeline metrics
+# ---------------------------------------------------------------------------
+
+emails_total = counter('mailer_emails_total', "Emails handled, by outcome (sent, failed, suppressed, capped).",
+                       ['status', 'server', 'campaign', 'type'])
+smtp_seconds = histogram('mailer_smtp_duration_seconds', "SMTP session time by phase (connect includes TLS).",
+                         ['phase', 'backend'])
+queue_recipients = gauge('mailer_queue_recipients', "Recipients of sending campaigns by queue status.",
+                         ['campaign', 'status'])
+writer_queue = gauge('mailer_db_writer_queue', "Work items waiting for the background DB writer.")
+db_commit_seconds = histogram('mailer_db_commit_seconds', "Session commit time, including the flush.")
+imap_seconds = histogram('mailer_imap_duration_seconds', "IMAP time by operation (connect, search, headers, body).",
+                         ['operation'])
+imap_bytes_total = counter('mailer_imap_fetched_bytes_total', "Bytes fetched from IMAP.", ['operation'])
+replies_total = counter('mailer_replies_total', "Messages seen by reply checks, by result (scanned, matched, new).",
+                        ['result'])
+
+def instrument_sessions(session_class):
+    """
+    Times every commit of sessions of session_class (and its subclasses).
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(session_class, 'before_commit')
+    def start_commit_timer(session):
+        session.info['commit_started'] = time.perf_counter()
+
+    @event.listens_for(session_class, 'after_commit')
+    def stop_commit_timer(session):
+        started = session.info.pop('commit_started', None)
+        if started is not None:
+            db_commit_seconds.observe(time.perf_counter() - started)
+
+    @event.listens_for(session_class, 'after_rollback')
+    def clear_commit_timer(session):
+        session.info.pop('commit_started', None)
+
+# ---------------------------------------------------------------------------
+# Exposition
+# ---------------------------------------------------------------------------
+
+# Set by reverse proxies; a loopback request carrying one came from outside
+FORWARDED_HEADERS = ('X-Forwarded-For', 'X-Real-IP', 'Forwarded')
+
+def authorized(authorization, remote_addr, headers=None):
+    """
+    Checks a scrape: the METRICS_TOKEN bearer token when one is set, else a loopback
+    client that didn't come through a proxy.
+    """
+    if METRICS_TOKEN:
+        return hmac.compare_digest(authorization or '', f"Bearer {METRICS_TOKEN}")
+    if headers is not None and any(headers.get(name) for name in FORWARDED_HEADERS):
+        return False
+    return remote_addr in ('127.0.0.1', '::1')
+
+def serve(port, app, host='0.0.0.0'):
+    """
+    Serves /metrics on its own port from a daemon thread, for processes without a web app.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            if not authorized(self.headers.get('Authorization'), self.client_address[0], self.headers):
+                self.send_error(403)
+                return
+            with app.app_context():
+                body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
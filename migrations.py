@@ -0,0 +1,182 @@
+import warnings
+from datetime import datetime
+from sqlalchemy import text, inspect
+from database import db
+
+# Versioned schema migrations.
+# Each migration runs once, in order, inside its own transaction, and is recorded in
+# the schema_version table. Migrations are written to be idempotent so a database
+# created by db.create_all() (which already has the latest columns and indexes) can
+# run them safely on first start.
+
+def _has_column(conn, table, column):
+    return column in [c['name'] for c in inspect(conn).get_columns(table)]
+
+def _add_column(conn, table, column, ddl):
+    if not _has_column(conn, table, column):
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+def add_campaign_error_message(conn):
+    _add_column(conn, 'campaign', 'error_message', 'TEXT')
+
+def add_campaign_segment_id(conn):
+    _add_column(conn, 'campaign', 'segment_id', 'INTEGER REFERENCES segment(id)')
+
+def _create_indexes(conn, *names):
+    """
+    Creates the named indexes (as declared on the models) if they don't exist yet.
+    Indexes are listed by name so a migration never touches columns added by later ones.
+    """
+    indexes = {index.name: index for table in db.metadata.sorted_tables for index in table.indexes}
+    with warnings.catch_warnings():
+        # checkfirst reflects the table's indexes, and can't read ix_contact_email_lower's expression
+        warnings.filterwarnings('ignore', 'Skipped unsupported reflection of expression-based index')
+        for name in names:
+            indexes[name].create(bind=conn, checkfirst=True)
+
+def create_performance_indexes(conn):
+    _create_indexes(conn,
+        'ix_contact_group_association_group_id',
+        'ix_contact_status_id', 'ix_contact_created_at',
+        'ix_campaign_status', 'ix_campaign_created_at', 'ix_campaign_name',
+        'ix_email_log_status_sent_at', 'ix_email_log_type_status',
+        'ix_email_log_campaign_id_status', 'ix_email_log_recipient_email',
+        'ix_reply_received_at', 'ix_reply_server_id_received_at', 'ix_reply_campaign_id',
+        'ix_reply_contact_id', 'ix_reply_sender_email_subject',
+    )
+
+def backfill_contact_tags(conn):
+    from audience import backfill_tags
+    backfill_tags(commit=False)
+
+def seed_suppression_list(conn):
+    from suppression import seed_from_contacts
+    seed_from_contacts(commit=False)
+
+def canonicalize_contact_emails(conn):
+    from audience import merge_duplicate_contacts
+    merge_duplicate_contacts(commit=False)
+
+def add_template_content_hash(conn):
+    from template_registry import content_hash
+    _add_column(conn, 'template', 'content_hash', 'VARCHAR(64)')
+    rows = conn.execute(text("SELECT id, content FROM template WHERE content_hash IS NULL")).all()
+    for template_id, content in rows:
+        conn.execute(text("UPDATE template SET content_hash = :h WHERE id = :id"), {'h': content_hash(content), 'id': template_id})
+    _create_indexes(conn, 'ix_template_content_hash')
+
+def add_campaign_subject(conn):
+    _add_column(conn, 'campaign', 'subject', 'VARCHAR(200)')
+
+def add_server_dkim(conn):
+    _add_column(conn, 'server', 'dkim_selector', 'VARCHAR(63)')
+    _add_column(conn, 'server', 'dkim_private_key', 'TEXT')
+
+def add_scheduling_columns(conn):
+    _add_column(conn, 'campaign', 'priority', 'INTEGER DEFAULT 0')
+    _add_column(conn, 'campaign', 'weight', 'INTEGER DEFAULT 1')
+    _add_column(conn, 'server', 'max_connections', 'INTEGER DEFAULT 1')
+    _add_column(conn, 'server', 'max_per_minute', 'INTEGER')
+
+def add_recipient_planning_columns(conn):
+    _add_column(conn, 'campaign_recipient', 'domain', 'VARCHAR(255)')
+    _add_column(conn, 'campaign_recipient', 'send_order', 'FLOAT')
+    _add_column(conn, 'campaign_recipient', 'defer_until', 'TIMESTAMP')
+    conn.execute(text("DROP INDEX IF EXISTS ix_campaign_recipient_claim"))
+    _create_indexes(conn, 'ix_campaign_recipient_order')
+
+def build_recipient_send_index(conn):
+    from frequency import backfill_send_index
+    backfill_send_index()
+
+def reply_inbox_indexes(conn):
+    from reply_search import install
+    _create_indexes(conn, 'ix_reply_campaign_id_received_at', 'ix_reply_is_read_received_at')
+    install(conn)
+
+def add_tracking_columns(conn):
+    for column in ('open_count', 'unique_open_count', 'click_count', 'unique_click_count'):
+        _add_column(conn, 'campaign', column, 'INTEGER DEFAULT 0')
+    _add_column(conn, 'campaign_recipient', 'opened_at', 'TIMESTAMP')
+    _add_column(conn, 'campaign_recipient', 'clicked_at', 'TIMESTAMP')
+
+def add_campaign_sender_lease(conn):
+    _add_column(conn, 'campaign', 'sender', 'VARCHAR(200)')
+    _add_column(conn, 'campaign', 'sender_lease_until', 'TIMESTAMP')
+
+def suppression_created_at_index(conn):
+    _create_indexes(conn, 'ix_suppression_created_at')
+
+def contact_email_lower_unique(conn):
+    # Collapse case variants first, or creating the index fails on them
+    from audience import merge_duplicate_contacts
+    merge_duplicate_contacts(commit=False)
+    # checkfirst doesn't see expression indexes, so say IF NOT EXISTS
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_contact_email_lower ON contact (lower(email))"))
+
+def shared_send_limits(conn):
+    # The server_lease and domain_pace tables are new, so create_all() makes them
+    _add_column(conn, 'server', 'pace_next', 'FLOAT')
+
+MIGRATIONS = [
+    (1, 'campaign_error_message', add_campaign_error_message),
+    (2, 'campaign_segment_id', add_campaign_segment_id),
+    (3, 'performance_indexes', create_performance_indexes),
+    (4, 'backfill_contact_tags', backfill_contact_tags),
+    (5, 'canonicalize_contact_emails', canonicalize_contact_emails),
+    (6, 'seed_suppression_list', seed_suppression_list),
+    (7, 'template_content_hash', add_template_content_hash),
+    (8, 'campaign_subject', add_campaign_subject),
+    (9, 'server_dkim', add_server_dkim),
+    (10, 'scheduling_columns', add_scheduling_columns),
+    (11, 'recipient_planning_columns', add_recipient_planning_columns),
+    (12, 'recipient_send_index', build_recipient_send_index),
+    (13, 'reply_inbox_indexes', reply_inbox_indexes),
+    (14, 'tracking_columns', add_tracking_columns),
+    (15, 'campaign_sender_lease', add_campaign_sender_lease),
+    (16, 'suppression_created_at_index', suppression_created_at_index),
+    (17, 'contact_email_lower_unique', contact_email_lower_unique),
+    (18, 'shared_send_limits', shared_send_limits),
+]
+
+def _ensure_version_table(conn):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        "version INTEGER PRIMARY KEY, "
+        "name VARCHAR(100) NOT NULL, "
+        "applied_at TIMESTAMP NOT NULL)"
+    ))
+
+def applied_versions():
+    with db.engine.begin() as conn:
+        _ensure_version_table(conn)
+        return {row[0] for row in conn.execute(text("SELECT version FROM schema_version"))}
+
+def run_migrations():
+    """
+    Applies pending migrations in order. Must run inside an app context.
+    On Postgres an advisory lock serializes concurrent runs (e.g. several gunicorn
+    workers booting at once); on SQLite the write transaction itself does.
+    Returns the list of applied migration names.
+    """
+    applied = []
+    pending = [m for m in MIGRATIONS if m[0] not in applied_versions()]
+    for version, name, migrate in pending:
+        conn = db.session.connection()
+        if conn.dialect.name == 'postgresql':
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': 7343001})
+        # Another process may have applied it while we waited for the lock
+        if conn.execute(text("SELECT 1 FROM schema_version WHERE version = :v"), {'v': version}).first():
+            db.session.rollback()
+            continue
+        try:
+            migrate(conn)
+            conn.execute(text("INSERT INTO schema_version (version, name, applied_at) VALUES (:v, :n, :t)"),
+                         {'v': version, 'n': name, 't': datetime.utcnow()})
+            db.session.commit()
+            applied.append(name)
+            print(f"Applied migration {version}: {name}")
+        except Exception:
+            db.session.rollback()
+            raise
+    return applied
@@ -0,0 +1,133 @@
+import cProfile
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from flask import request
+
+# Opt-in request profiling (PROFILING=1). Every request is timed together with the SQL
+# it ran, counted through SQLAlchemy engine events, and logged as one line:
+#   [profile] GET /contacts contacts 200 84.1ms sql=37 (51.3ms)
+# Statements slower than SLOW_QUERY_MS are logged with their parameters (from any
+# thread, so sender workers are covered too), and a statement repeated
+# N_PLUS_ONE_THRESHOLD times in one request is flagged as a likely N+1 pattern.
+# With PROFILE_SAMPLE_RATE > 0 that share of requests also runs under cProfile and the
+# stats are written to PROFILE_DIR/<endpoint>-<time>.prof (open with pstats or snakeviz).
+
+PROFILING = os.environ.get('PROFILING', '0') == '1'
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 0)) # Only log requests slower than this
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 10))
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+MAX_LOGGED_CHARS = 500
+
+def _shorten(text, limit=MAX_LOGGED_CHARS):
+    text = re.sub(r'\s+', ' ', str(text)).strip()
+    return text if len(text) <= limit else text[:limit] + '...'
+
+def _describe_params(parameters, executemany):
+    if executemany and isinstance(parameters, (list, tuple)):
+        first = parameters[0] if parameters else None
+        return f"{len(parameters)} rows, first {_shorten(repr(first))}"
+    return _shorten(repr(parameters))
+
+class _RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.repeated = Counter()
+        self.profiler = None
+
+class RequestProfiler:
+    """
+    Per-request wall time and SQL accounting plus a slow query log.
+    State lives in a thread local: a request is served by one thread, and so are the
+    statements it executes.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def init_app(self, app, engine):
+        from sqlalchemy import event
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        event.listen(engine, 'handle_error', self._on_error)
+        print(f"Request profiling on (slow queries > {SLOW_QUERY_MS:g}ms, sample rate {PROFILE_SAMPLE_RATE:g}).")
+
+    # Requests
+
+    def _before_request(self):
+        stats = self._local.request = _RequestStats()
+        if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+            stats.profiler = cProfile.Profile()
+            stats.profiler.enable()
+
+    def _after_request(self, response):
+        stats = getattr(self._local, 'request', None)
+        if stats is not None:
+            elapsed_ms = (time.perf_counter() - stats.started) * 1000
+            sql_ms = stats.sql_seconds * 1000
+            response.headers['Server-Timing'] = (f'app;dur={elapsed_ms:.1f}, '
+                                                 f'sql;dur={sql_ms:.1f};desc="{stats.statements} queries"')
+            if elapsed_ms >= SLOW_REQUEST_MS:
+                print(f"[profile] {request.method} {request.path} {request.endpoint} {response.status_code} "
+                      f"{elapsed_ms:.1f}ms sql={stats.statements} ({sql_ms:.1f}ms)")
+        return response
+
+    def _teardown_request(self, error=None):
+        stats = getattr(self._local, 'request', None)
+        self._local.request = None
+        if stats is None:
+            return
+        for statement, count in stats.repeated.items():
+            if count >= N_PLUS_ONE_THRESHOLD:
+                print(f"[profile] possible N+1 in {request.endpoint}: {count}x {_shorten(statement, 200)}")
+        if stats.profiler is not None:
+            stats.profiler.disable()
+            self._dump(stats.profiler)
+
+    def _dump(self, profiler):
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            name = re.sub(r'[^A-Za-z0-9_.-]', '_', request.endpoint or 'unknown')
+            path = os.path.join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.prof")
+            profiler.dump_stats(path)
+            print(f"[profile] wrote {path}")
+        except Exception as e:
+            print(f"[profile] could not write profile: {e}")
+
+    # Statements
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_started'].pop()
+        seconds = time.perf_counter() - started
+        stats = getattr(self._local, 'request', None)
+        if stats is not None:
+            stats.statements += 1
+            stats.sql_seconds += seconds
+            # Statements come with bound parameters, so a loop of lookups repeats the same text
+            stats.repeated[statement] += 1
+        if seconds * 1000 >= SLOW_QUERY_MS:
+            where = f"{request.endpoint}" if stats is not None else threading.current_thread().name
+            print(f"[profile] slow query ({seconds * 1000:.1f}ms, {where}): {_shorten(statement)} "
+                  f"params={_describe_params(parameters, executemany)}")
+
+    def _on_error(self, exception_context):
+        # A failed statement never reaches after_cursor_execute
+        conn = exception_context.connection
+        if conn is not None and conn.info.get('query_started'):
+            conn.info['query_started'].pop()
+
+# Shared per-process profiler, installed by the app when PROFILING=1
+request_profiler = RequestProfiler()
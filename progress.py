@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import deque
+
+class CampaignProgress:
+    """
+    Live counters for one sending campaign.
+    Throughput is measured over a sliding window so the ETA follows the current rate.
+    """
+
+    WINDOW_SECONDS = 30
+
+    def __init__(self, campaign_id, total):
+        self.campaign_id = campaign_id
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.suppressed = 0
+        self.status = 'sending'
+        self.error_message = None
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self._samples = deque([(self.started_at, 0)])
+
+    @property
+    def processed(self):
+        return self.sent + self.failed + self.suppressed
+
+    def sample(self, now):
+        self._samples.append((now, self.processed))
+        while len(self._samples) > 2 and now - self._samples[0][0] > self.WINDOW_SECONDS:
+            self._samples.popleft()
+
+    def throughput(self, now):
+        """
+        Emails processed per second over the window (0 until there are two samples).
+        """
+        first_time, first_count = self._samples[0]
+        elapsed = now - first_time
+        if elapsed <= 0:
+            return 0.0
+        return (self.processed - first_count) / elapsed
+
+    def as_dict(self, now=None):
+        now = now or time.monotonic()
+        total = self.total if self.total > 0 else 1
+        rate = self.throughput(now) if self.status == 'sending' else 0.0
+        remaining = max(self.total - self.processed, 0)
+        return {
+            'id': self.campaign_id,
+            'status': self.status,
+            'sent': self.sent,
+            'failed': self.failed,
+            'suppressed': self.suppressed,
+            'total': total,
+            'progress': round(self.sent / total * 100, 1),
+            'rate': round(rate, 2),
+            'eta': round(remaining / rate) if rate > 0 and self.status == 'sending' else None,
+            'elapsed': round((self.finished_at or now) - self.started_at),
+            'error_message': self.error_message,
+        }
+
+class ProgressRegistry:
+    """
+    In-memory progress of the campaigns being sent by this process.
+    Senders update counters in place (no DB round trip); readers such as the SSE
+    stream block on wait() until something changes instead of polling.
+    Finished campaigns stay visible for keep_finished seconds so clients see the final state.
+    """
+
+    def __init__(self, keep_finished=120):
+        self.keep_finished = keep_finished
+        self._campaigns = {}
+        self._version = 0
+        self._changed = threading.Condition()
+
+    def _touch(self):
+        self._version += 1
+        self._changed.notify_all()
+
+    def start(self, campaign_id, total):
+        with self._changed:
+            self._campaigns[campaign_id] = CampaignProgress(campaign_id, total)
+            self._touch()
+
+    def record(self, campaign_id, sent=0, failed=0, suppressed=0):
+        with self._changed:
+            progress = self._campaigns.get(campaign_id)
+            if progress is None:
+                return
+            progress.sent += sent
+            progress.failed += failed
+            progress.suppressed += suppressed
+            progress.sample(time.monotonic())
+            self._touch()
+
+    def finish(self, campaign_id, status, error_message=None):
+        with self._changed:
+            progress = self._campaigns.get(campaign_id)
+            if progress is None:
+                return
+            progress.status = status
+            progress.error_message = error_message
+            progress.finished_at = time.monotonic()
+            self._touch()
+
+    def get(self, campaign_id):
+        with self._changed:
+            progress = self._campaigns.get(campaign_id)
+            return progress.as_dict() if progress else None
+
+    def snapshot(self):
+        """
+        Returns (version, [progress dicts]) and forgets campaigns finished long ago.
+        """
+        now = time.monotonic()
+        with self._changed:
+            for campaign_id, progress in list(self._campaigns.items()):
+                if progress.finished_at and now - progress.finished_at > self.keep_finished:
+                    del self._campaigns[campaign_id]
+            return self._version, [p.as_dict(now) for p in self._campaigns.values()]
+
+    def wait(self, version, timeout):
+        """
+        Blocks until the registry version differs from version or timeout expires.
+        Returns the current version.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self._version != version, timeout)
+            return self._version
+
+# Shared per-process registry
+progress_registry = ProgressRegistry()
@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import or_, update
+from database import db, Campaign, CampaignRecipient as CR
+from sender import run_campaign, worker_name, CLAIM_LEASE_SECONDS
+
+# Recovery of campaigns sent by web threads (SENDER_MODE=thread). Such a campaign is sent
+# by a thread of the process that started it, which holds a lease on the campaign
+# (campaign.sender / sender_lease_until) and renews it every LEASE_SECONDS / 4. At the
+# same pace every web process
+#   - puts recipients back in the queue whose claim lease lapsed (their sender died mid-batch);
+#   - adopts 'sending' campaigns whose lease lapsed (their process crashed or restarted)
+#     and sends them on from where they stopped.
+# Campaigns of live processes are never touched, so a deploy overlapping running sends
+# is safe, and a crash or restart resumes its campaigns within about LEASE_SECONDS.
+
+LEASE_SECONDS = int(os.environ.get('SENDER_CAMPAIGN_LEASE', 120))
+
+class CampaignRecovery:
+    def __init__(self, lease_seconds=LEASE_SECONDS):
+        self.lease_seconds = lease_seconds
+        self.enabled = False
+        self.worker = worker_name()
+        self._app = None
+        self._running = {} # campaign id -> stop event of its sending thread
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def init_app(self, app):
+        """
+        In thread mode, starts checking with the first request, so processes that only
+        import the app (init_db.py, scripts) never adopt campaigns.
+        """
+        self._app = app
+        self.enabled = app.config['SENDER_MODE'] == 'thread'
+        if self.enabled:
+            app.before_request(self.ensure_started)
+
+    def lease(self, campaign):
+        """
+        Takes the lease of a campaign this process is about to send. Does not commit.
+        """
+        campaign.sender = self.worker
+        campaign.sender_lease_until = datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+
+    def start(self, campaign_id):
+        """
+        Sends a leased campaign from a new thread. Returns False if one already sends it.
+        """
+        stop = threading.Event()
+        with self._lock:
+            if campaign_id in self._running:
+                return False
+            self._running[campaign_id] = stop
+        threading.Thread(target=self._send, args=(campaign_id, stop), name=f'campaign-{campaign_id}', daemon=True).start()
+        self.ensure_started()
+        return True
+
+    def _send(self, campaign_id, stop):
+        with self._app.app_context():
+            try:
+                run_campaign(campaign_id, self.worker, stop=stop)
+            finally:
+                with self._lock:
+                    self._running.pop(campaign_id, None)
+                try:
+                    db.session.execute(update(Campaign).where(Campaign.id == campaign_id, Campaign.sender == self.worker)
+                                       .values(sender=None, sender_lease_until=None))
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Could not release the lease of campaign {campaign_id}, it will lapse: {e}")
+                finally:
+                    db.session.remove()
+
+    def ensure_started(self):
+        if not self.enabled or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='campaign-recovery', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        with self._app.app_context():
+            while True:
+                try:
+                    self.step()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Campaign recovery check failed: {e}")
+                finally:
+                    db.session.remove()
+                time.sleep(self.lease_seconds / 4)
+
+    def step(self):
+        """
+        Renews this process's leases, requeues lapsed recipient claims and adopts
+        campaigns whose lease lapsed. Returns the ids of the adopted campaigns.
+        """
+        now = datetime.utcnow()
+        until = now + timedelta(seconds=self.lease_seconds)
+        with self._lock:
+            running = dict(self._running)
+        if running:
+            owned = {campaign_id for (campaign_id,) in db.session.query(Campaign.id).filter(
+                Campaign.id.in_(running), Campaign.sender == self.worker)}
+            if owned:
+                db.session.execute(update(Campaign).where(Campaign.id.in_(owned)).values(sender_lease_until=until))
+            for campaign_id in set(running) - owned:
+                # Adopted elsewhere after this process stalled past its lease: leave it to them
+                print(f"Lost the lease of campaign {campaign_id}, stopping its sender.")
+                running[campaign_id].set()
+        stale = now - timedelta(seconds=CLAIM_LEASE_SECONDS)
+        requeued = db.session.execute(update(CR).where(CR.status == 'claimed', CR.claimed_at < stale)
+                                      .values(status='pending', claimed_by=None, claim_token=None, claimed_at=None)).rowcount
+        db.session.commit()
+        if requeued:
+            print(f"Requeued {requeued} recipients whose claim lapsed.")
+
+        lapsed = or_(Campaign.sender_lease_until.is_(None), Campaign.sender_lease_until < now)
+        adopted = []
+        for (campaign_id,) in db.session.query(Campaign.id).filter(Campaign.status == 'sending', lapsed).all():
+            # Conditional, so only one process adopts a campaign
+            taken = db.session.execute(update(Campaign).where(Campaign.id == campaign_id, Campaign.status == 'sending', lapsed)
+                                       .values(sender=self.worker, sender_lease_until=until)).rowcount
+            db.session.commit()
+            if taken and self.start(campaign_id):
+                print(f"Resuming campaign {campaign_id}: its sender stopped renewing its lease.")
+                adopted.append(campaign_id)
+        return adopted
+
+# Shared per-process instance
+campaign_recovery = CampaignRecovery()
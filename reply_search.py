@@ -0,0 +1,139 @@
+from datetime import datetime
+from sqlalchemy import text, tuple_, and_, or_
+from sqlalchemy.exc import OperationalError
+from database import Reply
+
+# Replies inbox queries: full text search over subject, sender and body, and keyset
+# pagination on (received_at, id) so a page costs the same at row 50 and row 1M.
+#
+# SQLite: reply_fts is an external content FTS5 table over the reply table (it stores
+# only the index, not a second copy of the text), kept current by triggers.
+# Postgres: a GIN index over a tsvector expression, matched with websearch_to_tsquery.
+# Other databases, or SQLite builds without FTS5, fall back to a LIKE scan.
+
+PAGE_SIZE = 50
+
+# Searches matching at least this many replies walk the inbox in date order and probe
+# the full text index per row (a page fills up quickly); rarer ones are driven from the
+# index and sort only their matches
+COMMON_MATCHES = 1000
+
+# 'simple' does no stemming, so words match in any language replies are written in
+TSVECTOR = ("to_tsvector('simple', coalesce(subject, '') || ' ' || coalesce(sender_email, '') "
+            "|| ' ' || coalesce(content, ''))")
+
+SQLITE_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS reply_fts_insert AFTER INSERT ON reply BEGIN
+        INSERT INTO reply_fts(rowid, subject, sender_email, content)
+        VALUES (new.id, new.subject, new.sender_email, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS reply_fts_delete AFTER DELETE ON reply BEGIN
+        INSERT INTO reply_fts(reply_fts, rowid, subject, sender_email, content)
+        VALUES ('delete', old.id, old.subject, old.sender_email, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS reply_fts_update AFTER UPDATE OF subject, sender_email, content ON reply BEGIN
+        INSERT INTO reply_fts(reply_fts, rowid, subject, sender_email, content)
+        VALUES ('delete', old.id, old.subject, old.sender_email, old.content);
+        INSERT INTO reply_fts(rowid, subject, sender_email, content)
+        VALUES (new.id, new.subject, new.sender_email, new.content);
+    END""",
+]
+
+_fts_available = {} # engine url -> bool
+
+def install(conn):
+    """
+    Creates the search index for the connection's database and indexes existing replies.
+    Safe to run again.
+    """
+    dialect = conn.dialect.name
+    if dialect == 'sqlite':
+        try:
+            conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS reply_fts USING fts5("
+                              "subject, sender_email, content, content='reply', content_rowid='id', "
+                              "tokenize='unicode61 remove_diacritics 2')"))
+        except OperationalError as e:
+            print(f"Reply search index not created, searches will scan the reply table: {e}")
+            return
+        for trigger in SQLITE_TRIGGERS:
+            conn.execute(text(trigger))
+        conn.execute(text("INSERT INTO reply_fts(reply_fts) VALUES ('rebuild')"))
+    elif dialect == 'postgresql':
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_reply_search ON reply USING gin ({TSVECTOR})"))
+    _fts_available.pop(str(conn.engine.url), None)
+
+def _has_fts(session):
+    bind = session.get_bind()
+    key = str(bind.url)
+    if key not in _fts_available:
+        if bind.dialect.name == 'sqlite':
+            _fts_available[key] = session.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'reply_fts'")).first() is not None
+        else:
+            _fts_available[key] = bind.dialect.name == 'postgresql'
+    return _fts_available[key]
+
+def fts5_query(terms):
+    """
+    Turns free text into an FTS5 query: every word must match, each quoted so punctuation
+    in the input (quotes, @, -, *) can't break the query syntax.
+    """
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in terms.split())
+
+def search_filter(session, terms):
+    """
+    A WHERE clause matching replies whose subject, sender or body contain every word of terms.
+    """
+    dialect = session.get_bind().dialect.name
+    if _has_fts(session):
+        if dialect == 'sqlite':
+            fts_query = fts5_query(terms)
+            matches = session.execute(text(
+                "SELECT count(*) FROM (SELECT rowid FROM reply_fts WHERE reply_fts MATCH :q LIMIT :n)"),
+                {'q': fts_query, 'n': COMMON_MATCHES}).scalar()
+            if matches < COMMON_MATCHES:
+                return Reply.id.in_(text("SELECT rowid FROM reply_fts WHERE reply_fts MATCH :fts_query")
+                                    .bindparams(fts_query=fts_query))
+            return text("EXISTS (SELECT 1 FROM reply_fts WHERE reply_fts MATCH :fts_query "
+                        "AND reply_fts.rowid = reply.id)").bindparams(fts_query=fts_query)
+        return text(f"{TSVECTOR} @@ websearch_to_tsquery('simple', :ts_query)").bindparams(ts_query=terms)
+    return and_(*[or_(Reply.subject.ilike(f'%{word}%'), Reply.sender_email.ilike(f'%{word}%'),
+                      Reply.content.ilike(f'%{word}%')) for word in terms.split()])
+
+def encode_cursor(reply):
+    return f"{reply.received_at:%Y-%m-%dT%H:%M:%S.%f}_{reply.id}"
+
+def decode_cursor(cursor):
+    """
+    (received_at, id) from a cursor, or None if it is malformed.
+    """
+    try:
+        received_at, reply_id = cursor.rsplit('_', 1)
+        return datetime.strptime(received_at, '%Y-%m-%dT%H:%M:%S.%f'), int(reply_id)
+    except (AttributeError, ValueError):
+        return None
+
+def keyset_page(query, before=None, after=None, size=PAGE_SIZE):
+    """
+    One page of query, newest first. before / after are cursors of the last row of the
+    previous page (older rows) or the first row of the next page (newer rows).
+    Returns (rows, older cursor or None, newer cursor or None).
+    """
+    key = tuple_(Reply.received_at, Reply.id)
+    after_key = decode_cursor(after) if after else None
+    before_key = decode_cursor(before) if before else None
+    if after_key:
+        rows = query.filter(key > after_key).order_by(Reply.received_at.asc(), Reply.id.asc()).limit(size + 1).all()
+        more_newer = len(rows) > size
+        rows = rows[:size][::-1]
+        more_older = True
+    else:
+        if before_key:
+            query = query.filter(key < before_key)
+        rows = query.order_by(Reply.received_at.desc(), Reply.id.desc()).limit(size + 1).all()
+        more_older = len(rows) > size
+        rows = rows[:size]
+        more_newer = before_key is not None
+    older = encode_cursor(rows[-1]) if rows and more_older else None
+    newer = encode_cursor(rows[0]) if rows and more_newer else None
+    return rows, older, newer
@@ -0,0 +1,132 @@
+import glob
+import gzip
+import json
+import os
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from itertools import takewhile
+from database import db, EmailLog, EmailLogDaily
+
+# EmailLog retention. Rows older than EMAIL_LOG_RETENTION_DAYS are
+#   1. appended to gzip JSON lines archives, one file per month of sent_at
+#      (ARCHIVE_DIR/email_log/YYYY-MM.jsonl.gz). Every run appends a new gzip member,
+#      so files are never rewritten and zcat or gzip.open read them as one stream;
+#   2. counted into email_log_daily (day, campaign, type, status), which the dashboard
+#      adds to the counts of the rows still in email_log;
+#   3. deleted, one chunk per transaction, so log writes from senders never wait long.
+# A chunk is written to the archive before its transaction commits. If the commit fails
+# the next run archives those rows again, so readers skip repeated ids (read_archive does).
+
+RETENTION_DAYS = int(os.environ.get('EMAIL_LOG_RETENTION_DAYS', 0)) # 0 keeps every row
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive')
+CHUNK_SIZE = int(os.environ.get('RETENTION_CHUNK_SIZE', 5000))
+
+FIELDS = ('id', 'campaign_id', 'recipient_email', 'status', 'type', 'error_message', 'sent_at')
+
+def _month_files(archive_dir):
+    return sorted(glob.glob(os.path.join(archive_dir, 'email_log', '*.jsonl.gz')))
+
+def _append(archive_dir, rows):
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(row.sent_at.strftime('%Y-%m') if row.sent_at else 'undated', []).append(row)
+    for month, month_rows in by_month.items():
+        path = os.path.join(archive_dir, 'email_log', f'{month}.jsonl.gz')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'ab') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as archive:
+                for row in month_rows:
+                    record = dict(zip(FIELDS, row))
+                    record['sent_at'] = row.sent_at.isoformat() if row.sent_at else None
+                    archive.write((json.dumps(record, separators=(',', ':')) + '\n').encode())
+            f.flush()
+            os.fsync(f.fileno())
+
+def _roll_up(session, rows):
+    counts = Counter((row.sent_at.date() if row.sent_at else None, row.campaign_id, row.type, row.status) for row in rows)
+    for (day, campaign_id, log_type, status), count in counts.items():
+        daily = session.query(EmailLogDaily).filter_by(day=day, campaign_id=campaign_id, type=log_type, status=status).first()
+        if daily is None:
+            session.add(EmailLogDaily(day=day, campaign_id=campaign_id, type=log_type, status=status, count=count))
+        else:
+            daily.count += count
+
+def archive_email_logs(retention_days=None, archive_dir=None, chunk_size=None, pause=0.0, now=None):
+    """
+    Archives, rolls up and deletes EmailLog rows older than retention_days, oldest first,
+    chunk_size rows per transaction with pause seconds between chunks. Must run inside an
+    app context. Returns the number of rows archived.
+    """
+    retention_days = RETENTION_DAYS if retention_days is None else retention_days
+    archive_dir = archive_dir or ARCHIVE_DIR
+    chunk_size = chunk_size or CHUNK_SIZE
+    if retention_days < 1:
+        return 0
+    cutoff = (now or datetime.utcnow()) - timedelta(days=retention_days)
+    columns = [getattr(EmailLog, field) for field in FIELDS]
+    archived = 0
+    last_id = 0
+    while True:
+        rows = db.session.query(*columns).filter(EmailLog.id > last_id).order_by(EmailLog.id).limit(chunk_size).all()
+        # Ids follow send time, so old rows have the lowest ids: stop at the first recent one
+        # instead of scanning the recent part of the table for stragglers
+        old = list(takewhile(lambda row: row.sent_at is None or row.sent_at < cutoff, rows))
+        if not old:
+            break
+        _append(archive_dir, old)
+        _roll_up(db.session, old)
+        db.session.query(EmailLog).filter(EmailLog.id.in_([row.id for row in old])).delete(synchronize_session=False)
+        db.session.commit()
+        archived += len(old)
+        last_id = old[-1].id
+        print(f"Archived {archived} email logs (up to {old[-1].sent_at or 'undated'})")
+        if len(old) < chunk_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return archived
+
+def read_archive(archive_dir=None, since=None, until=None, **filters):
+    """
+    Yields archived rows as dicts, with sent_at as an ISO string, for sent_at in
+    [since, until) and fields equal to filters, e.g. read_archive(campaign_id=3, status='failed').
+    Reads only the archive files, so it works without the database.
+    """
+    since_key = since.isoformat() if since else None
+    until_key = until.isoformat() if until else None
+    for path in _month_files(archive_dir or ARCHIVE_DIR):
+        month = os.path.basename(path)[:7]
+        if month != 'undated' and ((since_key and month < since_key[:7]) or (until_key and month > until_key[:7])):
+            continue
+        seen = set() # A row always lands in the file of its month
+        with gzip.open(path, 'rt') as f:
+            for line in f:
+                record = json.loads(line)
+                if record['id'] in seen:
+                    continue
+                seen.add(record['id'])
+                sent_at = record['sent_at']
+                if since_key and (sent_at is None or sent_at < since_key):
+                    continue
+                if until_key and (sent_at is None or sent_at >= until_key):
+                    continue
+                if all(record.get(field) == value for field, value in filters.items()):
+                    yield record
+
+def archived_counts():
+    """
+    {(type, status): count} of the rows moved to the archive.
+    """
+    rows = db.session.query(EmailLogDaily.type, EmailLogDaily.status, db.func.sum(EmailLogDaily.count)).group_by(
+        EmailLogDaily.type, EmailLogDaily.status).all()
+    return {(log_type, status): int(count) for log_type, status, count in rows}
+
+def archived_daily(start_day, end_day, status='sent'):
+    """
+    {'YYYY-MM-DD': count} of archived rows with status per day in [start_day, end_day].
+    """
+    rows = db.session.query(EmailLogDaily.day, db.func.sum(EmailLogDaily.count)).filter(
+        EmailLogDaily.status == status, EmailLogDaily.day >= start_day, EmailLogDaily.day <= end_day
+    ).group_by(EmailLogDaily.day).all()
+    return {str(day): int(count) for day, count in rows}
@@ -0,0 +1,415 @@
+import atexit
+import itertools
+import os
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from sqlalchemy import delete, insert, select, update
+from database import db, DomainPace, Server, ServerLease
+
+DEFAULT_MAX_CONNECTIONS = 1
+# Server limits are shared through the database by every process sending with it
+LEASE_SECONDS = int(os.environ.get('SCHEDULER_LEASE_SECONDS', 30)) # A dead process's connections count this long
+SYNC_INTERVAL = 1.0 # Seconds between syncs with the database while a server is in use
+PACE_BLOCK_SECONDS = 2.0 # Send slots on a paced server are reserved this many seconds' worth at a time
+TURN_SECONDS = 5.0 # Least time a process keeps its sessions before yielding them to waiting processes
+
+def holder_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _insert_missing(conn, table, **values):
+    # Another process may insert the same row meanwhile: let the database skip it
+    if conn.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif conn.dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        conn.execute(insert(table).values(**values))
+        return
+    conn.execute(dialect_insert(table).values(**values).on_conflict_do_nothing())
+
+class _CampaignState:
+    def __init__(self, priority, weight, virtual_time):
+        self.priority = priority
+        self.weight = max(weight, 1)
+        self.virtual_time = virtual_time # Sends so far divided by weight
+        self.sent = 0
+
+def _share(want, granted, held, since, others, max_connections):
+    """
+    Sessions a process may hold on a server, given what it wants and holds, whether it
+    has held them a whole turn, since when it has had none while wanting some (None:
+    it has some, or wants none), and the other processes' leases as (connections,
+    wanted, waiting_since). Processes left without a session longest are served first; while some wait, nobody grows past
+    an even share, and holders that had their turn shrink to it, down to no session at
+    all when there are more processes than sessions, so every process gets turns.
+    """
+    free = max_connections - sum(connections for connections, _, _ in others)
+    starved = [(connections, wanted, waiting) for connections, wanted, waiting in others if wanted > connections]
+    contenders = 1 + sum(1 for _, wanted, _ in others if wanted)
+    share = max_connections // contenders
+    keep = max(min(want, granted, free), 0)
+    if not starved:
+        return max(min(want, free), 0)
+    ahead = sum(max(min(wanted, max(share, 1)) - connections, 0) for connections, wanted, waiting in starved
+                if since is None or (waiting is not None and waiting < since))
+    target = max(keep, min(want, keep + max(free - keep - ahead, 0), max(share, 1)))
+    return min(target, share) if held else target
+
+class _ServerState:
+    def __init__(self):
+        self.max_connections = DEFAULT_MAX_CONNECTIONS
+        self.max_per_minute = None
+        self.in_flight = 0
+        self.next_allowed = 0.0 # Pace within this process only (time.monotonic)
+        # Shared limits: sessions this process may open and has on record in server_lease,
+        # and the send times (time.time) reserved for it on the server's pace
+        self.granted = 0
+        self.recorded = 0
+        self.denied = False # The last sync granted fewer sessions than wanted
+        self.held_since = None # When this process last went from no sessions to some (time.monotonic)
+        self.waiting_since = None # Since when it has wanted sessions and had none (time.time)
+        self.slots = deque()
+        self.block_end = None # End of the last block of slots reserved
+
+    @property
+    def interval(self):
+        return 60.0 / self.max_per_minute if self.max_per_minute else 0.0
+
+class SendScheduler:
+    """
+    Owns the sending capacity of every server and hands it out to campaigns.
+    Each send asks for a slot on a server; a slot is granted when the server is under
+    its connection limit and its per-minute pace, and the asking campaign is first in
+    line: highest priority wins, then the campaign with the lowest weighted send count
+    (weighted fair queuing), so concurrent campaigns share a server instead of each
+    running at full speed against it.
+    Single interactive sends (resends, follow-ups) go to the front of the line but
+    still respect the server limits.
+    Once init_app has run, the limits hold across every process using the database:
+    each process leases its share of a server's connections in server_lease and reserves
+    blocks of send slots from the server's pace (server.pace_next), in transactions
+    that lock the server row, so web and sender_worker processes together never exceed
+    them. A background thread renews the lease while the server is in use; processes
+    waiting for sessions get a share as the others renew, taking turns when there are
+    more of them than sessions.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._campaigns = {}
+        self._servers = {}
+        self._waiting = {} # ticket -> (token, server_id, arrival order)
+        self._arrivals = itertools.count()
+        self._engine = None # Set by init_app: limits are then shared through the database
+        self._wake = threading.Event()
+        self._keeper = None
+
+    def init_app(self, app):
+        """
+        Shares server limits with the other processes using the app's database.
+        Without it (scripts, benchmarks) they hold within this process only.
+        """
+        with app.app_context():
+            self._engine = db.engine
+
+    def configure_server(self, server_id, max_connections=None, max_per_minute=None):
+        with self._cond:
+            server = self._servers.setdefault(server_id, _ServerState())
+            server.max_connections = max(int(max_connections or DEFAULT_MAX_CONNECTIONS), 1)
+            server.max_per_minute = int(max_per_minute) if max_per_minute else None
+            self._cond.notify_all()
+
+    def register(self, campaign_id, priority=0, weight=1):
+        """
+        Adds a campaign. It starts level with the least-served active campaign so it
+        neither waits for the others to catch up nor gets a burst of its own.
+        """
+        with self._cond:
+            start = min((c.virtual_time for c in self._campaigns.values()), default=0.0)
+            self._campaigns[campaign_id] = _CampaignState(priority or 0, weight or 1, start)
+            self._cond.notify_all()
+
+    def unregister(self, campaign_id):
+        with self._cond:
+            self._campaigns.pop(campaign_id, None)
+            self._cond.notify_all()
+
+    def _rank(self, ticket):
+        token, _, arrival = self._waiting[ticket]
+        campaign = self._campaigns.get(token)
+        if campaign is None: # Interactive send
+            return (0, 0, 0.0, arrival)
+        return (1, -campaign.priority, campaign.virtual_time, arrival)
+
+    def _first_in_line(self, ticket, server_id):
+        waiting = [t for t, (_, s, _) in self._waiting.items() if s == server_id]
+        return min(waiting, key=self._rank) is ticket
+
+    def _ready(self, server):
+        """
+        0 if a send may start on server now, else the seconds to wait (None: until notified).
+        Called with the lock held by the first thread in line.
+        """
+        shared = self._engine is not None
+        if server.in_flight >= (min(server.granted, server.max_connections) if shared else server.max_connections):
+            if not shared or server.granted >= server.max_connections:
+                return None
+            if not server.denied:
+                self._request_sync()
+            return SYNC_INTERVAL
+        if not server.max_per_minute:
+            return 0
+        if not shared:
+            return max(server.next_allowed - time.monotonic(), 0)
+        now = time.time()
+        while server.slots and server.slots[0] < now - server.interval:
+            server.slots.popleft() # Lapsed unused: sending on it late could burst above the pace
+        if not server.slots:
+            self._request_sync()
+            return SYNC_INTERVAL
+        return max(server.slots[0] - now, 0)
+
+    def acquire(self, token, server_id):
+        """
+        Blocks until token (a campaign id, or an object() for an interactive send)
+        may open a connection to server_id. Several threads may send for the same campaign.
+        """
+        ticket = object()
+        with self._cond:
+            server = self._servers.setdefault(server_id, _ServerState())
+            self._waiting[ticket] = (token, server_id, next(self._arrivals))
+            try:
+                while True:
+                    wait = self._ready(server) if self._first_in_line(ticket, server_id) else None
+                    if wait == 0:
+                        break
+                    self._cond.wait(wait)
+                server.in_flight += 1
+                if server.max_per_minute and self._engine is not None:
+                    server.slots.popleft()
+                else:
+                    server.next_allowed = max(server.next_allowed, time.monotonic()) + server.interval
+                campaign = self._campaigns.get(token)
+                if campaign is not None:
+                    campaign.sent += 1
+                    campaign.virtual_time += 1.0 / campaign.weight
+            finally:
+                del self._waiting[ticket]
+                self._cond.notify_all()
+
+    def release(self, server_id):
+        with self._cond:
+            server = self._servers[server_id]
+            server.in_flight -= 1
+            if server.recorded > max(server.granted, server.in_flight):
+                # Sessions given up at the last sync are now closed: hand them over
+                self._request_sync()
+            self._cond.notify_all()
+
+    # --- Shared limits ---
+
+    def _request_sync(self):
+        # Called with the lock held
+        if self._keeper is None or not self._keeper.is_alive():
+            if self._keeper is None:
+                atexit.register(self._drop_leases)
+            self._keeper = threading.Thread(target=self._keep, name='send-scheduler', daemon=True)
+            self._keeper.start()
+        self._wake.set()
+
+    def _drop_leases(self):
+        # On a clean exit, hand this process's sessions back now rather than when the leases expire
+        try:
+            with self._engine.begin() as conn:
+                conn.execute(delete(ServerLease.__table__).where(ServerLease.__table__.c.holder == holder_name()))
+        except Exception as e:
+            print(f"Send scheduler: could not drop this process's leases: {e}")
+
+    def _keep(self):
+        while True:
+            self._wake.wait(SYNC_INTERVAL)
+            self._wake.clear()
+            with self._cond:
+                waiting = {server_id for _, server_id, _ in self._waiting.values()}
+                in_use = [server_id for server_id, server in self._servers.items()
+                          if server_id in waiting or server.in_flight or server.recorded]
+            for server_id in in_use:
+                try:
+                    self._sync(server_id)
+                except Exception as e:
+                    print(f"Send scheduler: could not sync the limits of server {server_id}: {e}")
+            time.sleep(0.1) # Waiters asking for a sync again right away don't turn this into a busy loop
+
+    def _sync(self, server_id):
+        """
+        Renews this process's lease on server_id for the sessions it uses or waits for,
+        within what other processes leave, and tops up its reserved send slots.
+        """
+        with self._cond:
+            server = self._servers[server_id]
+            waiting = sum(1 for _, s, _ in self._waiting.values() if s == server_id)
+            want = min(server.in_flight + waiting, server.max_connections)
+            in_flight, granted, max_connections = server.in_flight, server.granted, server.max_connections
+            held = server.held_since is not None and time.monotonic() - server.held_since >= TURN_SECONDS
+            since = server.waiting_since
+            interval = server.interval if server.max_per_minute else 0.0
+            slots_left = list(server.slots)
+        holder = holder_name()
+        servers, leases = Server.__table__, ServerLease.__table__
+        slots = []
+        with self._engine.begin() as conn:
+            # Writing the row first locks it (Postgres) or takes the write lock (SQLite) until
+            # commit, so processes syncing the same server take turns
+            lock = update(servers).where(servers.c.id == server_id).values(pace_next=servers.c.pace_next)
+            known = conn.execute(lock).rowcount
+            now = time.time()
+            pace_next = conn.execute(select(servers.c.pace_next).where(servers.c.id == server_id)).scalar()
+            conn.execute(delete(leases).where(leases.c.server_id == server_id, leases.c.expires_at < now))
+            # A server that isn't in the table (deleted meanwhile) has nothing to share
+            others = conn.execute(select(leases.c.connections, leases.c.wanted, leases.c.waiting_since).where(
+                leases.c.server_id == server_id, leases.c.holder != holder)).all() if known else []
+            target = _share(want, granted, held, since, others, max_connections)
+            since = (since or now) if want and not target else None
+            # Sessions still open count until they close
+            recorded = max(target, in_flight)
+            conn.execute(delete(leases).where(leases.c.server_id == server_id, leases.c.holder == holder))
+            if known and (recorded or want):
+                conn.execute(insert(leases).values(server_id=server_id, holder=holder, connections=recorded,
+                                                   wanted=want, waiting_since=since, expires_at=now + LEASE_SECONDS))
+            if not target:
+                if slots_left and known and pace_next == server.block_end:
+                    # Nobody reserved after our block: hand its unused slots back
+                    conn.execute(update(servers).where(servers.c.id == server_id).values(pace_next=max(slots_left[0], now)))
+            elif interval and waiting and len(slots_left) * interval < SYNC_INTERVAL:
+                start = max(pace_next or 0.0, now)
+                count = max(int(PACE_BLOCK_SECONDS / interval), 1)
+                slots = [start + i * interval for i in range(count)]
+                if known:
+                    conn.execute(update(servers).where(servers.c.id == server_id).values(pace_next=start + count * interval))
+        with self._cond:
+            if not target:
+                server.held_since = None
+                server.slots.clear()
+            elif server.held_since is None:
+                server.held_since = time.monotonic()
+            if slots:
+                server.block_end = slots[-1] + interval
+            server.granted = target
+            server.recorded = recorded
+            server.denied = target < want
+            server.waiting_since = since
+            server.slots.extend(slots)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, campaign_id, server_id):
+        """
+        with send_scheduler.slot(campaign_id, server_id): send_email(...)
+        campaign_id None marks an interactive send.
+        """
+        token = campaign_id if campaign_id is not None else object()
+        self.acquire(token, server_id)
+        try:
+            yield
+        finally:
+            self.release(server_id)
+
+    def status(self):
+        with self._cond:
+            return {
+                'campaigns': {cid: {'priority': c.priority, 'weight': c.weight, 'sent': c.sent}
+                              for cid, c in self._campaigns.items()},
+                'servers': {sid: {'in_flight': s.in_flight, 'max_connections': s.max_connections,
+                                  'max_per_minute': s.max_per_minute,
+                                  'granted': s.granted if self._engine is not None else s.max_connections}
+                            for sid, s in self._servers.items()},
+            }
+
+# Shared per-process scheduler; every send path goes through it
+send_scheduler = SendScheduler()
+
+def parse_domain_limits(text):
+    """
+    Parses 'gmail.com=120, outlook.com=60, *=300' (emails per minute per recipient
+    domain, '*' for any other domain) into a dict. Invalid entries are ignored.
+    """
+    limits = {}
+    for entry in (text or '').split(','):
+        domain, _, value = entry.partition('=')
+        if domain.strip() and value.strip().isdigit() and int(value) > 0:
+            limits[domain.strip().lower()] = int(value)
+    return limits
+
+class DomainRateLimiter:
+    """
+    Paces sends per recipient domain, so a list heavy in one provider reaches its
+    MX as a steady stream rather than a burst that gets greylisted or deferred.
+    Once init_app has run the caps hold across processes: each send to a capped domain
+    takes its slot from the domain's row in domain_pace, one short transaction per send.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = limits or {}
+        self._next_allowed = {}
+        self._lock = threading.Lock()
+        self._engine = None
+
+    def init_app(self, app):
+        """
+        Shares the caps with the other processes using the app's database.
+        """
+        with app.app_context():
+            self._engine = db.engine
+
+    def interval(self, domain):
+        per_minute = self.limits.get(domain) or self.limits.get('*')
+        return 60.0 / per_minute if per_minute else 0.0
+
+    def acquire(self, domain, max_wait=0):
+        """
+        Takes a send slot for domain, sleeping up to max_wait seconds for it.
+        Returns 0 once the slot is taken, or the seconds until the domain has room
+        if that's longer than max_wait (nothing is taken then).
+        """
+        interval = self.interval(domain)
+        if not interval:
+            return 0
+        reserve = self._reserve_shared if self._engine is not None else self._reserve_local
+        wait, taken = reserve(domain, interval, max_wait)
+        if not taken:
+            return wait
+        if wait:
+            time.sleep(wait)
+        return 0
+
+    def _reserve_local(self, domain, interval, max_wait):
+        with self._lock:
+            now = time.monotonic()
+            next_allowed = self._next_allowed.get(domain, 0.0)
+            wait = max(next_allowed - now, 0.0)
+            if wait > max_wait:
+                return wait, False
+            self._next_allowed[domain] = max(next_allowed, now) + interval
+            return wait, True
+
+    def _reserve_shared(self, domain, interval, max_wait):
+        table = DomainPace.__table__
+        with self._engine.begin() as conn:
+            # Locks the domain's row (Postgres) or the database (SQLite) until commit
+            lock = update(table).where(table.c.domain == domain).values(pace_next=table.c.pace_next)
+            if not conn.execute(lock).rowcount:
+                _insert_missing(conn, table, domain=domain)
+                conn.execute(lock)
+            now = time.time()
+            next_allowed = conn.execute(select(table.c.pace_next).where(table.c.domain == domain)).scalar() or 0.0
+            wait = max(next_allowed - now, 0.0)
+            if wait > max_wait:
+                return wait, False
+            conn.execute(update(table).where(table.c.domain == domain).values(pace_next=max(next_allowed, now) + interval))
+        return wait, True
+
+# Caps from DOMAIN_RATE_LIMITS, e.g. "gmail.com=120,outlook.com=60"; shared by every process once init_app ran
+domain_limits = DomainRateLimiter(parse_domain_limits(os.environ.get('DOMAIN_RATE_LIMITS')))
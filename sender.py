@@ -0,0 +1,557 @@
+import itertools
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import Float, and_, cast, func, insert, literal, or_, select, update
+from sqlalchemy.sql import exists
+from database import db, Contact, Campaign, CampaignRecipient, EmailLog, Server, Template
+from email_utils import send_email, is_hard_bounce
+from audience import recipients_query
+from suppression import suppression_list
+from db_writer import background_writer
+from template_build import build_template, personalize
+from attachments import encoded_attachments
+from progress import progress_registry
+from scheduler import send_scheduler, domain_limits
+from server_health import health_monitor
+from frequency import frequency_cap, record_send
+from metrics import emails_total, queue_recipients
+from tracking import tracker
+
+# Campaign sending engine shared by the web process and sender_worker.py.
+# Starting a campaign copies its audience into the campaign_recipient queue; senders
+# then claim small batches of pending rows, send them and record each result on its row.
+# A claim is a single UPDATE of the next pending rows: on Postgres the candidate rows are
+# selected FOR UPDATE SKIP LOCKED so concurrent workers take disjoint batches without
+# waiting on each other; on SQLite the statement runs under the database write lock,
+# which serializes claims the same way an advisory lock would.
+# Claims are leases: rows held by a worker that died are claimable again after
+# CLAIM_LEASE_SECONDS, and live workers renew the lease while they send.
+# Rows are claimed in send_order, which spreads every recipient domain evenly over the
+# campaign, and domain rate caps (scheduler.domain_limits) hold back rows whose domain
+# is at its limit instead of stalling the sender on them.
+# With SMTP_BACKEND=asyncio a sender doesn't wait for each delivery: it hands messages
+# to the async_smtp event loop and keeps up to the server's connection limit of them
+# in flight, recording each result as it comes back.
+
+BATCH_SIZE = int(os.environ.get('SENDER_BATCH_SIZE', 50))
+CLAIM_LEASE_SECONDS = int(os.environ.get('SENDER_CLAIM_LEASE', 600))
+SMTP_BACKEND = os.environ.get('SMTP_BACKEND', 'smtplib') # smtplib | asyncio (async_smtp)
+MAX_DOMAIN_WAIT = 2 # Seconds a sender sleeps for a capped domain before deferring the row instead
+IDLE_WAIT = 1 # Seconds between claims while the only work left is deferred or held by other workers
+SERVER_DOWN_WAIT = 30 # Seconds claimed rows are held back when no server is up
+MAX_QUEUE_ERRORS = 5 # Consecutive failures to claim or read the queue before a campaign thread gives up
+
+CR = CampaignRecipient
+
+SendContext = namedtuple('SendContext', [
+    'campaign_id', 'subject', 'built', 'attachment_parts', 'smtp_config', 'server_id', 'tracked'
+])
+
+class CampaignSendError(Exception):
+    """
+    A campaign can't be sent at all (no primary server, template deleted...).
+    """
+
+class NoServerAvailable(CampaignSendError):
+    """
+    Every server is down for now; the campaign waits for one to come back.
+    """
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def server_smtp_config(server):
+    """
+    SMTP settings dict for send_email, including DKIM signing when configured.
+    Also hands the server's limits to the send scheduler, reduced while the server is degraded.
+    """
+    send_scheduler.configure_server(server.id, *health_monitor.limits(server))
+    return {
+        'server': server.smtp_server,
+        'port': server.smtp_port,
+        'email': server.smtp_email,
+        'password': server.smtp_password,
+        'dkim_selector': server.dkim_selector,
+        'dkim_private_key': server.dkim_private_key
+    }
+
+# ---------------------------------------------------------------------------
+# Queue
+# ---------------------------------------------------------------------------
+
+def status_counts(campaign_id):
+    rows = db.session.query(CR.status, func.count(CR.id)).filter(CR.campaign_id == campaign_id).group_by(CR.status).all()
+    return dict(rows)
+
+def email_domain(column):
+    """
+    SQL expression for the domain part of an email column.
+    """
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return func.split_part(column, '@', 2)
+    return func.substr(column, func.instr(column, '@') + 1)
+
+def enqueue_campaign(campaign):
+    """
+    Adds the campaign's current audience to its send queue and returns the queue size.
+    Each domain's recipients get send_order positions spread evenly over (0, 1):
+    the k-th of n recipients at a domain sits at (k - 0.5) / n, so a domain holding half
+    the list gets every other slot instead of one long run.
+    Contacts already queued keep their row, and failed or abandoned rows go back to
+    pending, so restarting a failed campaign resumes it instead of sending twice.
+    Does not commit.
+    """
+    queued = exists().where(CR.campaign_id == campaign.id, CR.contact_id == Contact.id)
+    domain = email_domain(Contact.email)
+    send_order = ((cast(func.row_number().over(partition_by=domain, order_by=Contact.id), Float) - 0.5)
+                  / func.count().over(partition_by=domain))
+    rows = recipients_query(campaign).order_by(None).filter(~queued).with_entities(
+        literal(campaign.id), Contact.id, Contact.email, Contact.name, domain, send_order, literal('pending'))
+    db.session.execute(insert(CR).from_select(
+        ['campaign_id', 'contact_id', 'email', 'name', 'domain', 'send_order', 'status'], rows.statement))
+    db.session.execute(update(CR).where(CR.campaign_id == campaign.id, CR.status.in_(['failed', 'claimed']))
+                       .values(status='pending', claimed_by=None, claim_token=None, claimed_at=None,
+                               defer_until=None, error_message=None))
+    counts = status_counts(campaign.id)
+    campaign.total_contacts = sum(counts.values())
+    campaign.sent_count = counts.get('sent', 0)
+    return campaign.total_contacts
+
+def queue_depth():
+    """
+    {(campaign id, status): recipients} for campaigns being sent, for the metrics endpoint.
+    """
+    rows = (db.session.query(CR.campaign_id, CR.status, func.count(CR.id))
+            .join(Campaign, Campaign.id == CR.campaign_id).filter(Campaign.status == 'sending')
+            .group_by(CR.campaign_id, CR.status).all())
+    db.session.commit()
+    return {(campaign_id, status): count for campaign_id, status, count in rows}
+
+queue_recipients.set_function(queue_depth)
+
+def delete_queue(campaign_id):
+    CR.query.filter_by(campaign_id=campaign_id).delete(synchronize_session=False)
+
+def _claimable(now):
+    stale = now - timedelta(seconds=CLAIM_LEASE_SECONDS)
+    return or_(and_(CR.status == 'pending', or_(CR.defer_until.is_(None), CR.defer_until <= now)),
+               and_(CR.status == 'claimed', CR.claimed_at < stale))
+
+def claim_batch(campaign_id, worker, size=BATCH_SIZE):
+    """
+    Claims up to size unsent recipients of a campaign for this worker.
+    Returns (claim token, [(id, email, name, domain)]); the list is empty when nothing
+    can be claimed right now.
+    """
+    token = uuid.uuid4().hex
+    now = datetime.utcnow()
+    candidates = (select(CR.id).where(CR.campaign_id == campaign_id, _claimable(now))
+                  .order_by(CR.send_order, CR.id).limit(size))
+    if db.session.get_bind().dialect.name == 'postgresql':
+        candidates = candidates.with_for_update(skip_locked=True)
+    # The outer condition re-checks each row, so a row claimed meanwhile is never taken twice
+    db.session.execute(
+        update(CR).where(CR.id.in_(candidates.scalar_subquery()), _claimable(now))
+        .values(status='claimed', claimed_by=worker, claim_token=token, claimed_at=now)
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+    rows = (db.session.query(CR.id, CR.email, CR.name, CR.domain)
+            .filter(CR.claim_token == token, CR.status == 'claimed').order_by(CR.send_order, CR.id).all())
+    db.session.commit()
+    return token, rows
+
+def renew_claim(token):
+    background_writer.execute(update(CR).where(CR.claim_token == token, CR.status == 'claimed').values(claimed_at=datetime.utcnow()))
+
+def release_claim(token, defer_seconds=None):
+    """
+    Puts the rows of a claim that weren't sent back in the queue, claimable again
+    right away or after defer_seconds.
+    """
+    defer_until = datetime.utcnow() + timedelta(seconds=defer_seconds) if defer_seconds else None
+    background_writer.execute(update(CR).where(CR.claim_token == token, CR.status == 'claimed')
+                              .values(status='pending', claimed_by=None, claim_token=None, claimed_at=None,
+                                      defer_until=defer_until))
+    background_writer.flush()
+
+def defer_row(token, row_id, seconds):
+    """
+    Hands a claimed row back to the queue, claimable again in seconds.
+    """
+    background_writer.execute(update(CR).where(CR.id == row_id, CR.claim_token == token, CR.status == 'claimed')
+                              .values(status='pending', claimed_by=None, claim_token=None, claimed_at=None,
+                                      defer_until=datetime.utcnow() + timedelta(seconds=seconds)))
+
+# ---------------------------------------------------------------------------
+# Sending
+# ---------------------------------------------------------------------------
+
+def load_context(campaign_id):
+    """
+    Everything a sender needs for one campaign, built once per batch from cached parts.
+    The primary server is used unless the health monitor has it down, in which case
+    the healthiest other server takes over.
+    Raises CampaignSendError if the campaign can't be sent.
+    """
+    campaign = db.session.get(Campaign, campaign_id)
+    if not campaign:
+        raise CampaignSendError("Campaign not found.")
+    servers = Server.query.order_by(Server.is_primary.desc(), Server.id).all()
+    if not servers or not servers[0].is_primary:
+        raise CampaignSendError("No primary server configured. Please go to Settings and configure a server.")
+    health_monitor.ensure_started()
+    server = health_monitor.choose(servers)
+    if server is None:
+        error = (health_monitor.get(servers[0].id) or {}).get('error')
+        raise NoServerAvailable(f"No healthy server to send from. {error or ''}".strip())
+    template = db.session.get(Template, campaign.template_id)
+    if not template:
+        raise CampaignSendError("Campaign template not found. It may have been deleted.")
+    built = build_template(template)
+    return SendContext(
+        campaign_id=campaign_id,
+        subject=campaign.email_subject,
+        # Inlined, minified HTML plus text alternative, built once per template version
+        built=built,
+        # Attachments are encoded once and the same buffers are reused for every recipient
+        attachment_parts=encoded_attachments.parts(campaign.attachments),
+        smtp_config=server_smtp_config(server),
+        server_id=server.id,
+        # Open pixel and tracked links, or None when tracking is off
+        tracked=tracker.template(built, campaign_id),
+    )
+
+def _record(context, row_id, token, email, status, error=None):
+    campaign_id = context.campaign_id
+
+    # Log, queue row and progress go together; the writer batches these into few commits
+    def record(session):
+        session.add(EmailLog(campaign_id=campaign_id, recipient_email=email, status=status, error_message=error))
+        session.execute(update(CR).where(CR.id == row_id, CR.claim_token == token).values(status=status, error_message=error))
+        if status == 'sent':
+            session.execute(update(Campaign).where(Campaign.id == campaign_id).values(sent_count=Campaign.sent_count + 1))
+            if not frequency_cap.enabled:
+                # With a cap the send was already indexed when it was reserved
+                record_send(session, email)
+    background_writer.submit(record)
+    emails_total.inc(status=status, server=context.server_id, campaign=campaign_id, type='campaign')
+    progress_registry.record(campaign_id, sent=int(status == 'sent'), failed=int(status == 'failed'),
+                             suppressed=int(status in ('suppressed', 'capped')))
+
+def _sent(context, token, row_id, email, success, error, reserved=None):
+    """
+    Records a delivery, giving back its frequency cap reservation if it failed.
+    Returns False if the server is down after it.
+    """
+    if not success and reserved is not None:
+        frequency_cap.release(email, reserved)
+    if not success and is_hard_bounce(error):
+        suppression_list.defer(email, 'bounce', error)
+    _record(context, row_id, token, email, 'sent' if success else 'failed', None if success else error)
+    health_monitor.record_send(context.server_id, success, error)
+    return health_monitor.state(context.server_id) != 'down'
+
+def _collect(context, token, in_flight, wait=False):
+    """
+    Records the finished deliveries of in_flight [(future, row_id, email, reserved)], all of
+    them when wait is set, and drops them from the list. Returns False if the server went down.
+    """
+    up = True
+    for item in list(in_flight):
+        future, row_id, email, reserved = item
+        if not wait and not future.done():
+            continue
+        in_flight.remove(item)
+        success, error = future.result()
+        up = _sent(context, token, row_id, email, success, error, reserved) and up
+    return up
+
+def send_batch(context, token, rows, stop=None):
+    """
+    Sends a claimed batch. Rows left when stop is set, or when the server goes down
+    mid-batch, are released so the next batch can be routed elsewhere.
+    """
+    if SMTP_BACKEND == 'asyncio':
+        # Imported here so the smtplib backend never loads asyncio
+        from async_smtp import async_smtp
+    in_flight = [] # Deliveries running on the asyncio backend
+    renew_every = CLAIM_LEASE_SECONDS / 4
+    renewed = datetime.utcnow()
+    deferred = {} # domain -> rows held back in this batch
+    # Addresses that reached the frequency cap through other campaigns, in one lookup;
+    # each send still reserves its place under the cap before it goes out
+    capped = frequency_cap.capped([row[1] for row in rows])
+    try:
+        for index, (row_id, email, name, domain) in enumerate(rows):
+            if stop is not None and stop.is_set():
+                # Rows still being delivered are recorded before the rest go back
+                _collect(context, token, in_flight, wait=True)
+                release_claim(token)
+                return
+            if (datetime.utcnow() - renewed).total_seconds() > renew_every:
+                renew_claim(token)
+                renewed = datetime.utcnow()
+
+            suppression_list.maybe_refresh()
+            if suppression_list.is_suppressed(email):
+                _record(context, row_id, token, email, 'suppressed')
+                continue
+            if email in capped:
+                _record(context, row_id, token, email, 'capped', frequency_cap.reason)
+                continue
+
+            domain = domain or email.rpartition('@')[2]
+            wait = domain_limits.acquire(domain, MAX_DOMAIN_WAIT)
+            if wait:
+                # Spread the held back rows over the following slots of their domain
+                deferred[domain] = deferred.get(domain, 0) + 1
+                defer_row(token, row_id, wait + (deferred[domain] - 1) * domain_limits.interval(domain))
+                continue
+            reserved = None
+            if frequency_cap.enabled:
+                # Atomic, so concurrent senders can't take an address past the cap together
+                reserved = frequency_cap.reserve(email)
+                if reserved is None:
+                    _record(context, row_id, token, email, 'capped', frequency_cap.reason)
+                    continue
+
+            built = context.built
+            if context.tracked is not None:
+                built = built._replace(html=context.tracked.html_for(row_id), html_encoding=context.tracked.html_encoding)
+            html_content, text_content = personalize(built, name or 'Valued Customer')
+            if SMTP_BACKEND == 'asyncio':
+                # The slot is held until the delivery finishes, so the server's connection limit still applies
+                send_scheduler.acquire(context.campaign_id, context.server_id)
+                future = async_smtp.submit(context.smtp_config, email, context.subject, html_content, text_content,
+                                           built.html_encoding, built.text_encoding, context.attachment_parts)
+                future.add_done_callback(lambda f, server_id=context.server_id: send_scheduler.release(server_id))
+                in_flight.append((future, row_id, email, reserved))
+                up = _collect(context, token, in_flight)
+            else:
+                with send_scheduler.slot(context.campaign_id, context.server_id):
+                    success, error = send_email(context.smtp_config, email, context.subject, html_content, text_content,
+                                                built.html_encoding, built.text_encoding, context.attachment_parts)
+                up = _sent(context, token, row_id, email, success, error, reserved)
+            if not up and index + 1 < len(rows):
+                _collect(context, token, in_flight, wait=True)
+                background_writer.flush()
+                release_claim(token)
+                return
+    except Exception:
+        # Deliveries already handed to the loop still count; record them before the claim is released
+        _collect(context, token, in_flight, wait=True)
+        raise
+    _collect(context, token, in_flight, wait=True)
+    background_writer.flush()
+
+def finish_campaign(campaign_id):
+    """
+    Marks a campaign completed or failed once no recipient is pending or claimed.
+    Safe to call from every worker: only the first one to see the queue drained
+    changes the status. Returns the final status, or None while work remains.
+    """
+    counts = status_counts(campaign_id)
+    if counts.get('pending') or counts.get('claimed'):
+        db.session.commit()
+        return None
+    sent = counts.get('sent', 0)
+    suppressed = counts.get('suppressed', 0) + counts.get('capped', 0)
+    total = sum(counts.values())
+    error_message = None
+    if sent == 0 and total > suppressed:
+        last_error = db.session.query(CR.error_message).filter(CR.campaign_id == campaign_id, CR.status == 'failed').order_by(CR.id.desc()).limit(1).scalar()
+        status = 'failed'
+        error_message = f"All emails failed. Last error: {last_error}"
+    else:
+        status = 'completed'
+    db.session.execute(update(Campaign).where(Campaign.id == campaign_id, Campaign.status == 'sending')
+                       .values(status=status, error_message=error_message, sent_count=sent))
+    db.session.commit()
+    progress_registry.finish(campaign_id, status, error_message)
+    return status
+
+def fail_campaign(campaign_id, message):
+    db.session.rollback()
+    db.session.execute(update(Campaign).where(Campaign.id == campaign_id, Campaign.status == 'sending')
+                       .values(status='failed', error_message=message))
+    db.session.commit()
+    progress_registry.finish(campaign_id, 'failed', message)
+    print(f"Error sending campaign {campaign_id}: {message}")
+
+def process_batch(campaign_id, worker, size=BATCH_SIZE, stop=None):
+    """
+    Claims and sends one batch of a campaign, finishing the campaign when its queue
+    is drained. Returns the number of recipients claimed (0 = nothing left to do).
+    Must run inside an app context.
+    """
+    token, rows = claim_batch(campaign_id, worker, size)
+    if not rows:
+        finish_campaign(campaign_id)
+        return 0
+    try:
+        context = load_context(campaign_id)
+    except NoServerAvailable as e:
+        # Temporary: the campaign stays 'sending' and its rows are retried once a probe
+        # may have brought a server back
+        release_claim(token, SERVER_DOWN_WAIT)
+        print(f"Campaign {campaign_id} waiting: {e}")
+        return 0
+    except Exception as e:
+        release_claim(token)
+        fail_campaign(campaign_id, str(e))
+        return 0
+    try:
+        send_batch(context, token, rows, stop)
+    except Exception as e:
+        background_writer.flush()
+        release_claim(token)
+        fail_campaign(campaign_id, str(e))
+        return 0
+    return len(rows)
+
+def run_campaign(campaign_id, worker=None, size=BATCH_SIZE, stop=None):
+    """
+    Sends a campaign from this thread until its queue is drained, or stop (an Event) is
+    set. Other processes running sender_worker.py may claim batches of the same campaign
+    meanwhile. Must run inside an app context.
+    """
+    worker = worker or worker_name()
+    campaign = db.session.get(Campaign, campaign_id)
+    if not campaign:
+        return
+    progress_registry.start(campaign_id, campaign.total_contacts or 0)
+    suppression_list.refresh()
+    # Capacity on the server is shared with every other running campaign
+    send_scheduler.register(campaign_id, campaign.priority, campaign.weight)
+    db.session.commit()
+    errors = 0
+    try:
+        while stop is None or not stop.is_set():
+            try:
+                if process_batch(campaign_id, worker, size, stop):
+                    errors = 0
+                    continue
+                # Nothing claimable: done, failed, or waiting on deferred rows and other workers' batches
+                status = db.session.query(Campaign.status).filter(Campaign.id == campaign_id).scalar()
+                db.session.commit()
+                errors = 0
+            except Exception as e:
+                # Claiming or reading the queue failed (e.g. "database is locked"): back off and
+                # retry, and give up only if it keeps failing, so the campaign never stays 'sending'
+                db.session.rollback()
+                errors += 1
+                print(f"Campaign {campaign_id}: queue error ({errors}/{MAX_QUEUE_ERRORS}): {e}")
+                if errors >= MAX_QUEUE_ERRORS:
+                    fail_campaign(campaign_id, f"Queue error: {e}")
+                    break
+                time.sleep(min(IDLE_WAIT * 2 ** errors, 60))
+                continue
+            if status != 'sending':
+                progress_registry.finish(campaign_id, status)
+                break
+            time.sleep(IDLE_WAIT)
+    finally:
+        send_scheduler.unregister(campaign_id)
+        db.session.remove()
+
+# ---------------------------------------------------------------------------
+# Standalone worker
+# ---------------------------------------------------------------------------
+
+class SenderWorker:
+    """
+    Sends every campaign in 'sending' status, in batches claimed from the queue.
+    Runs threads sender threads in this process; start as many processes, on as many
+    machines, as the SMTP servers can take.
+    """
+
+    def __init__(self, app, worker=None, threads=1, batch_size=BATCH_SIZE, poll_interval=5, campaign_ids=None):
+        self.app = app
+        self.worker = worker or worker_name()
+        self.threads = max(threads, 1)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.campaign_ids = set(campaign_ids or [])
+        self.stop_event = threading.Event()
+        self._turn = itertools.count()
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def _sending_campaigns(self):
+        """
+        Ids of the campaigns to work on, highest priority first, and keeps the
+        scheduler's view of them current.
+        """
+        query = db.session.query(Campaign.id, Campaign.priority, Campaign.weight).filter(Campaign.status == 'sending')
+        if self.campaign_ids:
+            query = query.filter(Campaign.id.in_(self.campaign_ids))
+        campaigns = query.order_by(Campaign.priority.desc(), Campaign.id).all()
+        db.session.commit()
+        with self._lock:
+            current = {c.id for c in campaigns}
+            for campaign_id in self._active - current:
+                send_scheduler.unregister(campaign_id)
+            for campaign in campaigns:
+                if campaign.id not in self._active:
+                    send_scheduler.register(campaign.id, campaign.priority, campaign.weight)
+            self._active = current
+        return [c.id for c in campaigns]
+
+    def step(self):
+        """
+        Sends one batch of the next campaign with work left. Returns False when idle.
+        Campaigns take turns so threads spread over them; the scheduler decides
+        who gets a shared server first.
+        """
+        campaign_ids = self._sending_campaigns()
+        if not campaign_ids:
+            return False
+        suppression_list.maybe_refresh()
+        start = next(self._turn) % len(campaign_ids)
+        for campaign_id in campaign_ids[start:] + campaign_ids[:start]:
+            if self.stop_event.is_set():
+                return False
+            if process_batch(campaign_id, self.worker, self.batch_size, self.stop_event):
+                return True
+        return False
+
+    def _run_thread(self, once):
+        with self.app.app_context():
+            try:
+                while not self.stop_event.is_set():
+                    try:
+                        busy = self.step()
+                    except Exception as e:
+                        db.session.rollback()
+                        print(f"Sender worker {self.worker} error: {e}")
+                        busy = False
+                    if not busy:
+                        # Deferred rows and other workers' batches still count as work left
+                        if once and not self._sending_campaigns():
+                            return
+                        self.stop_event.wait(self.poll_interval)
+            finally:
+                db.session.remove()
+
+    def run(self, once=False):
+        """
+        Runs until stop() (or, with once=True, until there is nothing left to send).
+        """
+        print(f"Sender worker {self.worker} started with {self.threads} thread(s).")
+        threads = [threading.Thread(target=self._run_thread, args=(once,), name=f'sender-{i}', daemon=True)
+                   for i in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+        background_writer.flush()
+        print(f"Sender worker {self.worker} stopped.")
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,33 @@
+import argparse
+import os
+import signal
+
+# A worker must never reset campaigns that other workers are still sending
+os.environ['SENDER_MODE'] = 'worker'
+
+from app import app
+from sender import SenderWorker, BATCH_SIZE
+import metrics
+
+# Standalone campaign sender. Run any number of these, on any number of machines,
+# against the same database; they split campaigns into claimed batches.
+#   python sender_worker.py --threads 4
+parser = argparse.ArgumentParser(description="Send queued campaigns.")
+parser.add_argument('--threads', type=int, default=int(os.environ.get('SENDER_THREADS', 1)), help="sender threads in this process")
+parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="recipients claimed at a time")
+parser.add_argument('--poll-interval', type=float, default=5, help="seconds between checks when idle")
+parser.add_argument('--campaign', type=int, action='append', help="only send this campaign (repeatable)")
+parser.add_argument('--once', action='store_true', help="exit when there is nothing left to send")
+parser.add_argument('--metrics-port', type=int, default=int(os.environ.get('SENDER_METRICS_PORT', 0)),
+                    help="serve Prometheus metrics on this port (0 = off)")
+args = parser.parse_args()
+
+if args.metrics_port:
+    metrics.serve(args.metrics_port, app)
+
+worker = SenderWorker(app, threads=args.threads, batch_size=args.batch_size,
+                      poll_interval=args.poll_interval, campaign_ids=args.campaign)
+# Finish the recipient in flight, hand the rest of the batch back and exit
+signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+signal.signal(signal.SIGINT, lambda signum, frame: worker.stop())
+worker.run(once=args.once)
@@ -0,0 +1,253 @@
+import os
+import smtplib
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from database import db, Server
+from email_utils import is_refusal
+
+CHECK_INTERVAL = int(os.environ.get('SERVER_HEALTH_INTERVAL', 300)) # Seconds between probes of a working server
+RETRY_INTERVAL = 60 # Seconds between probes of a server that is down
+PROBE_TIMEOUT = int(os.environ.get('SERVER_HEALTH_TIMEOUT', 10))
+SEND_FAILURE_STREAK = 5 # Consecutive failed sends that take a server out until its next good probe
+DEGRADED_ERROR_RATE = 0.2 # Share of failed sends (refused recipients excluded) over the window
+DEGRADED_MIN_SENDS = 10
+SLOW_LOGIN_MS = 5000
+
+# Routing order; unknown servers haven't been probed yet and are given the benefit of the doubt
+STATE_RANK = {'healthy': 0, 'unknown': 0, 'degraded': 1, 'down': 2}
+
+# Plain copy of the Server columns a probe needs, so probes run without a session
+ProbeTarget = namedtuple('ProbeTarget', ['id', 'name', 'smtp_server', 'smtp_port', 'smtp_email', 'smtp_password', 'imap_server'])
+
+def probe_smtp(target, timeout=PROBE_TIMEOUT):
+    """
+    Connects and logs in like a send would. Returns (ok, latency in ms, error).
+    """
+    started = time.monotonic()
+    try:
+        if target.smtp_port == 465:
+            smtp = smtplib.SMTP_SSL(target.smtp_server, target.smtp_port, timeout=timeout)
+        else:
+            smtp = smtplib.SMTP(target.smtp_server, target.smtp_port, timeout=timeout)
+            smtp.starttls()
+        smtp.login(target.smtp_email, target.smtp_password)
+        smtp.quit()
+        return True, round((time.monotonic() - started) * 1000), None
+    except Exception as e:
+        return False, round((time.monotonic() - started) * 1000), f"SMTP Error: {e}"
+
+def probe_imap(target, timeout=PROBE_TIMEOUT):
+    """
+    Same as probe_smtp for IMAP. Returns (None, None, None) when no IMAP server is set.
+    """
+    if not target.imap_server or not target.imap_server.strip():
+        return None, None, None
+    import imaplib # Only the IMAP probe needs it
+    started = time.monotonic()
+    try:
+        imap = imaplib.IMAP4_SSL(target.imap_server, timeout=timeout)
+        imap.login(target.smtp_email, target.smtp_password)
+        imap.logout()
+        return True, round((time.monotonic() - started) * 1000), None
+    except Exception as e:
+        return False, round((time.monotonic() - started) * 1000), f"IMAP Error: {e}"
+
+class ServerHealth:
+    """
+    Last probe results of one server plus the outcome of recent sends through it.
+    """
+
+    WINDOW_SECONDS = 900
+
+    def __init__(self, server_id):
+        self.server_id = server_id
+        self.smtp_ok = None
+        self.imap_ok = None
+        self.smtp_latency_ms = None
+        self.imap_latency_ms = None
+        self.error = None
+        self.checked_at = None # Wall clock, for display
+        self.next_check = 0.0 # Monotonic
+        self.send_failures = 0 # In a row
+        self._sends = deque() # (monotonic time, ok)
+
+    def record_probe(self, smtp, imap):
+        now = time.monotonic()
+        self.smtp_ok, self.smtp_latency_ms, smtp_error = smtp
+        self.imap_ok, self.imap_latency_ms, imap_error = imap
+        self.error = ' '.join(e for e in (smtp_error, imap_error) if e) or None
+        self.checked_at = time.time()
+        if self.smtp_ok:
+            self.send_failures = 0
+        self.next_check = now + (CHECK_INTERVAL if self.smtp_ok else RETRY_INTERVAL)
+
+    def record_send(self, ok):
+        now = time.monotonic()
+        self._sends.append((now, ok))
+        while self._sends and now - self._sends[0][0] > self.WINDOW_SECONDS:
+            self._sends.popleft()
+        self.send_failures = 0 if ok else self.send_failures + 1
+        if self.send_failures == SEND_FAILURE_STREAK:
+            # Check again soon so a recovered server comes back quickly
+            self.next_check = min(self.next_check, now + RETRY_INTERVAL)
+
+    def error_rate(self):
+        if len(self._sends) < DEGRADED_MIN_SENDS:
+            return None
+        return sum(1 for _, ok in self._sends if not ok) / len(self._sends)
+
+    @property
+    def state(self):
+        if self.smtp_ok is False or self.send_failures >= SEND_FAILURE_STREAK:
+            return 'down'
+        if self.smtp_ok is None and not self._sends:
+            return 'unknown'
+        error_rate = self.error_rate()
+        if (error_rate is not None and error_rate >= DEGRADED_ERROR_RATE) or (self.smtp_latency_ms or 0) > SLOW_LOGIN_MS:
+            return 'degraded'
+        return 'healthy'
+
+    def as_dict(self):
+        error_rate = self.error_rate()
+        return {
+            'id': self.server_id,
+            'state': self.state,
+            'smtp_status': self.smtp_ok, # None until probed
+            'imap_status': self.imap_ok, # None when no IMAP server is set
+            'smtp_latency_ms': self.smtp_latency_ms,
+            'imap_latency_ms': self.imap_latency_ms,
+            'error_rate': round(error_rate, 3) if error_rate is not None else None,
+            'recent_sends': len(self._sends),
+            'checked_at': self.checked_at,
+            'error': self.error,
+        }
+
+class HealthMonitor:
+    """
+    Probes every server in the background, all of them concurrently, and keeps the
+    results in memory so pages and the send engine read them instantly.
+    Healthy servers are probed every CHECK_INTERVAL seconds, failing ones every
+    RETRY_INTERVAL. Sends report their outcome too, so a server that starts failing
+    mid-campaign is taken out after SEND_FAILURE_STREAK errors rather than after
+    the whole audience.
+    """
+
+    def __init__(self, max_workers=16):
+        self.max_workers = max_workers
+        self._app = None
+        self._health = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wake = threading.Event()
+
+    def init_app(self, app):
+        self._app = app
+
+    def ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='server-health', daemon=True)
+                self._thread.start()
+
+    def _entry(self, server_id):
+        with self._lock:
+            return self._health.setdefault(server_id, ServerHealth(server_id))
+
+    def probe(self, servers):
+        """
+        Probes the given Server rows now (SMTP and IMAP of all of them in parallel)
+        and blocks until every probe finished or timed out.
+        """
+        targets = [ProbeTarget(s.id, s.name, s.smtp_server, s.smtp_port, s.smtp_email, s.smtp_password, s.imap_server)
+                   for s in servers]
+        if not targets:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, 2 * len(targets))) as pool:
+            futures = [(t, pool.submit(probe_smtp, t), pool.submit(probe_imap, t)) for t in targets]
+            for target, smtp, imap in futures:
+                result = (smtp.result(), imap.result())
+                with self._lock:
+                    self._health.setdefault(target.id, ServerHealth(target.id)).record_probe(*result)
+
+    def _due(self):
+        now = time.monotonic()
+        servers = Server.query.all()
+        with self._lock:
+            known = {s.id for s in servers}
+            for server_id in list(self._health):
+                if server_id not in known:
+                    del self._health[server_id]
+            return [s for s in servers if s.id not in self._health or self._health[s.id].next_check <= now]
+
+    def _run(self):
+        with self._app.app_context():
+            while True:
+                try:
+                    due = self._due()
+                    db.session.remove()
+                    self.probe(due)
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Server health check failed: {e}")
+                self._wake.wait(min(RETRY_INTERVAL, CHECK_INTERVAL))
+                self._wake.clear()
+
+    def check_soon(self):
+        self.ensure_started()
+        self._wake.set()
+
+    def forget(self, server_id):
+        """
+        Drops cached results, e.g. after the server's settings changed.
+        """
+        with self._lock:
+            self._health.pop(server_id, None)
+        self.check_soon()
+
+    def get(self, server_id):
+        with self._lock:
+            health = self._health.get(server_id)
+            return health.as_dict() if health else None
+
+    def snapshot(self):
+        with self._lock:
+            return {server_id: health.as_dict() for server_id, health in self._health.items()}
+
+    def state(self, server_id):
+        with self._lock:
+            health = self._health.get(server_id)
+            return health.state if health else 'unknown'
+
+    def record_send(self, server_id, success, error=None):
+        # Only connect, login and DATA errors count against the server: a refused recipient,
+        # hard or soft, means it answered
+        ok = success or is_refusal(error)
+        self._entry(server_id).record_send(ok)
+
+    def choose(self, servers):
+        """
+        Picks the server to send through from candidates listed in order of preference
+        (primary first): the first healthy one, else the first degraded one.
+        Returns None when all of them are down.
+        """
+        ranked = sorted(enumerate(servers), key=lambda item: (STATE_RANK[self.state(item[1].id)], item[0]))
+        if not ranked or self.state(ranked[0][1].id) == 'down':
+            return None
+        return ranked[0][1]
+
+    def limits(self, server):
+        """
+        (max_connections, max_per_minute) for the scheduler: halved while a server is degraded.
+        """
+        max_connections, max_per_minute = server.max_connections, server.max_per_minute
+        if self.state(server.id) == 'degraded':
+            max_connections = max((max_connections or 1) // 2, 1)
+            max_per_minute = max(max_per_minute // 2, 1) if max_per_minute else None
+        return max_connections, max_per_minute
+
+# Shared per-process monitor
+health_monitor = HealthMonitor()
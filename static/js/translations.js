@@ -1,4 +1,5 @@
-{
+// UI strings for data-i18n elements, by language. Loaded by base.html before the page renders.
+window.translations = {
     "en": {
         "brand": "EmailGo",
         "dashboard": "Dashboard",
@@ -25,6 +26,10 @@
         "responses": "RESPONSES",
         "sending_trend": "Email Sending Trend (Last 7 Days)",
         "campaign_status": "Campaign Status",
+        "failed_missions": "Failed Missions",
+        "requires_attention": "REQUIRES ATTENTION",
+        "pending_missions": "Pending Missions",
+        "awaiting_launch": "AWAITING LAUNCH",
         "live_intel": "LIVE INTEL FEED",
         "view_all": "View All",
         "incoming_comms": "INCOMING COMMS",
@@ -119,7 +124,6 @@
         "no_replies": "No replies found.",
         "page_settings": "Settings",
         "manage_servers": "Manage your email servers.",
-        "servers": "Servers",
         "existing_servers": "Existing Servers",
         "primary": "Primary",
         "make_primary": "Make Primary",
@@ -135,6 +139,7 @@
         "add_server": "Add Server",
         "password_hint": "Use an App Password for Gmail/Outlook, not your login password.",
         "password_change_hint": "Only enter if you want to change it.",
+        "servers": "Servers",
         "change_password": "Change Password",
         "current_password": "Current Password",
         "new_password": "New Password",
@@ -151,7 +156,41 @@
         "overwrite_database_confirm_title": "Overwrite Database?",
         "overwrite_database_confirm_msg": "This will PERMANENTLY DELETE all current data on this server and replace it with the uploaded file. This action cannot be undone.",
         "type_confirm": "Type CONFIRM to continue",
-        "yes_overwrite": "Yes, Overwrite"
+        "yes_overwrite": "Yes, Overwrite",
+        "new_segment": "New Segment",
+        "create_new_segment": "Create New Segment",
+        "segment_name": "Segment Name",
+        "segment_rules": "Rules (JSON)",
+        "create_segment": "Create Segment",
+        "tags": "Tags",
+        "block_emails": "Block Emails",
+        "block_emails_hint": "Blocked addresses are never sent to again, from any campaign, resend or follow-up.",
+        "block": "Block",
+        "attachments": "Attachments",
+        "add_attachments": "Add Attachments",
+        "remove_current_attachments": "Remove current attachments",
+        "dkim_config": "DKIM Signing (Optional)",
+        "dkim_selector": "Selector",
+        "dkim_private_key": "Private Key (PEM)",
+        "dkim_hint": "Signs mail for the domain of the email address. Publish the public key at selector._domainkey.domain.",
+        "dkim_key_change_hint": "Leave the key blank to keep the stored one. Clear the selector to turn signing off.",
+        "priority": "Priority",
+        "priority_high": "High",
+        "priority_normal": "Normal",
+        "priority_low": "Low",
+        "weight": "Weight",
+        "sending_limits": "Sending Limits (All Campaigns)",
+        "sending_limits_short": "Limits:",
+        "max_connections": "Parallel Connections",
+        "max_per_minute": "Emails per Minute",
+        "search": "Search",
+        "search_replies_placeholder": "Sender, subject or message text",
+        "all_campaigns": "All Campaigns",
+        "unread_only": "Unread only",
+        "newer": "← Newer",
+        "older": "Older →",
+        "opens": "Opens",
+        "clicks": "Clicks"
     },
     "ar": {
         "brand": "EmailGo",
@@ -179,6 +218,10 @@
         "responses": "استجابات",
         "sending_trend": "اتجاه إرسال البريد (آخر 7 أيام)",
         "campaign_status": "حالة الحملة",
+        "failed_missions": "مهام فاشلة",
+        "requires_attention": "يتطلب الانتباه",
+        "pending_missions": "مهام معلقة",
+        "awaiting_launch": "في انتظار الإطلاق",
         "live_intel": "تغذية استخباراتية حية",
         "view_all": "عرض الكل",
         "incoming_comms": "اتصالات واردة",
@@ -273,7 +316,6 @@
         "no_replies": "لم يتم العثور على ردود.",
         "page_settings": "الإعدادات",
         "manage_servers": "إدارة خوادم البريد الإلكتروني الخاصة بك.",
-        "servers": "الخوادم",
         "existing_servers": "الخوادم الموجودة",
         "primary": "أساسي",
         "make_primary": "تعيين كأساسي",
@@ -289,6 +331,7 @@
         "add_server": "إضافة خادم",
         "password_hint": "استخدم كلمة مرور التطبيق لـ Gmail/Outlook، وليس كلمة مرور تسجيل الدخول الخاصة بك.",
         "password_change_hint": "أدخل فقط إذا كنت تريد تغييرها.",
+        "servers": "الخوادم",
         "change_password": "تغيير كلمة المرور",
         "current_password": "كلمة المرور الحالية",
         "new_password": "كلمة المرور الجديدة",
@@ -305,6 +348,40 @@
         "overwrite_database_confirm_title": "استبدال قاعدة البيانات؟",
         "overwrite_database_confirm_msg": "سيؤدي هذا إلى حذف جميع البيانات الحالية على هذا الخادم بشكل دائم واستبدالها بالملف الذي تم تحميله. لا يمكن التراجع عن هذا الإجراء.",
         "type_confirm": "اكتب CONFIRM للمتابعة",
-        "yes_overwrite": "نعم، استبدال"
+        "yes_overwrite": "نعم، استبدال",
+        "new_segment": "شريحة جديدة",
+        "create_new_segment": "إنشاء شريحة جديدة",
+        "segment_name": "اسم الشريحة",
+        "segment_rules": "القواعد (JSON)",
+        "create_segment": "إنشاء شريحة",
+        "tags": "الوسوم",
+        "block_emails": "حظر العناوين",
+        "block_emails_hint": "لن يتم الإرسال إلى العناوين المحظورة مرة أخرى من أي حملة أو إعادة إرسال أو متابعة.",
+        "block": "حظر",
+        "attachments": "المرفقات",
+        "add_attachments": "إضافة مرفقات",
+        "remove_current_attachments": "إزالة المرفقات الحالية",
+        "dkim_config": "توقيع DKIM (اختياري)",
+        "dkim_selector": "المحدد (Selector)",
+        "dkim_private_key": "المفتاح الخاص (PEM)",
+        "dkim_hint": "يوقّع الرسائل لنطاق عنوان البريد. انشر المفتاح العام في selector._domainkey.domain.",
+        "dkim_key_change_hint": "اترك المفتاح فارغًا للإبقاء على المفتاح المحفوظ. امسح المحدد لإيقاف التوقيع.",
+        "priority": "الأولوية",
+        "priority_high": "عالية",
+        "priority_normal": "عادية",
+        "priority_low": "منخفضة",
+        "weight": "الوزن",
+        "sending_limits": "حدود الإرسال (كل الحملات)",
+        "sending_limits_short": "الحدود:",
+        "max_connections": "الاتصالات المتوازية",
+        "max_per_minute": "رسائل في الدقيقة",
+        "search": "بحث",
+        "search_replies_placeholder": "المرسل أو الموضوع أو نص الرسالة",
+        "all_campaigns": "كل الحملات",
+        "unread_only": "غير المقروءة فقط",
+        "newer": "→ الأحدث",
+        "older": "الأقدم ←",
+        "opens": "الفتح",
+        "clicks": "النقرات"
     }
-}
+};
@@ -0,0 +1,200 @@
+import gzip
+import hashlib
+import io
+import mimetypes
+import os
+import re
+import sys
+from flask import current_app, request, send_file
+from flask.sessions import SecureCookieSessionInterface
+from werkzeug.exceptions import NotFound
+
+# Static file delivery. url_for('static', filename='js/chart.js') yields a fingerprinted
+# URL, /static/js/chart.<content hash>.js, which is served with a one year immutable
+# Cache-Control: a changed file gets a new URL, so browsers never revalidate an asset
+# and never keep a stale one. Plain or outdated fingerprinted URLs still work but must
+# revalidate (no-cache), against an ETag of the content hash.
+# Precompressed variants (file.js.gz, file.js.br) made by `python static_assets.py`
+# (run at build time on Heroku, see bin/post_compile) are served to clients that accept
+# them. A compressible file without a gzip variant is gzipped on first request and kept
+# in memory, so a missing build step costs CPU once per process, not bandwidth. Rendered
+# HTML pages are gzipped on the fly (COMPRESS_HTML=0 turns that off).
+
+CACHE_MAX_AGE = int(os.environ.get('STATIC_CACHE_MAX_AGE', 365 * 24 * 3600)) # Seconds, fingerprinted URLs
+COMPRESS_HTML = os.environ.get('COMPRESS_HTML', '1') != '0'
+HTML_COMPRESS_LEVEL = int(os.environ.get('HTML_COMPRESS_LEVEL', 4)) # 1 (fastest) to 9 (smallest)
+
+COMPRESSIBLE = ('.js', '.css', '.json', '.svg', '.html', '.txt', '.map')
+MIN_COMPRESS_SIZE = 1024 # Bytes; smaller files aren't worth a variant
+ENCODINGS = (('br', '.br'), ('gzip', '.gz')) # In order of preference
+FALLBACK_COMPRESS_LEVEL = 6 # On-the-fly gzip of files without a variant (done once per file)
+HASH_LENGTH = 12
+FINGERPRINT_RE = re.compile(r'^(.+)\.([0-9a-f]{%d})(\.[^./]+)$' % HASH_LENGTH)
+
+def _fingerprint(name, digest):
+    root, ext = os.path.splitext(name)
+    return f"{root}.{digest}{ext}"
+
+class _Asset:
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        with open(path, 'rb') as f:
+            self.digest = hashlib.sha256(f.read()).hexdigest()[:HASH_LENGTH]
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        # Variants older than the file are stale (not rebuilt since an edit) and ignored
+        self.variants = {encoding: path + suffix for encoding, suffix in ENCODINGS
+                         if os.path.exists(path + suffix) and os.stat(path + suffix).st_mtime >= self.mtime}
+        self.compressible = path.endswith(COMPRESSIBLE) and os.path.getsize(path) >= MIN_COMPRESS_SIZE
+        self._gzipped = None
+
+    def gzipped(self):
+        """
+        The file gzipped in memory, for when no gzip variant was built; None if that
+        wouldn't make it smaller.
+        """
+        if self._gzipped is None:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            compressed = gzip.compress(data, FALLBACK_COMPRESS_LEVEL, mtime=0)
+            self._gzipped = compressed if len(compressed) < len(data) * 0.95 else b''
+        return self._gzipped or None
+
+class _SessionInterface(SecureCookieSessionInterface):
+    # Static files don't need the session. Without this, reading it (Flask-Login does after
+    # every request) adds "Vary: Cookie", and as the cookie changes with every flash message
+    # browsers would refetch the cached assets.
+    # (Flask opens the session before matching the URL, so check the path.)
+    def open_session(self, app, request):
+        if request.path.startswith(app.static_url_path + '/'):
+            return self.null_session_class()
+        return super().open_session(app, request)
+
+class StaticAssets:
+    def __init__(self):
+        self.folder = None
+        self._assets = {}
+
+    def init_app(self, app):
+        """
+        Hashes the static folder, fingerprints url_for('static') URLs and takes over the
+        static endpoint. Hashing the whole folder takes a few milliseconds.
+        """
+        self.folder = app.static_folder
+        self._assets = {}
+        for directory, _, files in os.walk(self.folder):
+            for file_name in files:
+                if file_name.endswith(('.gz', '.br')):
+                    continue
+                path = os.path.join(directory, file_name)
+                self._assets[os.path.relpath(path, self.folder).replace(os.sep, '/')] = _Asset(path)
+        app.url_defaults(self._url_defaults)
+        app.view_functions['static'] = self.serve
+        app.session_interface = _SessionInterface()
+        if COMPRESS_HTML:
+            app.after_request(compress_html)
+
+    def _asset(self, name):
+        asset = self._assets.get(name)
+        # While debugging files are edited under a running app: pick up the new content
+        if asset is not None and current_app.debug and os.stat(asset.path).st_mtime != asset.mtime:
+            asset = self._assets[name] = _Asset(asset.path)
+        return asset
+
+    def url_name(self, name):
+        asset = self._asset(name)
+        return _fingerprint(name, asset.digest) if asset else name
+
+    def _url_defaults(self, endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            values['filename'] = self.url_name(values['filename'])
+
+    def serve(self, filename):
+        name, digest = filename, None
+        match = FINGERPRINT_RE.match(filename)
+        if match and match.group(1) + match.group(3) in self._assets:
+            name, digest = match.group(1) + match.group(3), match.group(2)
+        asset = self._asset(name)
+        if asset is None:
+            raise NotFound()
+        encoding = next((encoding for encoding, _ in ENCODINGS
+                         if encoding in asset.variants and request.accept_encodings[encoding]), None)
+        source = asset.variants[encoding] if encoding else asset.path
+        if (encoding is None and asset.compressible and 'gzip' not in asset.variants
+                and request.accept_encodings['gzip'] and asset.gzipped()):
+            encoding, source = 'gzip', io.BytesIO(asset.gzipped())
+        response = send_file(source, mimetype=asset.mimetype,
+                             etag=f"{asset.digest}-{encoding}" if encoding else asset.digest,
+                             max_age=CACHE_MAX_AGE if digest == asset.digest else None,
+                             last_modified=asset.mtime)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if asset.variants or asset.compressible:
+            response.vary.add('Accept-Encoding')
+        if digest == asset.digest:
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response
+
+def compress_html(response):
+    """
+    Gzips rendered HTML pages for clients that accept it; streamed responses are left alone.
+    """
+    if (response.mimetype != 'text/html' or response.status_code != 200 or response.is_streamed
+            or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or not request.accept_encodings['gzip']):
+        return response
+    body = response.get_data()
+    if len(body) < MIN_COMPRESS_SIZE:
+        return response
+    response.set_data(gzip.compress(body, HTML_COMPRESS_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+def build(folder, force=False):
+    """
+    Writes .gz (and .br, when the brotli package is installed) next to every compressible
+    file in folder, skipping variants that are up to date or wouldn't be smaller.
+    Returns [(file, encoding, original size, compressed size)] of the variants written.
+    """
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+    compressors = [('gzip', '.gz', lambda data: gzip.compress(data, 9, mtime=0))]
+    if brotli is not None:
+        compressors.insert(0, ('br', '.br', lambda data: brotli.compress(data, quality=11)))
+    written = []
+    for directory, _, files in os.walk(folder):
+        for file_name in sorted(files):
+            path = os.path.join(directory, file_name)
+            if not file_name.endswith(COMPRESSIBLE) or os.path.getsize(path) < MIN_COMPRESS_SIZE:
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            for encoding, suffix, compress in compressors:
+                target = path + suffix
+                if not force and os.path.exists(target) and os.stat(target).st_mtime >= os.stat(path).st_mtime:
+                    continue
+                compressed = compress(data)
+                if len(compressed) >= len(data) * 0.95:
+                    continue
+                with open(target + '.tmp', 'wb') as f:
+                    f.write(compressed)
+                os.replace(target + '.tmp', target)
+                written.append((os.path.relpath(path, folder), encoding, len(data), len(compressed)))
+    return written
+
+# Shared per-process instance
+static_assets = StaticAssets()
+
+if __name__ == '__main__':
+    # Precompress static files:  python static_assets.py [--force]
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    written = build(folder, force='--force' in sys.argv[1:])
+    for name, encoding, size, compressed in written:
+        print(f"{name} ({encoding}): {size} -> {compressed} bytes")
+    print(f"Wrote {len(written)} compressed static files.")
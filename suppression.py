@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+from datetime import timedelta
+from database import db, Contact, Suppression
+from db_writer import background_writer
+from email_utils import normalize_email
+
+# Contact.status a suppression reason maps to
+REASON_STATUS = {
+    'unsubscribe': 'unsubscribed',
+    'bounce': 'bounced',
+    'complaint': 'unsubscribed',
+}
+
+# Refreshes re-read rows created this long before the newest one seen. Rows become
+# visible when their transaction commits, which can be after a newer row committed
+# (or be stamped by a host whose clock lags), so a plain "newer than" watermark would
+# skip them for good.
+REFRESH_OVERLAP = timedelta(seconds=int(os.environ.get('SUPPRESSION_REFRESH_OVERLAP', 60)))
+
+class SuppressionList:
+    """
+    In-memory copy of the Suppression table used for O(1) membership checks at send time.
+    The first refresh loads every row; later refreshes only fetch rows created since
+    the newest one seen (less REFRESH_OVERLAP), so keeping the set current costs one
+    indexed range query.
+    """
+
+    def __init__(self, refresh_interval=30):
+        self.refresh_interval = refresh_interval
+        self._emails = set()
+        self._newest = None # created_at of the newest row loaded
+        self._last_refresh = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Pulls suppressions added since the last refresh. Must run inside an app context.
+        Returns the number of addresses new to the set.
+        """
+        with self._lock:
+            query = db.session.query(Suppression.email, Suppression.created_at)
+            if self._newest is not None:
+                query = query.filter(Suppression.created_at >= self._newest - REFRESH_OVERLAP)
+            added = 0
+            for email, created_at in query.all():
+                if email not in self._emails:
+                    self._emails.add(email)
+                    added += 1
+                if created_at is not None and (self._newest is None or created_at > self._newest):
+                    self._newest = created_at
+            self._last_refresh = time.monotonic()
+        return added
+
+    def maybe_refresh(self):
+        """
+        Refreshes if the last refresh is older than refresh_interval seconds.
+        Cheap enough to call from inside a send loop.
+        """
+        if time.monotonic() - self._last_refresh >= self.refresh_interval:
+            self.refresh()
+
+    def reset(self):
+        """
+        Drops the in-memory copy, e.g. after the database file was replaced.
+        """
+        with self._lock:
+            self._emails = set()
+            self._newest = None
+            self._last_refresh = 0
+
+    def is_suppressed(self, email):
+        return normalize_email(email) in self._emails
+
+    def __contains__(self, email):
+        return self.is_suppressed(email)
+
+    def __len__(self):
+        return len(self._emails)
+
+    def add(self, email, reason, source=None, commit=True):
+        """
+        Suppresses an address: records it in the table, marks matching contacts
+        and updates the in-memory set immediately. Returns True if it was new.
+        """
+        email = normalize_email(email)
+        if not email:
+            return False
+        self._emails.add(email)
+        added = _store(db.session, email, reason, source)
+        if added and commit:
+            db.session.commit()
+        return added
+
+    def defer(self, email, reason, source=None):
+        """
+        Like add, for send threads: the set is updated now and the rows are written
+        by the background writer, so senders don't contend for SQLite's write lock.
+        """
+        email = normalize_email(email)
+        if email:
+            self._emails.add(email)
+            background_writer.submit(lambda session: _store(session, email, reason, source))
+
+    # There is no remove: refresh only picks up new rows, so other processes would keep
+    # suppressing a deleted address until they restart.
+
+def _store(session, email, reason, source):
+    if session.query(Suppression.id).filter_by(email=email).first():
+        return False
+    session.add(Suppression(email=email, reason=reason, source=(source or '')[:200] or None))
+    status = REASON_STATUS.get(reason)
+    if status:
+        session.query(Contact).filter(Contact.email == email, Contact.status == 'active').update(
+            {Contact.status: status}, synchronize_session=False)
+    return True
+
+def seed_from_contacts(commit=True):
+    """
+    Adds a suppression row for every unsubscribed or bounced contact that lacks one.
+    Returns the number of rows added.
+    """
+    existing = db.session.query(Suppression.email)
+    rows = db.session.query(Contact.email, Contact.status).filter(
+        Contact.status.in_(['unsubscribed', 'bounced']),
+        ~Contact.email.in_(existing)
+    ).all()
+    seen = set()
+    for email, status in rows:
+        email = normalize_email(email)
+        if not email or email in seen or Suppression.query.filter_by(email=email).first():
+            continue
+        seen.add(email)
+        db.session.add(Suppression(email=email, reason='bounce' if status == 'bounced' else 'unsubscribe', source='Contact status'))
+    if seen and commit:
+        db.session.commit()
+    return len(seen)
+
+# Shared per-process list used by every send path
+suppression_list = SuppressionList()
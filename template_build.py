@@ -0,0 +1,373 @@
+import base64
+import html
+import quopri
+import re
+import threading
+from collections import OrderedDict, namedtuple
+from template_registry import content_hash as _content_hash
+
+# Output of the build stage for one template version.
+# html/text still contain the {{name}} placeholder; personalization happens per recipient.
+BuiltTemplate = namedtuple('BuiltTemplate', [
+    'content_hash', 'html', 'text', 'html_encoding', 'text_encoding', 'original_size', 'size'
+])
+
+STYLE_BLOCK_RE = re.compile(r'<style\b[^>]*>(.*?)</style\s*>', re.I | re.S)
+# Keeps Outlook conditional comments (<!--[if mso]> ... <![endif]-->)
+COMMENT_RE = re.compile(r'<!--(?!\s*\[if).*?-->', re.S)
+PRESERVE_RE = re.compile(r'<(pre|textarea)\b.*?</\1\s*>', re.I | re.S)
+START_TAG_RE = re.compile(r'<([a-zA-Z][\w:-]*)((?:\s+[^\s=>/]+(?:\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s>]+))?)*)\s*(/?)>')
+ATTR_RE = re.compile(r'([^\s=>/]+)(?:\s*=\s*("[^"]*"|\'[^\']*\'|[^\s>]+))?')
+SIMPLE_SELECTOR_RE = re.compile(r'^([a-zA-Z][\w-]*)?((?:[.#][\w-]+)*)$')
+CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+
+MAX_LINE_LENGTH = 998  # RFC 5322 limit for 7bit bodies
+
+# ---------------------------------------------------------------------------
+# CSS inlining
+# ---------------------------------------------------------------------------
+
+def _split_css(css):
+    """
+    Splits a stylesheet into top level chunks: ('rule', selectors, declarations)
+    for plain rules and ('raw', text) for at-rules such as @media, which can't be inlined.
+    """
+    css = CSS_COMMENT_RE.sub('', css)
+    chunks = []
+    i = 0
+    while i < len(css):
+        start = css.find('{', i)
+        if start == -1:
+            break
+        prelude = css[i:start].strip()
+        depth = 0
+        end = start
+        while end < len(css):
+            if css[end] == '{':
+                depth += 1
+            elif css[end] == '}':
+                depth -= 1
+                if depth == 0:
+                    break
+            end += 1
+        body = css[start + 1:end]
+        if prelude.startswith('@') or '{' in body:
+            chunks.append(('raw', f"{prelude}{{{body}}}"))
+        else:
+            chunks.append(('rule', prelude, body.strip()))
+        i = end + 1
+    return chunks
+
+def _parse_selector(selector):
+    """
+    Returns (tag, classes, ids) for simple selectors like 'p', '.btn', 'td.cell#x',
+    or None for anything involving combinators, pseudo classes or attributes.
+    """
+    match = SIMPLE_SELECTOR_RE.match(selector.strip())
+    if not match or not selector.strip():
+        return None
+    tag = (match.group(1) or '').lower() or None
+    parts = re.findall(r'([.#])([\w-]+)', match.group(2))
+    classes = {name for kind, name in parts if kind == '.'}
+    ids = {name for kind, name in parts if kind == '#'}
+    return tag, classes, ids
+
+def _declarations(body):
+    return [d.strip().replace('"', "'") for d in body.split(';') if ':' in d]
+
+def _parse_attrs(attr_text):
+    attrs = []
+    for match in ATTR_RE.finditer(attr_text):
+        value = match.group(2)
+        if value and value[0] in '"\'':
+            value = value[1:-1]
+        attrs.append((match.group(1).lower(), value, match.span()))
+    return attrs
+
+def _specificity(selector):
+    """
+    (ids, classes/attributes/pseudo classes, tags/pseudo elements) of a complex selector.
+    """
+    selector = re.sub(r'\((?:[^()]|\([^()]*\))*\)', '', selector) # :not(...) and friends count as their name only
+    pseudo_elements = len(re.findall(r'::[\w-]+', selector))
+    selector = re.sub(r'::[\w-]+', '', selector)
+    ids = len(re.findall(r'#[\w-]+', selector))
+    classes = len(re.findall(r'\.[\w-]+|\[[^\]]*\]|:[\w-]+', selector))
+    tags = len(re.findall(r'(?:^|[\s>+~])([a-zA-Z][\w-]*)', selector))
+    return ids, classes, tags + pseudo_elements
+
+def _subject(selector):
+    """
+    _parse_selector of the part of a complex selector naming the styled element
+    ('.footer a:hover' -> 'a'), or None when that can't be told.
+    """
+    last = re.split(r'[\s>+~]+', selector.strip())[-1]
+    return _parse_selector(re.sub(r'::?[\w-]+(?:\([^)]*\))?|\[[^\]]*\]', '', last))
+
+def _may_match_same(a, b):
+    if a is None or b is None:
+        return True
+    (tag_a, _, ids_a), (tag_b, _, ids_b) = a, b
+    return not ((tag_a and tag_b and tag_a != tag_b) or (ids_a and ids_b and ids_a != ids_b))
+
+def _properties(declarations, important=True):
+    return {d.split(':', 1)[0].strip().lower() for d in declarations if important or '!important' not in d.lower()}
+
+def _overlap(props_a, props_b):
+    # margin and margin-top interact, as do border and border-left-color
+    return any(a == b or a.startswith(b + '-') or b.startswith(a + '-') for a in props_a for b in props_b)
+
+def inline_css(content):
+    """
+    Moves rules with simple selectors (tag, .class, #id and combinations of those)
+    from <style> blocks into style="" attributes, since many mail clients drop
+    <style>. Rules that can't be inlined (@media, :hover, descendant selectors...)
+    stay in a <style> block, and so does a simple rule that one of those would
+    override on the same element: inlined, it would win instead. Existing inline
+    styles win over inlined ones.
+    """
+    blocks = [_split_css(match.group(1)) for match in STYLE_BLOCK_RE.finditer(content)]
+    candidates = [] # [specificity, order, parsed, declarations, properties, inline, non-!important properties]
+    kept = [] # (specificity, order, subject, properties) of rules that stay in <style>
+    by_selector = {} # (block, chunk, selector index) -> candidate
+    order = 0
+
+    def keep(selector, body):
+        nonlocal order
+        # !important declarations beat inline styles anyway, so only the others can be overridden
+        kept.append((_specificity(selector), order, _subject(selector), _properties(_declarations(body), important=False)))
+        order += 1
+
+    for block_index, chunks in enumerate(blocks):
+        for chunk_index, chunk in enumerate(chunks):
+            if chunk[0] == 'raw':
+                # Rules inside @media and the like still override inlined ones
+                body = chunk[1][chunk[1].find('{') + 1:-1]
+                for inner in _split_css(body):
+                    if inner[0] == 'rule':
+                        for selector in inner[1].split(','):
+                            keep(selector, inner[2])
+                continue
+            _, prelude, body = chunk
+            declarations = _declarations(body)
+            for selector_index, selector in enumerate(prelude.split(',')):
+                parsed = _parse_selector(selector)
+                if parsed is None or not declarations:
+                    keep(selector, body)
+                    continue
+                tag, classes, ids = parsed
+                candidate = [(len(ids), len(classes), 1 if tag else 0), order, parsed, declarations,
+                             _properties(declarations), True, _properties(declarations, important=False)]
+                candidates.append(candidate)
+                by_selector[(block_index, chunk_index, selector_index)] = candidate
+                order += 1
+
+    # A candidate stays in <style> if a kept rule that may style the same element sets one
+    # of its properties and wins the cascade. Keeping it can in turn affect weaker candidates.
+    changed = True
+    while changed:
+        changed = False
+        blockers = kept + [(c[0], c[1], c[2], c[6]) for c in candidates if not c[5]]
+        for candidate in candidates:
+            if candidate[5] and any(
+                    (spec, rule_order) > (candidate[0], candidate[1]) and _may_match_same(candidate[2], subject)
+                    and _overlap(candidate[4], properties)
+                    for spec, rule_order, subject, properties in blockers):
+                candidate[5] = False
+                changed = True
+
+    rules = sorted((c for c in candidates if c[5]), key=lambda c: (c[0], c[1]))
+    block_numbers = iter(range(len(blocks)))
+
+    def rebuild(match):
+        block_index = next(block_numbers)
+        css = []
+        for chunk_index, chunk in enumerate(blocks[block_index]):
+            if chunk[0] == 'raw':
+                css.append(chunk[1])
+                continue
+            _, prelude, body = chunk
+            leftover = [selector.strip() for selector_index, selector in enumerate(prelude.split(','))
+                        if not by_selector.get((block_index, chunk_index, selector_index), [None] * 7)[5]]
+            if leftover:
+                css.append(f"{','.join(leftover)}{{{body}}}")
+        return f"<style>{''.join(css)}</style>" if css else ''
+
+    content = STYLE_BLOCK_RE.sub(rebuild, content)
+    if not rules:
+        return content
+
+    def apply(match):
+        tag = match.group(1).lower()
+        attrs = _parse_attrs(match.group(2))
+        values = {name: value for name, value, _ in attrs}
+        classes = set((values.get('class') or '').split())
+        element_id = values.get('id')
+        declarations = []
+        for _, _, (rule_tag, rule_classes, rule_ids), rule_declarations, *_ in rules:
+            if rule_tag and rule_tag != tag:
+                continue
+            if not rule_classes <= classes:
+                continue
+            if rule_ids and rule_ids != {element_id}:
+                continue
+            declarations.extend(rule_declarations)
+        if not declarations:
+            return match.group(0)
+        existing = values.get('style')
+        if existing:
+            declarations.extend(_declarations(existing))
+        style = '; '.join(declarations)
+        attr_text = match.group(2)
+        for name, _, (start, end) in attrs:
+            if name == 'style':
+                attr_text = f'{attr_text[:start]}style="{style}"{attr_text[end:]}'
+                break
+        else:
+            attr_text = f'{attr_text} style="{style}"'
+        closing = ' /' if match.group(3) else ''
+        return f"<{match.group(1)}{attr_text}{closing}>"
+
+    return START_TAG_RE.sub(apply, content)
+
+# ---------------------------------------------------------------------------
+# Minification
+# ---------------------------------------------------------------------------
+
+def _minify_css(css):
+    css = CSS_COMMENT_RE.sub('', css)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    return css.replace(';}', '}').strip()
+
+def minify_html(content):
+    """
+    Drops comments (except conditional ones) and collapses whitespace.
+    Runs containing a newline become a single newline so lines stay well under the
+    998 character SMTP limit; <pre> and <textarea> contents are left untouched.
+    """
+    preserved = []
+
+    def protect(match):
+        preserved.append(match.group(0))
+        return f"\x00{len(preserved) - 1}\x00"
+
+    content = COMMENT_RE.sub('', content)
+    content = PRESERVE_RE.sub(protect, content)
+    content = STYLE_BLOCK_RE.sub(lambda m: f"<style>{_minify_css(m.group(1))}</style>", content)
+    content = re.sub(r'\s+', lambda m: '\n' if '\n' in m.group(0) else ' ', content)
+    content = re.sub(r'\x00(\d+)\x00', lambda m: preserved[int(m.group(1))], content)
+    return content.strip()
+
+# ---------------------------------------------------------------------------
+# text/plain alternative
+# ---------------------------------------------------------------------------
+
+def _link_text(match):
+    href = html.unescape(match.group(2) or '').strip()
+    label = re.sub(r'<[^>]+>', '', match.group(3)).strip()
+    if not href or href.startswith('#') or href.startswith('mailto:') or href == label:
+        return label
+    return f"{label} ({href})" if label else href
+
+def html_to_text(content):
+    """
+    Renders a readable text/plain version of an HTML email.
+    """
+    text = COMMENT_RE.sub('', content)
+    text = re.sub(r'<(head|style|script|title)\b.*?</\1\s*>', '', text, flags=re.I | re.S)
+    text = re.sub(r'<a\b[^>]*?href\s*=\s*(["\'])(.*?)\1[^>]*>(.*?)</a\s*>', _link_text, text, flags=re.I | re.S)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'<br\s*/?>', '\n', text, flags=re.I)
+    text = re.sub(r'<li\b[^>]*>', '\n- ', text, flags=re.I)
+    text = re.sub(r'</(p|div|h[1-6]|tr|table|ul|ol|blockquote)\s*>', '\n\n', text, flags=re.I)
+    text = re.sub(r'</td\s*>', ' ', text, flags=re.I)
+    text = re.sub(r'<[^>]+>', '', text)
+    text = html.unescape(text).replace('\xa0', ' ')
+    lines = [re.sub(r'[ \t]+', ' ', line).strip() for line in text.split('\n')]
+    text = '\n'.join(lines)
+    return re.sub(r'\n{3,}', '\n\n', text).strip() + '\n'
+
+# ---------------------------------------------------------------------------
+# Transfer encoding
+# ---------------------------------------------------------------------------
+
+def choose_transfer_encoding(content):
+    """
+    Picks the smallest Content-Transfer-Encoding for a text body:
+    '7bit' for ASCII with short lines, otherwise whichever of 'quoted-printable'
+    and 'base64' encodes to fewer bytes (QP for mostly-ASCII text, base64 for e.g. Arabic).
+    """
+    if content.isascii() and all(len(line) <= MAX_LINE_LENGTH for line in content.split('\n')):
+        return '7bit'
+    data = content.encode('utf-8')
+    qp_size = len(quopri.encodestring(data))
+    base64_size = len(base64.encodebytes(data))
+    return 'quoted-printable' if qp_size <= base64_size else 'base64'
+
+# ---------------------------------------------------------------------------
+# Build cache
+# ---------------------------------------------------------------------------
+
+def build_html(content, content_hash=None):
+    """
+    Runs the full pipeline on a template body: inline CSS, minify, text alternative
+    and transfer encodings.
+    """
+    content = content or ''
+    built_html = minify_html(inline_css(content))
+    text = html_to_text(built_html)
+    return BuiltTemplate(
+        content_hash=content_hash or _content_hash(content),
+        html=built_html,
+        text=text,
+        html_encoding=choose_transfer_encoding(built_html),
+        text_encoding=choose_transfer_encoding(text),
+        original_size=len(content.encode('utf-8')),
+        size=len(built_html.encode('utf-8')),
+    )
+
+class TemplateBuildCache:
+    """
+    LRU cache of built templates keyed by content hash, so the pipeline runs once
+    per template version rather than per campaign or per recipient.
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, content, content_hash=None):
+        key = content_hash or _content_hash(content)
+        with self._lock:
+            built = self._entries.get(key)
+            if built is not None:
+                self._entries.move_to_end(key)
+                return built
+        built = build_html(content, key)
+        with self._lock:
+            self._entries[key] = built
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return built
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+# Shared per-process cache
+template_builds = TemplateBuildCache()
+
+def build_template(template):
+    """
+    Returns the BuiltTemplate for a Template row (or anything with .content and .content_hash).
+    """
+    return template_builds.get(template.content, getattr(template, 'content_hash', None))
+
+def personalize(built, name):
+    """
+    Returns (html, text) with the {{name}} placeholder filled in.
+    """
+    return built.html.replace('{{name}}', name), built.text.replace('{{name}}', name)
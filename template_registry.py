@@ -0,0 +1,69 @@
+import hashlib
+import os
+import threading
+from collections import namedtuple
+
+FileTemplate = namedtuple('FileTemplate', ['name', 'content', 'content_hash', 'mtime_ns'])
+
+def content_hash(content):
+    """
+    Content address of a template body: hex SHA-256 of its UTF-8 bytes.
+    """
+    return hashlib.sha256((content or '').encode('utf-8')).hexdigest()
+
+def is_safe_name(filename):
+    return bool(filename) and '..' not in filename and '/' not in filename and '\\' not in filename
+
+class FileTemplateRegistry:
+    """
+    In-memory registry of the HTML templates in a directory.
+    The file list is cached against the directory mtime (which changes when files are
+    added, removed or renamed) and each file's content against its own mtime and size,
+    so a page render or preview costs a stat() instead of a glob or a full read.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._names = []
+        self._dir_mtime_ns = None
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def names(self):
+        """
+        Returns the sorted .html file names in the directory.
+        """
+        mtime_ns = os.stat(self.directory).st_mtime_ns
+        if mtime_ns != self._dir_mtime_ns:
+            with self._lock:
+                with os.scandir(self.directory) as entries:
+                    self._names = sorted(e.name for e in entries if e.name.endswith('.html') and e.is_file())
+                self._dir_mtime_ns = mtime_ns
+                # Forget files that no longer exist
+                for name in list(self._files):
+                    if name not in self._names:
+                        del self._files[name]
+        return list(self._names)
+
+    def get(self, filename):
+        """
+        Returns the FileTemplate for filename, re-reading it only if it changed on disk.
+        Returns None for unsafe names or missing files.
+        """
+        if not is_safe_name(filename):
+            return None
+        path = os.path.join(self.directory, filename)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        cached = self._files.get(filename)
+        if cached and cached[0] == (stat.st_mtime_ns, stat.st_size):
+            return cached[1]
+        with open(path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        template = FileTemplate(filename, content, content_hash(content), stat.st_mtime_ns)
+        with self._lock:
+            self._files[filename] = ((stat.st_mtime_ns, stat.st_size), template)
+        return template
@@ -0,0 +1,207 @@
+import atexit
+import base64
+import hashlib
+import hmac
+import html
+import os
+import re
+import threading
+from collections import Counter
+from datetime import datetime
+from urllib.parse import quote
+from sqlalchemy import insert, update
+from database import db, Campaign, CampaignRecipient as CR, TrackingEvent
+from db_writer import background_writer
+from metrics import counter, gauge
+from template_build import choose_transfer_encoding
+
+# Open and click tracking. Campaign emails get an open pixel and their http(s) links are
+# routed through the app, each carrying a token "<campaign id>.<recipient id>.<signature>"
+# (recipient = campaign_recipient row), so a hit is verified with one HMAC and no query.
+# Hits are appended to a per-process buffer; a flusher thread writes them in bulk: one
+# insert of the raw events, the first open/click time of each recipient (which decides
+# what is unique) and the campaign's open/click counters, which is what pages read.
+# Tracking is on when TRACKING_BASE_URL (the app's public URL) is set.
+
+FLUSH_INTERVAL = float(os.environ.get('TRACKING_FLUSH_INTERVAL', 1)) # Seconds
+FLUSH_SIZE = int(os.environ.get('TRACKING_FLUSH_SIZE', 1000)) # Flush early once this many hits are waiting
+MAX_BUFFER = int(os.environ.get('TRACKING_MAX_BUFFER', 100000)) # Hits beyond this are dropped, not queued
+
+PIXEL = base64.b64decode('R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7') # 1x1 transparent GIF
+LINK_RE = re.compile(r'(<a\b[^>]*?\bhref\s*=\s*)(["\'])(https?://[^"\']+)\2', re.I)
+IN_CHUNK = 500 # Recipient ids per UPDATE ... IN (...)
+
+tracking_events = counter('mailer_tracking_events_total', "Open and click hits accepted", ['type'])
+tracking_rejected = counter('mailer_tracking_rejected_total', "Hits with a bad token, or dropped on a full buffer", ['reason'])
+tracking_buffer = gauge('mailer_tracking_buffer', "Hits waiting to be written")
+
+class TrackedTemplate:
+    """
+    A built template's HTML split at its links, so one recipient's tracked copy is a join.
+    Links containing placeholders such as {{name}} are left alone.
+    """
+
+    def __init__(self, tracker, content, campaign_id):
+        self.tracker = tracker
+        self.campaign_id = campaign_id
+        self.parts = [] # Literal HTML and link URLs, alternating; literals at even positions
+        position = 0
+        for match in LINK_RE.finditer(content):
+            if '{{' in match.group(3):
+                continue
+            self.parts += [content[position:match.start(3)], html.unescape(match.group(3))]
+            position = match.end(3)
+        tail = content[position:]
+        image = '<img src="{pixel}" width="1" height="1" alt="" style="border:0;width:1px;height:1px">' # html_for fills in {pixel}
+        pixel = tail.rfind('</body>')
+        self.parts.append(tail[:pixel] + image + tail[pixel:] if pixel != -1 else tail + image)
+        # Tokens make lines longer, so pick the encoding for the longest ones
+        self.html_encoding = choose_transfer_encoding(self.html_for(10 ** 12))
+
+    def html_for(self, recipient_id):
+        ids = f"{self.campaign_id}.{recipient_id}"
+        base = self.tracker.base_url
+        out = []
+        for index, part in enumerate(self.parts):
+            if index % 2:
+                out.append(f"{base}/t/c/{ids}.{self.tracker.sign('c', ids, part)}?u={quote(part, safe='')}")
+            else:
+                out.append(part)
+        out[-1] = out[-1].replace('{pixel}', f"{base}/t/o/{ids}.{self.tracker.sign('o', ids)}.gif", 1)
+        return ''.join(out)
+
+class Tracker:
+    def __init__(self, flush_interval=FLUSH_INTERVAL, flush_size=FLUSH_SIZE, max_buffer=MAX_BUFFER):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.max_buffer = max_buffer
+        self.base_url = ''
+        self._key = None
+        self._app = None
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.base_url and self._key)
+
+    def init_app(self, app, base_url=None):
+        """
+        Reads TRACKING_BASE_URL and the signing key (TRACKING_SECRET, else SECRET_KEY).
+        """
+        self._app = app
+        self.base_url = (base_url or os.environ.get('TRACKING_BASE_URL') or '').rstrip('/')
+        secret = os.environ.get('TRACKING_SECRET') or app.config.get('SECRET_KEY')
+        self._key = hashlib.sha256(b'emailgo-tracking:' + secret.encode()).digest() if secret else None
+        atexit.register(self.flush)
+
+    def sign(self, kind, ids, url=''):
+        digest = hmac.new(self._key, f"{kind}:{ids}:{url}".encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:12]).decode()
+
+    def verify(self, kind, token, url=''):
+        """
+        (campaign id, recipient id) if token is a valid kind ('o' or 'c') token, else None.
+        """
+        if self._key is None:
+            return None
+        campaign_id, _, rest = token.partition('.')
+        recipient_id, _, signature = rest.partition('.')
+        if not (campaign_id.isdigit() and recipient_id.isdigit()):
+            return None
+        if not hmac.compare_digest(signature.encode(), self.sign(kind, f"{campaign_id}.{recipient_id}", url).encode()):
+            return None
+        return int(campaign_id), int(recipient_id)
+
+    def template(self, built, campaign_id):
+        """
+        TrackedTemplate for a BuiltTemplate, or None when tracking is off.
+        """
+        return TrackedTemplate(self, built.html, campaign_id) if self.enabled else None
+
+    def hit(self, kind, token, url=None, user_agent=None):
+        """
+        Verifies and buffers an 'open' or 'click'. Returns False for a bad token.
+        """
+        ids = self.verify(kind[0], token, url or '')
+        if ids is None:
+            tracking_rejected.inc(reason='token')
+            return False
+        with self._lock:
+            if len(self._buffer) >= self.max_buffer:
+                tracking_rejected.inc(reason='buffer_full')
+                return True
+            self._buffer.append((kind, ids[0], ids[1], url, (user_agent or '')[:200], datetime.utcnow()))
+            if len(self._buffer) >= self.flush_size:
+                self._wake.set()
+        tracking_events.inc(type=kind)
+        self._ensure_started()
+        return True
+
+    def pending(self):
+        return len(self._buffer)
+
+    def flush(self):
+        """
+        Writes the buffered hits. Blocks until they are committed.
+        """
+        with self._lock:
+            events, self._buffer = self._buffer, []
+        if not events or self._app is None:
+            return len(events)
+        with self._app.app_context():
+            background_writer.submit(lambda session: write_events(session, events))
+            background_writer.flush()
+            db.session.remove()
+        return len(events)
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='tracking-flush', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Tracking flush failed: {e}")
+
+def write_events(session, events):
+    """
+    Bulk inserts hits [(type, campaign id, recipient id, url, user agent, time)] and
+    updates first open/click times and the campaign counters.
+    """
+    session.execute(insert(TrackingEvent), [
+        {'type': kind, 'campaign_id': campaign_id, 'recipient_id': recipient_id, 'url': url,
+         'user_agent': user_agent, 'created_at': created_at}
+        for kind, campaign_id, recipient_id, url, user_agent, created_at in events])
+    totals = Counter((kind, campaign_id) for kind, campaign_id, *_ in events)
+    recipients = {}
+    for kind, campaign_id, recipient_id, *_ in events:
+        recipients.setdefault((kind, campaign_id), set()).add(recipient_id)
+    now = datetime.utcnow()
+    for (kind, campaign_id), total in totals.items():
+        first = CR.opened_at if kind == 'open' else CR.clicked_at
+        ids = sorted(recipients[(kind, campaign_id)])
+        unique = 0
+        for start in range(0, len(ids), IN_CHUNK):
+            unique += session.execute(update(CR).where(
+                CR.id.in_(ids[start:start + IN_CHUNK]), CR.campaign_id == campaign_id, first.is_(None)
+            ).values({first: now})).rowcount
+        if kind == 'open':
+            values = {'open_count': Campaign.open_count + total, 'unique_open_count': Campaign.unique_open_count + unique}
+        else:
+            values = {'click_count': Campaign.click_count + total, 'unique_click_count': Campaign.unique_click_count + unique}
+        session.execute(update(Campaign).where(Campaign.id == campaign_id).values(values))
+
+# Shared per-process tracker
+tracker = Tracker()
+tracking_buffer.set_function(lambda: {(): tracker.pending()})